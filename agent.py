@@ -1,3 +1,5 @@
+import asyncio
+import functools
 import random
 import re
 import sys
@@ -5,13 +7,43 @@ from typing import Optional
 from dataclasses import dataclass, field
 from typing import Dict
 
-from llama import (
-    gen,
-    gen_formatted_response,
-    response_format_prompt,
-    fuzzy_percent,
-)
-from sd import make_image
+from llama import gen, gen_formatted_response
+from context import Prompt, compress
+import templates
+from sd import update_image
+from structured import Field, Percent, Schema, combine, prefixed
+import client
+from client import prioritized, SETUP, SENTIMENT, SPEAKER_SELECTION, VISIBLE
+import metrics
+
+
+EAGERNESS_SCHEMA = Schema([Percent("SPEAK_EAGERNESS")])
+
+
+# Opinions about fellow jurors before the case starts, keyed by the cast of
+# the jury (names and descriptions), the juror and the fellow juror
+preconceptions = {}
+
+
+@functools.cache
+def preconceptions_schema(name_keys):
+    return Schema(Field("OPINION_ABOUT_" + key) for key in name_keys)
+
+
+@functools.cache
+def hearing_schema(name_key, speaker_key, summarize):
+    fields = [
+        Field("MOOD"),
+        Field(name_key + "_BELIEFS"),
+        Percent("GUILTY_PERCENTAGE"),
+        Percent("INNOCENT_PERCENTAGE"),
+    ]
+    if speaker_key is None:
+        if summarize:
+            fields.insert(0, Field("FACTUAL_SUMMARY"))
+    else:
+        fields.append(Field("OPINION_ABOUT_" + speaker_key))
+    return Schema(fields, qualifiers=(name_key,))
 
 
 @dataclass
@@ -47,108 +79,162 @@ class Agent:
     # Used in UI
     image_uri: str = ""
 
-    def description_prompt(self, is_in_deliberation):
-        prompt = (
-            f"You are {self.description}. You are a member of a jury in a court case. "
-        )
-        if is_in_deliberation:
-            prompt += "The jury is now in deliberation and no further evidence will be presented. You must now examine the evidence and argue your opinion and work towards a conclusive verdict."
-        else:
-            prompt += "Evidence is being presented and you are forming an opinion."
-        return prompt
+    def __setattr__(self, name, value):
+        # Track which fields have changed since the last time the agent was
+        # saved, so that only those need to be written
+        dirty = self.__dict__.setdefault("_dirty", set())
+        if name not in self.__dict__ or self.__dict__[name] != value:
+            dirty.add(name)
+        super().__setattr__(name, value)
 
-    def mood_prompt(self):
-        return f"Your current mood is: {self.mood}"
+    def pop_dirty_fields(self):
+        dirty = self.__dict__.get("_dirty", set())
+        self.__dict__["_dirty"] = set()
+        return dirty
 
-    def beliefs_prompt(self):
-        return f"""This is the evidence for and against the defendant:
-{self.summary}
+    def set_agent_sentiment(self, name, sentiment):
+        # Mutating the dict in place wouldn't mark it as dirty
+        self.agent_sentiments = {**self.agent_sentiments, name: sentiment}
 
-Your current opinions and beliefs about the case are:
-{self.beliefs}
+    def description_prompt(self, is_in_deliberation):
+        return f"You are {self.description}. You are a member of a jury in a court case. {self.phase_prompt(is_in_deliberation)}"
 
-You are currently {self.guilty_percent}% sure that the defendant is guilty and {self.innocent_percent}% sure that the defendant is innocent."""
+    def phase_prompt(self, is_in_deliberation):
+        if is_in_deliberation:
+            return "The jury is now in deliberation and no further evidence will be presented. You must now examine the evidence and argue your opinion and work towards a conclusive verdict."
+        return "Evidence is being presented and you are forming an opinion."
+
+    def prompt_values(self, is_in_deliberation):
+        """What the juror templates in templates.py are filled in with"""
+        return {
+            "name": self.name,
+            "description": self.description,
+            "phase": self.phase_prompt(is_in_deliberation),
+            "mood": self.mood,
+            "summary": self.summary,
+            "beliefs": self.beliefs,
+            "guilty": self.guilty_percent,
+            "innocent": self.innocent_percent,
+            "sentiments": "".join(
+                f"* {name}: {sentiment}\n" for name, sentiment in self.agent_sentiments.items()
+            ),
+        }
 
-    def agent_sentiments_prompt(self):
-        prompt = "Your current opinions about your fellow jury members are:\n"
-        for name, sentiment in self.agent_sentiments.items():
-            prompt += f"* {name}: {sentiment}\n"
-        return prompt
+    def mood_prompt(self):
+        return f"Your current mood is: {self.mood}"
 
     async def set_initial_mood(self):
         prompt = f"""{self.description_prompt(is_in_deliberation=False)}
 
 What is your current mood? Respond in only one or two words."""
-        self.mood = await gen(prompt)
-        self.image_uri = await make_image(self)
-
-    async def set_preconceptions_about_fellow_jury_members(self, other_agents):
-        for a in other_agents:
-            self.agent_sentiments[a.name] = await gen(
-                f"""{self.description_prompt(is_in_deliberation=False)}
-
-{self.mood_prompt()}
-
-Describe your opinion of your fellow jury member, {a.description}.
-
-Only base your opinion on their superficial appearence and mannerisms. Respond in only one or two words."""
-            )
+        with prioritized(SETUP):
+            self.mood = await gen(prompt)
+        await update_image(self)
+
+    async def set_preconceptions_about_fellow_jury_members(self, other_agents, refresh=False):
+        """Asks for the opinions about all fellow jurors in one call. They
+        only depend on who is on the jury, so they are reused by every case
+        with the same cast, unless `refresh` is set."""
+        cast = tuple(sorted((a.name, a.description) for a in [self, *other_agents]))
+        missing = [
+            a for a in other_agents
+            if refresh or (cast, self.name, a.name) not in preconceptions
+        ]
+        metrics.incr("preconceptions.hits", len(other_agents) - len(missing))
+        opinions = {}
+        if missing:
+            schema = preconceptions_schema(tuple(a.name_key() for a in missing))
+            jurors = "\n".join(f"* {a.name}: {a.description}" for a in missing)
+            prompt = f"""{self.description_prompt(is_in_deliberation=False)}
+
+Your fellow jury members are:
+{jurors}
+
+Describe your opinion of each of your fellow jury members. Only base your opinions on their superficial appearence and mannerisms. Respond in only one or two words per jury member, in the following format:
+
+{schema.format_prompt()}"""
+            with prioritized(SETUP):
+                parsed = await gen_formatted_response(
+                    prompt,
+                    schema,
+                    max_length=30 * len(missing),
+                    cache="refresh" if refresh else True,
+                )
+            for a in missing:
+                if parsed is None:
+                    opinions[a.name] = "No opinion yet"
+                else:
+                    opinions[a.name] = preconceptions[(cast, self.name, a.name)] = parsed[
+                        "OPINION_ABOUT_" + a.name_key()
+                    ]
+            if parsed is None:
+                sys.stderr.write("Failed to parse preconceptions, keeping an open mind\n")
+                sys.stderr.flush()
+
+        self.agent_sentiments = {
+            **self.agent_sentiments,
+            **{
+                a.name: opinions[a.name]
+                if a.name in opinions
+                else preconceptions[(cast, self.name, a.name)]
+                for a in other_agents
+            },
+        }
 
     async def hear(
-        self, utterance, is_in_deliberation, speaker: Optional["Agent"] = None
+        self,
+        utterance,
+        is_in_deliberation,
+        speaker: Optional["Agent"] = None,
+        summarize=True,
     ):
-        prompt = f"""{self.description_prompt(is_in_deliberation=is_in_deliberation)}
-
-{self.mood_prompt()}
-
-"""
-        beliefs_key = self.name_key() + "_BELIEFS"
+        schema = self.hearing_schema(speaker, summarize)
+        values = self.prompt_values(is_in_deliberation)
         if speaker is None:
-            response_fields = [
-                ("FACTUAL_SUMMARY", str),
-                ("MOOD", str),
-                (beliefs_key, str),
-                ("GUILTY_PERCENTAGE", fuzzy_percent),
-                ("INNOCENT_PERCENTAGE", fuzzy_percent),
-            ]
-
-            prompt += f"""{self.beliefs_prompt()}
-
-The court says:
-{utterance}
-
-You are {self.description}, in your own distinctive tone of voice, describe your updated summary of what the court has said so far (factual bullet points only), mood (one word), beliefs (several bullet points in the voice of {self.name}), and certainty of guilt and innocence (percentages) in the following format::
-"""
+            summary_request = ""
+            if summarize:
+                summary_request = "updated summary of what the court has said so far (factual bullet points only), "
+            prompt = templates.get("hear_court").render(
+                **values,
+                utterance=utterance,
+                summary_request=summary_request,
+                format=schema.format_prompt(),
+            )
         else:
-            prompt += f"""{self.agent_sentiments_prompt()}
-
-{self.beliefs_prompt()}
+            prompt = templates.get("hear_speaker").render(
+                **values,
+                utterance=utterance,
+                speaker=speaker.name,
+                format=schema.format_prompt(),
+            )
 
-{speaker.name} says: {utterance}
+        with prioritized(SENTIMENT):
+            parsed = await gen_formatted_response(prompt, schema)
+        await self.update_from_hearing(parsed, speaker)
 
-You are {self.description}, given your previous beliefs and what {speaker.name} said, in your own distinctive voice, describe your updated mood (one word), new beliefs (several bullet points in the voice of {self.name}), updated certainty of guilt and innocence (percentages), and updated opinion about the speaker {speaker.name}'s views in relation to your own beliefs (concise) in the following format (do not output anything else):
-"""
-            opinion_key = "OPINION_ABOUT_" + speaker.name_key()
-            response_fields = [
-                ("MOOD", str),
-                (beliefs_key, str),
-                ("GUILTY_PERCENTAGE", fuzzy_percent),
-                ("INNOCENT_PERCENTAGE", fuzzy_percent),
-                (opinion_key, str),
-            ]
+    def hearing_schema(self, speaker, summarize=True):
+        return hearing_schema(
+            self.name_key(), speaker.name_key() if speaker else None, summarize
+        )
 
-        prompt += response_format_prompt(response_fields)
-        parsed = await gen_formatted_response(prompt, response_fields)
+    async def update_from_hearing(self, parsed, speaker):
         old_mood = self.mood
         if parsed:
             self.mood = parsed["MOOD"]
-            self.beliefs = parsed[beliefs_key]
+            self.beliefs = await compress(
+                "beliefs",
+                parsed[self.name_key() + "_BELIEFS"],
+                f"beliefs of {self.name} about a court case, in the voice of {self.name}",
+            )
             self.guilty_percent = parsed["GUILTY_PERCENTAGE"]
             self.innocent_percent = parsed["INNOCENT_PERCENTAGE"]
-            if speaker is None:
-                self.summary = parsed["FACTUAL_SUMMARY"]
-            else:
-                self.agent_sentiments[speaker.name] = parsed[opinion_key]
+            if "FACTUAL_SUMMARY" in parsed:
+                self.summary = await compress(
+                    "summary", parsed["FACTUAL_SUMMARY"], "summary of a court case"
+                )
+            if speaker is not None:
+                opinion_key = "OPINION_ABOUT_" + speaker.name_key()
+                self.set_agent_sentiment(speaker.name, parsed[opinion_key])
                 self.latest_sentiment = parsed[opinion_key]
         else:
             sys.stderr.write(
@@ -157,27 +243,28 @@ You are {self.description}, given your previous beliefs and what {speaker.name}
             sys.stderr.flush()
 
         if old_mood != self.mood:
-            self.image_uri = await make_image(self)
+            await update_image(self)
 
     async def decide_to_speak(
         self, is_in_deliberation, previous_utterance, previous_speaker
     ):
-        response_fields = [("SPEAK_EAGERNESS", fuzzy_percent)]
-        prompt = f"""{self.description_prompt(is_in_deliberation)}
-
-{self.mood_prompt()}
-
-{self.beliefs_prompt()}
-
-{self.agent_sentiments_prompt()}
-
-{self.previous_utterance_prompt(previous_utterance, previous_speaker)}
-
-How eager are you to speak? Reply as a percentage in the following format:
-
-{response_format_prompt(response_fields)}
-"""
-        parsed = await gen_formatted_response(prompt, response_fields, max_length=30)
+        prompt = templates.get("decide_to_speak").render(
+            max_length=30,
+            **self.prompt_values(is_in_deliberation),
+            previous_utterance=self.previous_utterance_prompt(previous_utterance, previous_speaker),
+            format=EAGERNESS_SCHEMA.format_prompt(),
+        )
+        if not client.llama_limiter.breaker.closed:
+            # Leave llama to the utterances until it has recovered
+            metrics.incr("degraded.coin_flip_eagerness")
+            self.speak_eagerness = random.choice(range(100))
+            return
+
+        # Eagerness is sampled, a cached answer would always pick the same speaker
+        with prioritized(SPEAKER_SELECTION):
+            parsed = await gen_formatted_response(
+                prompt, EAGERNESS_SCHEMA, max_length=30, cache=False
+            )
         if parsed is None:
             sys.stderr.write("Failed to parse speaking intent, tossing a coin\n")
             sys.stderr.flush()
@@ -186,24 +273,28 @@ How eager are you to speak? Reply as a percentage in the following format:
             speak_eagerness = parsed["SPEAK_EAGERNESS"]
         self.speak_eagerness = speak_eagerness
 
-    async def say(self, is_in_deliberation, previous_utterance, previous_speaker):
-        prompt = f"""{self.description_prompt(is_in_deliberation)}
-
-{self.mood_prompt()}
-
-{self.agent_sentiments_prompt()}
-
-{self.beliefs_prompt()}
-
-{self.previous_utterance_prompt(previous_utterance, previous_speaker)}
-
-"""
+    async def say(
+        self, is_in_deliberation, previous_utterance, previous_speaker, on_partial=None
+    ):
+        values = self.prompt_values(is_in_deliberation)
+        values["previous_utterance"] = self.previous_utterance_prompt(
+            previous_utterance, previous_speaker
+        )
         if previous_speaker:
-            prompt += f"You are {self.name}. In your distinctive voice argue your evidence-based opinion in reply to {previous_speaker.name} in a single short sentence."
+            prompt = templates.get("say_reply").render(**values, speaker=previous_speaker.name)
         else:
-            prompt += f"You are {self.name}. Try to convince the jury about your opinions in your distinctive voice. Be brief (one or two sentences). Argue for your beliefs mentioning specific evidence."
+            prompt = templates.get("say_opening").render(**values)
 
-        utterance = await gen(prompt)
+        def on_text(text):
+            on_partial(text.strip('"'))
+
+        with prioritized(VISIBLE):
+            utterance = await gen(
+                prompt,
+                cache=False,
+                on_partial=on_text if on_partial else None,
+                hedge=True,
+            )
         utterance = utterance.strip('"')
         return utterance
 
@@ -223,3 +314,112 @@ How eager are you to speak? Reply as a percentage in the following format:
 
     def name_key(self):
         return re.sub(r"[^A-Z_]", "", self.name.upper().replace(" ", "_"))
+
+
+async def hear_all(
+    agents,
+    utterance,
+    is_in_deliberation,
+    speaker: Optional[Agent] = None,
+    summarize=True,
+):
+    """Let all agents hear the utterance in a single model call. Agents whose
+    part of the response can't be parsed fall back on hearing individually."""
+
+    agent_schemas = {
+        agent.name: prefixed(agent.hearing_schema(speaker, summarize), agent.name_key())
+        for agent in agents
+    }
+    schema = combine(*agent_schemas.values())
+    max_length = 350 * len(agents)
+
+    prompt = Prompt("hear_all", max_length=max_length)
+    intro = "The following people are members of a jury in a court case. "
+    if is_in_deliberation:
+        intro += "The jury is now in deliberation and no further evidence will be presented. They must now examine the evidence and argue their opinions and work towards a conclusive verdict."
+    else:
+        intro += "Evidence is being presented and they are forming opinions."
+    prompt.add("description", intro)
+
+    for agent in agents:
+        prompt.add("name", f"# {agent.name}")
+        prompt.add(
+            "mood",
+            f"{agent.name} is {agent.description}. Their current mood is: {agent.mood}",
+        )
+        prompt.add(
+            "summary",
+            agent.summary,
+            header=f"{agent.name}'s summary of the evidence for and against the defendant:\n",
+            trimmable=True,
+        )
+        prompt.add(
+            "beliefs",
+            agent.beliefs,
+            header=f"{agent.name}'s current opinions and beliefs about the case:\n",
+            trimmable=True,
+        )
+        certainty = f"{agent.name} is currently {agent.guilty_percent}% sure that the defendant is guilty and {agent.innocent_percent}% sure that the defendant is innocent."
+        if speaker is None:
+            prompt.add("certainty", certainty + "\n")
+        else:
+            prompt.add("certainty", certainty)
+            sentiments = f"{agent.name}'s current opinions about their fellow jury members are:\n"
+            for name, sentiment in agent.agent_sentiments.items():
+                sentiments += f"* {name}: {sentiment}\n"
+            prompt.add("sentiments", sentiments)
+
+    if speaker is None:
+        prompt.add("utterance", utterance, header="The court says:\n")
+        prompt.add(
+            "instructions",
+            f"""For each juror, in their own distinctive tone of voice, describe their {"updated summary of what the court has said so far (factual bullet points only), " if summarize else ""}mood (one word), beliefs (several bullet points in their voice), and certainty of guilt and innocence (percentages) in the following format:
+{schema.format_prompt()}""",
+        )
+    else:
+        prompt.add("utterance", utterance, header=f"{speaker.name} says: ")
+        prompt.add(
+            "instructions",
+            f"""For each juror, given their previous beliefs and what {speaker.name} said, in their own distinctive voice, describe their updated mood (one word), new beliefs (several bullet points in their voice), updated certainty of guilt and innocence (percentages), and updated opinion about the speaker {speaker.name}'s views in relation to their own beliefs (concise) in the following format (do not output anything else):
+{schema.format_prompt()}""",
+        )
+
+    with prioritized(SENTIMENT):
+        output = await gen(prompt.render(), max_length=max_length, schema=schema)
+
+    # Parsed as a whole, so that every juror's part ends at the next juror's
+    values, errors = schema.parse_fields(output)
+    async with asyncio.TaskGroup() as tg:
+        for agent in agents:
+            if any(name in errors for name in agent_schemas[agent.name].names):
+                metrics.incr("hear_all.fallbacks")
+                tg.create_task(
+                    agent.hear(utterance, is_in_deliberation, speaker, summarize)
+                )
+                continue
+
+            # Strip the agent prefix again, but keep NAME_BELIEFS as is
+            unprefixed = {}
+            for field, prefixed_field in zip(
+                agent.hearing_schema(speaker, summarize).fields,
+                agent_schemas[agent.name].fields,
+            ):
+                unprefixed[field.name] = values[prefixed_field.name]
+            tg.create_task(agent.update_from_hearing(unprefixed, speaker))
+
+
+async def update_case_summary(summary, evidence):
+    """Update the factual record of the case that is shared by all jurors"""
+
+    prompt = f"""You are the clerk of a court, keeping a factual record of a court case.
+
+The record so far:
+{summary or "Nothing has been said yet."}
+
+The court says:
+{evidence}
+
+Update the record with what the court has just said. Keep everything that is still relevant, use factual bullet points only and don't give any opinions. Only output the updated record."""
+    with prioritized(SENTIMENT):
+        summary = await gen(prompt)
+    return await compress("summary", summary, "summary of a court case")
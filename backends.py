@@ -0,0 +1,349 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import hashlib
+import json
+import math
+import os
+import random
+import re
+
+import openai
+
+import client
+import metrics
+
+
+class Backend:
+    model = None
+    # Whether the model can be trusted to answer with a JSON object when
+    # asked for one, instead of labelled fields
+    json_mode = False
+
+    async def generate(self, prompt, **params) -> str:
+        raise NotImplementedError()
+
+    async def stream(self, prompt, **params):
+        """Yields the output in chunks as it's being generated. Backends
+        that can't stream yield it all at once."""
+        yield await self.generate(prompt, **params)
+
+
+class ReplicateLlama(Backend):
+    model = "a16z-infra/llama-2-13b-chat:2a7f981751ec7fdf87b5b91ad4db53683a98082e9ff7bfd12c8cd5ea85980a52"
+    # model = "replicate/llama-2-70b-chat:58d078176e02c219e11eb4da5a02a7830a283b14cf8f94537af893ccff5ee781"
+
+    async def generate(self, prompt, max_length=500, temperature=1.1, **params):
+        output = await client.replicate_run(
+            self.model,
+            input={"prompt": prompt, "system_prompt": "", "temperature": temperature, "max_new_tokens": max_length},
+            limiter=client.llama_limiter,
+            tokens=client.count_tokens(prompt) + max_length,
+        )
+        return "".join(output)
+
+    async def stream(self, prompt, max_length=500, temperature=1.1, **params):
+        async for chunk in client.replicate_stream(
+            self.model,
+            input={"prompt": prompt, "system_prompt": "", "temperature": temperature, "max_new_tokens": max_length},
+            limiter=client.llama_limiter,
+            tokens=client.count_tokens(prompt) + max_length,
+        ):
+            yield chunk
+
+
+class OpenAIChat(Backend):
+    model = "gpt-4"
+
+    async def generate(self, prompt, temperature=0.7, **params):
+        openai.api_key = os.environ["OPENAI_API_KEY"]
+        async with client.openai_limiter.slot():
+            response = await openai.ChatCompletion.acreate(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    },
+                ],
+                n=1,
+                stop=None,
+                temperature=temperature,
+                stream=False,
+            )
+        return response["choices"][0]["message"]["content"]
+
+
+class ReplicateSDXL(Backend):
+    model = "stability-ai/sdxl:a00d0b7dcbb9c3fbb34ba87d2d5b46c56969c84a628bf778a7fdaec30b1b99c5"
+
+    async def generate(self, prompt, negative_prompt="collage", width=512, height=1024, **params):
+        output = await client.replicate_run(
+            self.model,
+            input={"prompt": prompt, "negative_prompt": negative_prompt, "width": width, "height": height},
+            limiter=client.sdxl_limiter,
+        )
+        return output[0]
+
+
+class PrefixCache:
+    """Measures how many tokens of every prompt a model host could have
+    reused from its prefix (KV) cache, if it keeps the prefixes of the `size`
+    most recent prompts"""
+
+    def __init__(self, name, size=64):
+        self.name = name
+        self.size = size
+        self.recent = collections.deque()
+        # The prompt sharing the longest prefix with a new one is always a
+        # neighbour of the new one in sorted order
+        self.sorted = []
+
+    def add(self, prompt):
+        i = bisect.bisect_left(self.sorted, prompt)
+        reused = max(
+            (common_prefix(prompt, self.sorted[j]) for j in (i - 1, i) if 0 <= j < len(self.sorted)),
+            default=0,
+        )
+        metrics.incr(f"{self.name}.prefix_reused_tokens", client.count_tokens(prompt[:reused]))
+        metrics.incr(f"{self.name}.prefix_prompt_tokens", client.count_tokens(prompt))
+
+        self.sorted.insert(i, prompt)
+        self.recent.append(prompt)
+        if len(self.recent) > self.size:
+            oldest = self.recent.popleft()
+            del self.sorted[bisect.bisect_left(self.sorted, oldest)]
+
+
+def common_prefix(a, b):
+    """Length of the common prefix, comparing slices instead of characters"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class FakeBackend(Backend):
+    """Local stand-in for a model. Latencies are log-normally distributed
+    around `latency` seconds (the median), `failure_rate` of calls raise
+    ModelError and `malformed_rate` of formatted responses miss a field.
+    `rambling_rate` of formatted responses go on after the last field, like
+    llama likes to do. Calls wait for the same limiter as the real model.
+
+    With more than `capacity` calls running at once, calls get slower and
+    some are rate limited, like Replicate under load."""
+
+    limiter = None
+
+    def __init__(self, latency=1.0, latency_sigma=0.5, failure_rate=0.0, malformed_rate=0.0, rambling_rate=0.0, capacity=None, seed=None):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.malformed_rate = malformed_rate
+        self.rambling_rate = rambling_rate
+        self.capacity = capacity
+        self.running = 0
+        self.rng = random.Random(seed)
+        self.prefix_cache = PrefixCache(self.model)
+
+    async def generate(self, prompt, **params):
+        tokens = client.count_tokens(prompt) + params.get("max_length", 0)
+        async with self.limiter.slot(tokens), self.running_call() as latency:
+            self.prefix_cache.add(prompt)
+            await asyncio.sleep(latency)
+            return self.respond(prompt, **params)
+
+    async def stream(self, prompt, **params):
+        # The first word arrives after a tenth of the latency, the rest are
+        # spread over the remaining time
+        tokens = client.count_tokens(prompt) + params.get("max_length", 0)
+        async with self.limiter.slot(tokens), self.running_call() as latency:
+            self.prefix_cache.add(prompt)
+            words = re.findall(r"\S+\s*", self.respond(prompt, **params))
+            await asyncio.sleep(latency * 0.1)
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(latency * 0.9 / len(words))
+                yield word
+
+    @contextlib.asynccontextmanager
+    async def running_call(self):
+        """Yields the latency of the call, or fails it"""
+        self.running += 1
+        try:
+            latency = self.sample_latency()
+            overload = self.running / self.capacity if self.capacity else 1
+            if overload > 1:
+                latency *= overload
+                if self.rng.random() > 1 / overload:
+                    await asyncio.sleep(self.latency * 0.1)
+                    raise client.ModelError("Fake rate limit")
+            if self.rng.random() < self.failure_rate:
+                await asyncio.sleep(latency)
+                raise client.ModelError("Fake failure")
+            yield latency
+        finally:
+            self.running -= 1
+
+    def sample_latency(self):
+        return self.latency * math.exp(self.rng.gauss(0, self.latency_sigma))
+
+    def respond(self, prompt, **params):
+        raise NotImplementedError()
+
+
+FAKE_MOODS = ["Grumpy", "Curious", "Skeptical", "Amused", "Bored", "Suspicious", "Determined", "Tired"]
+FAKE_OPINIONS = ["Seems trustworthy", "Talks too much", "Sharp mind", "Not to be trusted", "Agrees with me", "Misguided"]
+FAKE_UTTERANCES = [
+    "The evidence clearly shows the defendant was elsewhere that night.",
+    "I cannot ignore the fingerprints on the stolen goods.",
+    "Nobody has explained the missing receipt, and that troubles me.",
+    "The witness contradicted herself twice, I will not convict on that.",
+]
+FAKE_BELIEFS = """* The defendant had a motive
+* The alibi is shaky
+* The key witness seemed unreliable"""
+FAKE_RAMBLING = """Note: I have tried to stay in character while giving my honest assessment of the evidence. The percentages are my best estimate and may change as the deliberation continues. Please let me know if you would like me to elaborate on any of my beliefs, or if there is anything else I can help you with."""
+FAKE_SUMMARY = """* The prosecution claims the defendant stole the item
+* The defense claims the defendant was elsewhere"""
+
+# Skewed towards extremes so that fake juries actually reach a verdict
+FAKE_PERCENTAGES = [5, 10, 15, 20, 40, 60, 80, 85, 90, 95]
+
+RESPONSE_FIELD_PATTERN = re.compile(r"^([A-Z][A-Z_]+):$", re.MULTILINE)
+JSON_FIELD_PATTERN = re.compile(r'"([A-Z][A-Z_]+)": \.\.\.')
+
+
+def requested_fields(prompt):
+    """The labels (or JSON keys) that the prompt ends by asking for, and
+    whether they were asked for as JSON"""
+    fields = []
+    for line in reversed(prompt.rstrip().splitlines()):
+        if not fields and (keys := JSON_FIELD_PATTERN.findall(line)):
+            return keys, True
+        if match := RESPONSE_FIELD_PATTERN.match(line):
+            fields.insert(0, match.group(1))
+        elif line.strip():
+            break
+    return fields, False
+
+
+def bullets(text):
+    return [line for line in text.split("\n") if line.startswith("* ")]
+
+
+class FakeText(FakeBackend):
+    model = "fake-llama"
+    limiter = client.llama_limiter
+
+    def __init__(self, *args, json_mode=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.json_mode = json_mode
+
+    def respond(self, prompt, **params):
+        fields, is_json = requested_fields(prompt)
+        if not fields:
+            if "one or two words" in prompt:
+                return self.rng.choice(FAKE_MOODS)
+            if "Only output the bullet points." in prompt:
+                # Compressing, keep the latest points
+                return "\n".join(bullets(prompt.split("Only output the bullet points.")[1])[-3:])
+            if "The record so far:" in prompt:
+                return self.grow(prompt, "The record so far:\n", FAKE_SUMMARY)
+            return self.rng.choice(FAKE_UTTERANCES)
+
+        if self.rng.random() < self.malformed_rate:
+            fields = fields[:-1]
+
+        # Keep guilty and innocent percentages consistent per juror, even
+        # when several jurors answer in the same response
+        guilty = {}
+        values = {field: self.field_value(field, guilty, prompt) for field in fields}
+        if is_json:
+            lines = [json.dumps(values, indent=2)]
+        else:
+            lines = [f"{field}: {value}" for field, value in values.items()]
+        if self.rng.random() < self.rambling_rate:
+            lines.append(FAKE_RAMBLING)
+        return "\n\n".join(lines)
+
+    def field_value(self, field, guilty, prompt):
+        if field.endswith("GUILTY_PERCENTAGE"):
+            prefix = field.removesuffix("GUILTY_PERCENTAGE")
+            guilty[prefix] = self.rng.choice(FAKE_PERCENTAGES)
+            return f"{guilty[prefix]}%"
+        if field.endswith("INNOCENT_PERCENTAGE"):
+            prefix = field.removesuffix("INNOCENT_PERCENTAGE")
+            return f"{100 - guilty.get(prefix, 50)}%"
+        if field.endswith("PERCENTAGE") or field.endswith("EAGERNESS"):
+            return f"{self.rng.randint(0, 100)}%"
+        if field.endswith("MOOD"):
+            return self.rng.choice(FAKE_MOODS)
+        if field.endswith("BELIEFS"):
+            return self.grow(prompt, "Your current opinions and beliefs about the case are:\n", FAKE_BELIEFS)
+        if field.endswith("SUMMARY"):
+            return self.grow(prompt, "This is the evidence for and against the defendant:\n", FAKE_SUMMARY)
+        if "OPINION_ABOUT_" in field:
+            return self.rng.choice(FAKE_OPINIONS)
+        return "Nothing to add."
+
+    def grow(self, prompt, header, initial):
+        """Like llama, keeps everything from the previous version of a list
+        in the prompt and adds a point"""
+        if header not in prompt:
+            return initial
+        previous = bullets(prompt.split(header)[1].split("\n\n")[0])
+        if not previous:
+            return initial
+        return "\n".join(previous + ["* " + self.rng.choice(FAKE_UTTERANCES)])
+
+
+class FakeChat(FakeBackend):
+    model = "fake-gpt"
+    limiter = client.openai_limiter
+
+    def respond(self, prompt, **params):
+        with open("transcript.txt") as f:
+            return f.read()
+
+
+class FakeImage(FakeBackend):
+    model = "fake-sdxl"
+    limiter = client.sdxl_limiter
+
+    def respond(self, prompt, **params):
+        digest = hashlib.sha1(prompt.encode()).hexdigest()[:16]
+        return f"https://fake.invalid/{digest}.png"
+
+
+text = ReplicateLlama()
+chat = OpenAIChat()
+image = ReplicateSDXL()
+
+
+def use(text_backend=None, chat_backend=None, image_backend=None):
+    global text, chat, image
+    if text_backend is not None:
+        text = text_backend
+    if chat_backend is not None:
+        chat = chat_backend
+    if image_backend is not None:
+        image = image_backend
+
+
+def wrap(wrapper):
+    use(wrapper(text), wrapper(chat), wrapper(image))
+
+
+def use_fake(latency=1.0, failure_rate=0.0, malformed_rate=0.0, rambling_rate=0.0, json_mode=False, capacity=None, seed=None):
+    # Image generation is much slower than text generation on Replicate
+    use(
+        FakeText(latency=latency, failure_rate=failure_rate, malformed_rate=malformed_rate, rambling_rate=rambling_rate, json_mode=json_mode, capacity=capacity, seed=seed),
+        FakeChat(latency=latency * 10, seed=seed),
+        FakeImage(latency=latency * 5, failure_rate=failure_rate, capacity=capacity and max(1, capacity // 8), seed=seed),
+    )
@@ -0,0 +1,376 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import subprocess
+import time
+from collections import defaultdict
+
+import backends
+import client
+import context
+import llama
+import metrics
+import portraits
+import templates
+import db
+from db import StateLog
+import llama_jury
+from llama_jury import step, background_images
+from state import State
+
+COUNTERS = {
+    "llm_calls": "llama.calls",
+    "prompt_tokens": "llama.prompt_tokens",
+    "output_tokens": "llama.output_tokens",
+    "format_retries": "llama.format_retries",
+    "partial_retries": "llama.partial_retries",
+    "errors": "llama.failures",
+    "image_calls": "sdxl.calls",
+}
+
+
+# See context.Prompt
+PROMPT_KINDS = ["hear", "hear_all", "decide_to_speak", "say"]
+
+
+class MemorySession:
+    """Keeps all writes in memory so benchmarks never touch the database"""
+
+    def __init__(self, room):
+        self.room = room
+        self.rows = []
+        self.num_cases = 0
+        self.num_drafts = 0
+        self.state_log = StateLog()
+
+    def create_case(self, room):
+        self.num_cases += 1
+        return f"benchmark-{self.num_cases}"
+
+    def save_state(self, state):
+        record = self.state_log.record(state)
+        if record is not None:
+            self.rows.append(json.dumps(record[1]))
+
+    def save_draft(self, case_id, speaker, text, done=False):
+        self.num_drafts += 1
+
+    def save_transcript(self, case_id, transcript):
+        pass
+
+    async def load_latest(self, room):
+        return None, None, None, None, None
+
+
+async def run_case(room, label=None):
+    # Rooms running side by side share the limiters under different names
+    client.current_room.set(label or room)
+    db = MemorySession(room)
+    state = State(
+        db=db,
+        room=room,
+        case_id=None,
+        evidence=None,
+        agents=None,
+        verdict=None,
+        transcript=None,
+    )
+
+    steps = defaultdict(lambda: defaultdict(float))
+    start = time.monotonic()
+    time_to_verdict = None
+    async with background_images(state, wait=True):
+        while (current := state.current_step()) != State.COMPLETE:
+            counters_before = metrics.snapshot()["counters"]
+            step_start = time.monotonic()
+            await step(state)
+            counters_after = metrics.snapshot()["counters"]
+
+            result = steps[current]
+            result["count"] += 1
+            result["seconds"] += time.monotonic() - step_start
+            for name, counter in COUNTERS.items():
+                result[name] += counters_after.get(counter, 0) - counters_before.get(counter, 0)
+            if current == State.AWAITING_VERDICT:
+                time_to_verdict = time.monotonic() - start
+
+    deliberation_seconds = sum(
+        steps[s]["seconds"]
+        for s in [State.AWAITING_UTTERANCE, State.AWAITING_SENTIMENT]
+        if s in steps
+    )
+    return {
+        "total_seconds": time.monotonic() - start,
+        "time_to_verdict": time_to_verdict,
+        "deliberation_turns": state.num_deliberation_steps,
+        "turns_per_minute": state.num_deliberation_steps / deliberation_seconds * 60
+        if deliberation_seconds
+        else None,
+        "state_writes": len(db.rows),
+        "state_write_bytes": sum(len(row) for row in db.rows),
+        "draft_writes": db.num_drafts,
+        "steps": {name: dict(result) for name, result in steps.items()},
+    }
+
+
+def summarize(runs):
+    summary = defaultdict(lambda: defaultdict(float))
+    for run in runs:
+        for name, result in run["steps"].items():
+            for key, value in result.items():
+                summary[name][key] += value / len(runs)
+    return {
+        "total_seconds": sum(r["total_seconds"] for r in runs) / len(runs),
+        "time_to_verdict": sum(r["time_to_verdict"] for r in runs) / len(runs),
+        "turns_per_minute": sum(r["turns_per_minute"] or 0 for r in runs) / len(runs),
+        "visible_wait_p95": sum(r["visible_wait_p95"] or 0 for r in runs) / len(runs),
+        "utterance_p99": sum(r["utterance_p99"] or 0 for r in runs) / len(runs),
+        "hedge_rate": sum(r["hedge_rate"] for r in runs) / len(runs),
+        "hedge_win_rate": sum(r["hedge_win_rate"] for r in runs) / len(runs),
+        "prefix_reuse": sum(r["prefix_reuse"] for r in runs) / len(runs),
+        "steps": {name: dict(result) for name, result in summary.items()},
+        "prompt_sizes": {
+            kind: {
+                stat: sum(r["prompt_sizes"][kind][stat] for r in runs) / len(runs)
+                for stat in ["p50", "p95", "max"]
+            }
+            for kind in PROMPT_KINDS
+            if all(kind in r["prompt_sizes"] for r in runs)
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def print_summary(summary, baseline=None):
+    def delta(value, old):
+        if old is None or not old:
+            return ""
+        return f" ({(value - old) / old * 100:+.1f}%)"
+
+    base_steps = baseline["steps"] if baseline else {}
+    print(f"{'step':<22}{'count':>8}{'seconds':>10}{'calls':>8}{'in tokens':>11}{'out tokens':>11}{'retries':>9}{'partial':>9}{'errors':>8}")
+    for name, result in summary["steps"].items():
+        old = base_steps.get(name, {})
+        print(
+            f"{name:<22}{result['count']:>8.1f}{result['seconds']:>10.2f}{result['llm_calls']:>8.1f}{result['prompt_tokens']:>11.0f}{result['output_tokens']:>11.0f}{result['format_retries']:>9.1f}{result['partial_retries']:>9.1f}{result['errors']:>8.1f}"
+            + delta(result["seconds"], old.get("seconds"))
+        )
+    for key, unit in [
+        ("turns_per_minute", ""),
+        ("visible_wait_p95", "s"),
+        ("utterance_p99", "s"),
+        ("hedge_rate", ""),
+        ("hedge_win_rate", ""),
+        ("prefix_reuse", ""),
+        ("time_to_verdict", "s"),
+        ("total_seconds", "s"),
+    ]:
+        old = baseline.get(key) if baseline else None
+        print(f"{key}: {summary[key]:.2f}{unit}" + delta(summary[key], old))
+
+    base_sizes = baseline.get("prompt_sizes", {}) if baseline else {}
+    print(f"{'prompt tokens':<22}{'p50':>8}{'p95':>8}{'max':>8}")
+    for kind, sizes in summary["prompt_sizes"].items():
+        old = base_sizes.get(kind, {})
+        print(
+            f"{kind:<22}{sizes['p50']:>8.0f}{sizes['p95']:>8.0f}{sizes['max']:>8.0f}"
+            + delta(sizes["p95"], old.get("p95"))
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Run complete cases against fake models and time every state"
+    )
+    parser.add_argument("--room", default="dev-A")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument(
+        "--rooms", type=int, default=1, help="Number of cases to run side by side"
+    )
+    parser.add_argument(
+        "--llama-concurrency",
+        type=int,
+        default=client.LLAMA_CONCURRENCY,
+        help="Concurrency limit of the fake llama",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="Median latency of fake llama calls in seconds",
+    )
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.05)
+    parser.add_argument("--rambling-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--capacity",
+        type=int,
+        help="Calls the fake llama can run at once before it slows down and rate limits",
+    )
+    parser.add_argument(
+        "--output", default="bench_output.json", help="Where to write the results"
+    )
+    parser.add_argument(
+        "--compare", metavar="PATH", help="Previous results to compare against"
+    )
+    parser.add_argument(
+        "--batched-hearing", action="store_true", help="Set BATCHED_HEARING"
+    )
+    parser.add_argument(
+        "--speculative-speakers",
+        type=int,
+        default=0,
+        help="Set SPECULATIVE_SPEAKERS",
+    )
+    parser.add_argument(
+        "--pipelined-deliberation",
+        action="store_true",
+        help="Set PIPELINED_DELIBERATION",
+    )
+    parser.add_argument(
+        "--inline-images",
+        action="store_true",
+        help="Set BACKGROUND_IMAGES to False",
+    )
+    parser.add_argument(
+        "--portrait-library", metavar="PATH", help="Use a portrait library"
+    )
+    parser.add_argument(
+        "--shared-case-summary", action="store_true", help="Set SHARED_CASE_SUMMARY"
+    )
+    parser.add_argument(
+        "--streamed-utterances", action="store_true", help="Set STREAMED_UTTERANCES"
+    )
+    parser.add_argument(
+        "--no-early-stop", action="store_true", help="Set llama.EARLY_STOP to False"
+    )
+    parser.add_argument(
+        "--no-partial-retry",
+        action="store_true",
+        help="Set llama.PARTIAL_RETRY to False",
+    )
+    parser.add_argument(
+        "--no-adaptive-concurrency",
+        action="store_true",
+        help="Set client.ADAPTIVE_CONCURRENCY to False",
+    )
+    parser.add_argument(
+        "--hedging", action="store_true", help="Set llama.HEDGING to True"
+    )
+    parser.add_argument(
+        "--no-rolling-compression",
+        action="store_true",
+        help="Set context.ROLLING_COMPRESSION to False",
+    )
+    parser.add_argument(
+        "--prompt-budget",
+        type=int,
+        default=context.PROMPT_BUDGET,
+        help="Set context.PROMPT_BUDGET",
+    )
+    parser.add_argument(
+        "--original-prompt-order",
+        action="store_true",
+        help="Set templates.PREFIX_STABLE to False",
+    )
+    parser.add_argument(
+        "--state-events", action="store_true", help="Set db.STATE_EVENTS"
+    )
+    parser.add_argument(
+        "--refresh-preconceptions",
+        action="store_true",
+        help="Set llama_jury.REFRESH_PRECONCEPTIONS",
+    )
+    args = parser.parse_args()
+    templates.PREFIX_STABLE = not args.original_prompt_order
+    llama_jury.REFRESH_PRECONCEPTIONS = args.refresh_preconceptions
+    db.STATE_EVENTS = args.state_events
+    context.ROLLING_COMPRESSION = not args.no_rolling_compression
+    context.PROMPT_BUDGET = args.prompt_budget
+    llama.HEDGING = args.hedging
+    client.ADAPTIVE_CONCURRENCY = not args.no_adaptive_concurrency
+    llama.EARLY_STOP = not args.no_early_stop
+    llama.PARTIAL_RETRY = not args.no_partial_retry
+    llama_jury.STREAMED_UTTERANCES = args.streamed_utterances
+    client.llama_limiter.concurrency = client.llama_limiter.limit = args.llama_concurrency
+    llama_jury.SHARED_CASE_SUMMARY = args.shared_case_summary
+    if args.portrait_library:
+        portraits.use_library(args.portrait_library)
+    llama_jury.BACKGROUND_IMAGES = not args.inline_images
+    llama_jury.PIPELINED_DELIBERATION = args.pipelined_deliberation
+    llama_jury.BATCHED_HEARING = args.batched_hearing
+    llama_jury.SPECULATIVE_SPEAKERS = args.speculative_speakers
+
+    runs = []
+    for i in range(args.runs):
+        random.seed(args.seed + i)
+        metrics.reset()
+        backends.use_fake(
+            latency=args.latency,
+            failure_rate=args.failure_rate,
+            malformed_rate=args.malformed_rate,
+            rambling_rate=args.rambling_rate,
+            capacity=args.capacity,
+            seed=args.seed + i,
+        )
+        # Silence the court's own printing
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            rooms = await asyncio.gather(
+                *(run_case(args.room, f"{args.room}-{j}") for j in range(args.rooms))
+            )
+        snapshot = metrics.snapshot()
+        for run in rooms:
+            # How long utterances and verdicts waited for a slot
+            run["visible_wait_p95"] = snapshot["summaries"].get(
+                "llama.wait_seconds.visible", {}
+            ).get("p95")
+            utterances = snapshot["summaries"].get("llama.hedged_seconds", {})
+            hedges = snapshot["counters"].get("llama.hedges", 0)
+            run["utterance_p99"] = utterances.get("p99")
+            run["hedge_rate"] = hedges / utterances["count"] if utterances else 0
+            run["hedge_win_rate"] = (
+                snapshot["counters"].get("llama.hedge_wins", 0) / hedges if hedges else 0
+            )
+            counters = snapshot["counters"]
+            run["prefix_reuse"] = counters.get("fake-llama.prefix_reused_tokens", 0) / max(
+                1, counters.get("fake-llama.prefix_prompt_tokens", 0)
+            )
+            run["prompt_sizes"] = {
+                kind: snapshot["summaries"][f"prompt.{kind}"]
+                for kind in PROMPT_KINDS
+                if f"prompt.{kind}" in snapshot["summaries"]
+            }
+            run["metrics"] = snapshot
+        runs.extend(rooms)
+
+    results = {
+        "commit": git_commit(),
+        "created_at": time.time(),
+        "config": vars(args),
+        "summary": summarize(runs),
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["summary"]
+    print_summary(results["summary"], baseline)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+import argparse
+import json
+import random
+import time
+
+from backends import FakeText, RESPONSE_FIELD_PATTERN
+from llama import parse_formatted_response, fuzzy_percent
+from structured import Field, Percent, Schema
+
+# Real llama outputs that have caused trouble, see also test_llama.py
+TRICKY_OUTPUTS = [
+    """foo bar
+
+MOOD:
+
+i am happy
+
+BELIEFS:
+
+i believe i can fly
+
+i believe i can touch the sky
+GUILTY PERCENTAGE:
+
+10
+""",
+    """MOOD: Grumpier than usual. I do not enjoy being stuck in this dull, pointless courtroom all day. I miss the thrill of battle and the fresh air of Qo'noS.
+
+BELIEFS: This Human, Jerry Jenkins, looks like a scoundrel. He smells like one too. But... (pauses) ...I am not convinced that the prosecution has presented enough evidence to prove their case beyond a reasonable doubt.
+
+GUILTY_PERCENTAGE: 60% (increased from 50%). My instincts tell me that Jenkins is guilty, but I need more information before I can be certain.""",
+    """**MOOD:** Skeptical
+
+**BELIEFS:** The alibi doesn't hold up.
+
+**GUILTY_PERCENTAGE:** 70%""",
+    """MOOD: Amused
+
+BELIEFS: The witness is lying.
+
+GUILTY_PERCENTAGE: fifty percent""",
+    """MOOD: Calm
+
+BELIEFS: I have no idea.
+
+GUILTY_PERCENTAGE: very""",
+]
+TRICKY_FIELDS = ["MOOD", "BELIEFS", "GUILTY_PERCENTAGE"]
+
+
+def is_percent(name):
+    return name.endswith("PERCENTAGE") or name.endswith("EAGERNESS")
+
+
+def corpus(recordings, num_fake, seed):
+    """(output, field names) pairs from the tricky outputs above, recorded
+    cases and the fake llama"""
+    cases = [(output, TRICKY_FIELDS) for output in TRICKY_OUTPUTS]
+
+    for path in recordings:
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["type"] != "model" or "output" not in entry:
+                    continue
+                fields = RESPONSE_FIELD_PATTERN.findall(entry["prompt"])
+                if fields:
+                    cases.append((entry["output"], fields))
+
+    fake = FakeText(malformed_rate=0.05, rambling_rate=0.3, seed=seed)
+    rng = random.Random(seed)
+    juror_fields = [
+        "MOOD",
+        "YODA_BELIEFS",
+        "GUILTY_PERCENTAGE",
+        "INNOCENT_PERCENTAGE",
+        "OPINION_ABOUT_COUNT_DRACULA",
+    ]
+    for _ in range(num_fake):
+        fields = rng.choice([juror_fields, ["SPEAK_EAGERNESS"]])
+        prompt = "\n\n".join(field + ":" for field in fields)
+        cases.append((fake.respond(prompt), fields))
+    return cases
+
+
+def run(name, parse, cases, repeat):
+    """`parse` returns the number of fields it could parse"""
+    parsed = 0
+    parsed_fields = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for output, fields in cases:
+            n = parse(output, fields)
+            parsed += n == len(fields)
+            parsed_fields += n
+    seconds = time.perf_counter() - start
+    calls = len(cases) * repeat
+    num_fields = sum(len(fields) for _, fields in cases) * repeat
+    print(
+        f"{name:<12}{parsed / calls * 100:>9.1f}%{parsed_fields / num_fields * 100:>9.1f}%{seconds / calls * 1e6:>10.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare parse_formatted_response with structured.Schema"
+    )
+    parser.add_argument(
+        "recordings", nargs="*", help="Recordings made with llama_jury.py --record"
+    )
+    parser.add_argument("--fake", type=int, default=1000, help="Number of fake outputs")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    cases = corpus(args.recordings, args.fake, args.seed)
+
+    # Schemas are declared once per prompt type, like in agent.py
+    schemas = {}
+
+    def parse_structured(output, fields):
+        key = tuple(fields)
+        if key not in schemas:
+            schemas[key] = Schema(
+                Percent(name) if is_percent(name) else Field(name) for name in fields
+            )
+        values, errors = schemas[key].parse_fields(output)
+        return len(values)
+
+    def parse_regex(output, fields):
+        parsed = parse_formatted_response(
+            output, [(name, fuzzy_percent if is_percent(name) else str) for name in fields]
+        )
+        # All or nothing
+        return len(fields) if parsed else 0
+
+    print(f"{len(cases)} outputs")
+    print(f"{'parser':<12}{'parsed':>10}{'fields':>10}{'us/parse':>10}")
+    run("regex", parse_regex, cases, args.repeat)
+    run("structured", parse_structured, cases, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
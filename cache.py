@@ -0,0 +1,156 @@
+import contextlib
+import hashlib
+import json
+import sqlite3
+import time
+
+import backends
+import metrics
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class Cache:
+    """On-disk cache of model outputs, keyed by a hash of the model, the
+    prompt and the sampling parameters. Entries older than `ttl` seconds
+    are ignored, and the least recently used entries are evicted once the
+    cache grows beyond `max_bytes`."""
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)"
+        )
+        self.conn.commit()
+        self.size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key(model, prompt, params):
+        data = json.dumps([model, prompt, params], sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT value FROM cache WHERE key = ? AND created_at > ?",
+            (key, now - self.ttl),
+        ).fetchone()
+        if row is None:
+            metrics.incr("cache.misses")
+            return None
+
+        metrics.incr("cache.hits")
+        self.conn.execute(
+            "UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key)
+        )
+        self.conn.commit()
+        return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        size = len(key) + len(value.encode())
+        old = self.conn.execute(
+            "SELECT size FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if old is not None:
+            self.size -= old[0]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+            (key, value, size, now, now),
+        )
+        self.size += size
+        self.evict(now)
+        self.conn.commit()
+
+    def evict(self, now):
+        expired = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM cache WHERE created_at <= ?",
+            (now - self.ttl,),
+        ).fetchone()
+        if expired[1]:
+            self.conn.execute(
+                "DELETE FROM cache WHERE created_at <= ?", (now - self.ttl,)
+            )
+            self.size -= expired[0]
+            metrics.incr("cache.evictions", expired[1])
+
+        while self.size > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM cache ORDER BY accessed_at LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.size -= size
+                metrics.incr("cache.evictions")
+                if self.size <= self.max_bytes:
+                    break
+
+
+class CachedBackend(backends.Backend):
+    """Wraps a backend. Pass cache=False to bypass the cache for calls that
+    must stay stochastic, or cache="refresh" to regenerate and overwrite."""
+
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.model = backend.model
+        self.json_mode = backend.json_mode
+        self.cache = cache
+
+    async def generate(self, prompt, cache=True, **params):
+        if not cache:
+            return await self.backend.generate(prompt, **params)
+
+        key = self.cache.key(self.model, prompt, params)
+        if cache != "refresh":
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+
+        value = await self.backend.generate(prompt, **params)
+        self.cache.put(key, value)
+        return value
+
+    async def stream(self, prompt, cache=True, **params):
+        """Streams from the backend on a miss, so callers still see partial
+        output and can stop early. What they read until then is cached. A hit
+        comes as a single chunk."""
+        if not cache:
+            async for chunk in self.backend.stream(prompt, **params):
+                yield chunk
+            return
+
+        key = self.cache.key(self.model, prompt, params)
+        if cache != "refresh":
+            value = self.cache.get(key)
+            if value is not None:
+                yield value
+                return
+
+        output = ""
+        try:
+            async with contextlib.aclosing(self.backend.stream(prompt, **params)) as chunks:
+                async for chunk in chunks:
+                    output += chunk
+                    yield chunk
+        except GeneratorExit:
+            # The caller stopped early
+            if output:
+                self.cache.put(key, output)
+            raise
+        self.cache.put(key, output)
@@ -0,0 +1,454 @@
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import os
+import random
+import time
+from collections import defaultdict
+
+import aiohttp
+
+import metrics
+
+REPLICATE_API_URL = os.environ.get(
+    "REPLICATE_API_BASE_URL", "https://api.replicate.com"
+) + "/v1"
+POLL_INTERVAL = float(os.environ.get("REPLICATE_POLL_INTERVAL", "0.5"))
+
+# Every backend gets its own limit, so slow SDXL calls can never take slots
+# away from llama calls (which was the case when everything shared the
+# default thread pool executor)
+LLAMA_CONCURRENCY = int(os.environ.get("LLAMA_CONCURRENCY", "64"))
+SDXL_CONCURRENCY = int(os.environ.get("SDXL_CONCURRENCY", "8"))
+OPENAI_CONCURRENCY = int(os.environ.get("OPENAI_CONCURRENCY", "8"))
+
+# Maximum number of prompt plus output tokens of the llama calls in flight,
+# 0 means no limit
+LLAMA_TOKEN_BUDGET = int(os.environ.get("LLAMA_TOKEN_BUDGET", "0"))
+
+# Priority classes of model calls, most urgent first
+VISIBLE = 0  # Utterances and verdicts, which viewers are waiting for
+SENTIMENT = 1
+SPEAKER_SELECTION = 2
+SETUP = 3  # Preconceptions, transcripts, portraits, etc.
+PRIORITY_NAMES = ["visible", "sentiment", "speaker_selection", "setup"]
+
+# A waiting call moves up one priority class for every this many seconds it
+# has been waiting, so that busy rooms can't starve setup forever
+AGING_SECONDS = 30
+
+# Failed calls are retried after a random delay of up to
+# BACKOFF_BASE * 2**attempt seconds (at most BACKOFF_MAX), so that rooms that
+# failed at the same time don't all retry at the same time
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+# Set to True to halve a limiter's concurrency when calls fail or get much
+# slower than usual, and to raise it by one per round of successful calls
+ADAPTIVE_CONCURRENCY = True
+SLOW_CALL_FACTOR = 3
+
+# After BREAKER_FAILURES failures in a row, calls to a backend fail right away
+# for BREAKER_RESET_SECONDS. Then a single call is let through to see whether
+# it has recovered
+BREAKER_FAILURES = 20
+BREAKER_RESET_SECONDS = 30
+
+priority = contextvars.ContextVar("priority", default=SETUP)
+
+# Set by a Promotable, calls are no more urgent than its level
+promotable = contextvars.ContextVar("promotable", default=None)
+
+# Set per court, calls from different rooms get a fair share of every limiter
+current_room = contextvars.ContextVar("current_room", default=None)
+
+
+@contextlib.contextmanager
+def prioritized(level):
+    token = priority.set(level)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+
+class Promotable:
+    """Calls made within `with promotable:` are no more urgent than `level`
+    until promote() is called, which also moves the calls that are already
+    waiting for a slot up to their own priority. For calls that nobody is
+    waiting for yet, like speculative utterances."""
+
+    def __init__(self, level):
+        self.level = level
+        self.waiting = {}
+        self.tokens = []
+
+    def __enter__(self):
+        self.tokens.append(promotable.set(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        promotable.reset(self.tokens.pop())
+
+    def promote(self):
+        # VISIBLE doesn't hold back any call
+        self.level = VISIBLE
+        limiters = set()
+        for request, (limiter, level) in self.waiting.items():
+            request.priority = level
+            limiters.add(limiter)
+        self.waiting.clear()
+        for limiter in limiters:
+            limiter.dispatch()
+
+
+def count_tokens(text):
+    # Rough estimate, llama's tokenizer averages about four characters per token
+    return (len(text) + 3) // 4
+
+
+# Retries depend on timing, so they don't draw from the global random state
+# that a recorded case is replayed with
+backoff_random = random.Random()
+
+
+def backoff(attempt):
+    return backoff_random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def retry_delay(error, attempt):
+    # No point in retrying before the circuit breaker lets calls through
+    return max(backoff(attempt), getattr(error, "retry_in", 0))
+
+
+class ModelError(Exception):
+    pass
+
+
+class PermanentError(ModelError):
+    """Retrying won't help, e.g. a replayed call that wasn't recorded"""
+
+
+class CircuitOpenError(ModelError):
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name} is unavailable, retry in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, max_failures=BREAKER_FAILURES, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.max_failures = max_failures
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def closed(self):
+        """False until a call succeeds after the breaker opened. Optional
+        work (portraits, eagerness, etc.) should be skipped meanwhile."""
+        return self.state == self.CLOSED
+
+    def check(self):
+        """Raises CircuitOpenError unless a call may go ahead. Returns True
+        if the call is the one that probes whether the backend recovered."""
+        if self.state == self.OPEN:
+            retry_in = self.opened_at + self.reset_seconds - time.monotonic()
+            if retry_in > 0:
+                raise CircuitOpenError(self.name, retry_in)
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                raise CircuitOpenError(self.name, BACKOFF_BASE)
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.probing = False
+        if self.state != self.CLOSED:
+            self.state = self.CLOSED
+            metrics.gauge(f"{self.name}.breaker_open", 0)
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or (
+            self.state == self.CLOSED and self.failures >= self.max_failures
+        ):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            metrics.incr(f"{self.name}.breaker_opened")
+            metrics.gauge(f"{self.name}.breaker_open", 1)
+
+
+class Limiter:
+    """Hands out slots by priority class, then to the room that has used the
+    fewest tokens, then first come first served. At most `concurrency` calls
+    and (unless it's None) `max_tokens` tokens are in flight at once. With
+    ADAPTIVE_CONCURRENCY, `limit` calls are let through, which backs off
+    while the backend fails or slows down."""
+
+    def __init__(self, name, concurrency, max_tokens=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_tokens = max_tokens
+        self.breaker = CircuitBreaker(name)
+        self.limit = concurrency
+        self.latency = None
+        self.baseline_latency = None
+        self.last_decrease = 0
+        self.waiting = []
+        self.in_flight = 0
+        self.tokens_in_flight = 0
+        self.room_tokens = defaultdict(int)
+        self.counter = itertools.count()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens=0):
+        probe = self.breaker.check()
+        level = priority.get()
+        cap = promotable.get()
+        request = Request(
+            priority=level if cap is None else max(level, cap.level),
+            room=current_room.get(),
+            tokens=tokens,
+            seq=next(self.counter),
+            future=asyncio.get_running_loop().create_future(),
+        )
+        if request.priority != level:
+            cap.waiting[request] = (self, level)
+        if request.room not in self.room_tokens:
+            # Rooms that join late start level with the others
+            self.room_tokens[request.room] = min(self.room_tokens.values(), default=0)
+        self.waiting.append(request)
+        metrics.gauge(f"{self.name}.queue_depth", len(self.waiting))
+        self.dispatch()
+        try:
+            await request.future
+        except asyncio.CancelledError:
+            if probe:
+                self.breaker.probing = False
+            if request.future.cancelled():
+                self.waiting.remove(request)
+                metrics.gauge(f"{self.name}.queue_depth", len(self.waiting))
+            else:
+                # Got the slot just before being cancelled
+                self.release(request)
+            raise
+        finally:
+            if cap is not None:
+                cap.waiting.pop(request, None)
+
+        wait_seconds = time.monotonic() - request.start
+        metrics.observe(f"{self.name}.wait_seconds", wait_seconds)
+        metrics.observe(
+            f"{self.name}.wait_seconds.{PRIORITY_NAMES[request.priority]}", wait_seconds
+        )
+        start = time.monotonic()
+        try:
+            yield
+        except (asyncio.CancelledError, GeneratorExit):
+            # Says nothing about the health of the backend
+            if probe:
+                self.breaker.probing = False
+            raise
+        except Exception:
+            self.failure()
+            raise
+        else:
+            self.success(time.monotonic() - start)
+        finally:
+            self.release(request)
+
+    def dispatch(self):
+        concurrency = self.concurrency
+        if ADAPTIVE_CONCURRENCY:
+            concurrency = min(concurrency, int(self.limit))
+        while self.waiting and self.in_flight < concurrency:
+            request = min(self.waiting, key=self.rank)
+            if (
+                self.max_tokens
+                and self.tokens_in_flight
+                and self.tokens_in_flight + request.tokens > self.max_tokens
+            ):
+                break
+            self.waiting.remove(request)
+            self.in_flight += 1
+            self.tokens_in_flight += request.tokens
+            self.room_tokens[request.room] += request.tokens
+            request.future.set_result(None)
+
+        metrics.gauge(f"{self.name}.queue_depth", len(self.waiting))
+        metrics.gauge(f"{self.name}.in_flight", self.in_flight)
+        metrics.gauge(f"{self.name}.tokens_in_flight", self.tokens_in_flight)
+
+    def rank(self, request):
+        promotions = int((time.monotonic() - request.start) / AGING_SECONDS)
+        return (
+            request.priority - promotions,
+            self.room_tokens[request.room],
+            request.seq,
+        )
+
+    def success(self, seconds):
+        self.breaker.success()
+        if self.latency is None:
+            self.latency = self.baseline_latency = seconds
+        self.latency += 0.1 * (seconds - self.latency)
+        # The baseline follows the latency down right away, but up slowly
+        self.baseline_latency = min(
+            self.latency, self.baseline_latency + 0.01 * (self.latency - self.baseline_latency)
+        )
+        if self.latency > SLOW_CALL_FACTOR * self.baseline_latency:
+            self.decrease()
+        else:
+            self.limit = min(self.concurrency, self.limit + 1 / self.limit)
+            metrics.gauge(f"{self.name}.limit", int(self.limit))
+
+    def failure(self):
+        metrics.incr(f"{self.name}.failures")
+        self.breaker.failure()
+        self.decrease()
+
+    def decrease(self):
+        # Calls that were already in flight when the backend got into trouble
+        # will fail or be slow too, so back off at most once per round trip
+        now = time.monotonic()
+        if not ADAPTIVE_CONCURRENCY or now - self.last_decrease < (self.latency or 0):
+            return
+        self.last_decrease = now
+        self.limit = max(1, self.limit / 2)
+        metrics.incr(f"{self.name}.limit_decreases")
+        metrics.gauge(f"{self.name}.limit", int(self.limit))
+
+    def release(self, request):
+        self.in_flight -= 1
+        self.tokens_in_flight -= request.tokens
+        self.dispatch()
+
+
+class Request:
+    def __init__(self, priority, room, tokens, seq, future):
+        self.priority = priority
+        self.room = room
+        self.tokens = tokens
+        self.seq = seq
+        self.future = future
+        self.start = time.monotonic()
+
+
+llama_limiter = Limiter("llama", LLAMA_CONCURRENCY, LLAMA_TOKEN_BUDGET or None)
+sdxl_limiter = Limiter("sdxl", SDXL_CONCURRENCY)
+openai_limiter = Limiter("openai", OPENAI_CONCURRENCY)
+
+_session = None
+
+# Keep references to fire-and-forget cancellation requests
+_background_tasks = set()
+
+
+def session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            # Concurrency is bounded by the limiters, not the connection pool
+            connector=aiohttp.TCPConnector(limit=0),
+            headers={"Authorization": f"Token {os.environ['REPLICATE_API_TOKEN']}"},
+            raise_for_status=True,
+        )
+    return _session
+
+
+async def close():
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+async def replicate_run(model_version, input, limiter, tokens=0):
+    version = model_version.split(":")[1]
+    async with limiter.slot(tokens):
+        start = time.monotonic()
+        async with session().post(
+            f"{REPLICATE_API_URL}/predictions",
+            json={"version": version, "input": input},
+        ) as resp:
+            prediction = await resp.json()
+
+        try:
+            while prediction["status"] not in ("succeeded", "failed", "canceled"):
+                await asyncio.sleep(POLL_INTERVAL)
+                async with session().get(prediction["urls"]["get"]) as resp:
+                    prediction = await resp.json()
+        except asyncio.CancelledError:
+            cancel_prediction(prediction)
+            raise
+        metrics.observe(f"{limiter.name}.run_seconds", time.monotonic() - start)
+        # Inside the slot, so the limiter counts it as a failure
+        if prediction["status"] != "succeeded":
+            raise ModelError(prediction.get("error") or prediction["status"])
+    return prediction["output"]
+
+
+async def replicate_stream(model_version, input, limiter, tokens=0):
+    """Like replicate_run, but yields the output while it's being generated"""
+    version = model_version.split(":")[1]
+    async with limiter.slot(tokens):
+        start = time.monotonic()
+        async with session().post(
+            f"{REPLICATE_API_URL}/predictions",
+            json={"version": version, "input": input, "stream": True},
+        ) as resp:
+            prediction = await resp.json()
+
+        try:
+            async with session().get(
+                prediction["urls"]["stream"],
+                headers={"Accept": "text/event-stream", "Cache-Control": "no-store"},
+            ) as resp:
+                async for event, data in server_sent_events(resp.content):
+                    if event == "output":
+                        yield data
+                    elif event == "error":
+                        raise ModelError(data)
+                    elif event == "done":
+                        break
+        except (asyncio.CancelledError, GeneratorExit):
+            cancel_prediction(prediction)
+            raise
+        metrics.observe(f"{limiter.name}.run_seconds", time.monotonic() - start)
+
+
+async def server_sent_events(lines):
+    event, data = "message", []
+    async for line in lines:
+        line = line.decode().rstrip("\r\n")
+        if line.startswith("event:"):
+            event = line.removeprefix("event:").strip()
+        elif line.startswith("data:"):
+            data.append(line.removeprefix("data:").removeprefix(" "))
+        elif not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+
+
+def cancel_prediction(prediction):
+    async def cancel():
+        try:
+            async with session().post(prediction["urls"]["cancel"]):
+                pass
+        except aiohttp.ClientError:
+            pass
+
+    task = asyncio.create_task(cancel())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
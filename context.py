@@ -0,0 +1,119 @@
+import string
+
+import metrics
+from client import count_tokens, prioritized, SENTIMENT
+from llama import gen
+
+# llama-2's context window, which is shared by the prompt and the output
+CONTEXT_TOKENS = 4096
+
+# Prompts are trimmed to this many tokens (or less, to leave room for the
+# output) by dropping the oldest lines of the summary and beliefs
+PROMPT_BUDGET = 2000
+
+# Set to True to let the llama compress a juror's summary or beliefs to half
+# of their budget once they grow past it. Growing sections are otherwise only
+# trimmed when a prompt goes over PROMPT_BUDGET
+ROLLING_COMPRESSION = True
+SECTION_BUDGETS = {"summary": 300, "beliefs": 200}
+
+
+class Section:
+    def __init__(self, name, body, header="", trimmable=False):
+        self.name = name
+        self.header = header
+        self.lines = body.split("\n")
+        self.trimmable = trimmable
+
+    def text(self):
+        return self.header + "\n".join(self.lines)
+
+
+class Prompt:
+    """A prompt made of sections, which are separated by empty lines. Counts
+    the tokens of every section, and when the prompt doesn't fit the budget
+    of a call that generates up to `max_length` tokens, drops the oldest
+    lines of its trimmable sections, largest section first."""
+
+    def __init__(self, kind, max_length=500):
+        self.kind = kind
+        self.max_length = max_length
+        self.sections = []
+
+    def add(self, name, body, header="", trimmable=False):
+        self.sections.append(Section(name, body, header, trimmable))
+
+    def render(self):
+        budget = min(PROMPT_BUDGET, CONTEXT_TOKENS - self.max_length)
+        text = self.join()
+        while count_tokens(text) > budget:
+            trimmable = [s for s in self.sections if s.trimmable and len(s.lines) > 1]
+            if not trimmable:
+                metrics.incr(f"prompt.{self.kind}.over_budget")
+                break
+            section = max(trimmable, key=lambda s: count_tokens(s.text()))
+            section.lines.pop(0)
+            metrics.incr(f"prompt.trimmed_lines.{section.name}")
+            text = self.join()
+
+        for section in self.sections:
+            metrics.observe(f"prompt.sections.{section.name}", count_tokens(section.text()))
+        metrics.observe(f"prompt.{self.kind}", count_tokens(text))
+        return text
+
+    def join(self):
+        return "\n\n".join(section.text() for section in self.sections)
+
+
+class Template:
+    """A prompt layout, declared once. Sections are (name, format string)
+    pairs that are split into literal text and fields up front. The last
+    field of a trimmable section is the part that can be trimmed."""
+
+    def __init__(self, kind, sections, trimmable=("summary", "beliefs")):
+        self.kind = kind
+        self.sections = [
+            (name, list(string.Formatter().parse(text))) for name, text in sections
+        ]
+        self.trimmable = trimmable
+
+    def render(self, max_length=500, **values):
+        prompt = Prompt(self.kind, max_length)
+        for name, pieces in self.sections:
+            parts = []
+            for literal, field, _, _ in pieces:
+                parts.append(literal)
+                if field is not None:
+                    parts.append(str(values[field]))
+            if name in self.trimmable:
+                prompt.add(name, parts[-1], header="".join(parts[:-1]), trimmable=True)
+            else:
+                prompt.add(name, "".join(parts))
+        return prompt.render()
+
+
+async def compress(name, text, what):
+    """Has the llama rewrite `text` (the `name` section, e.g. "summary") in
+    half of its budget once it has grown past it"""
+    budget = SECTION_BUDGETS[name]
+    if not ROLLING_COMPRESSION or count_tokens(text) <= budget:
+        return text
+
+    metrics.incr(f"prompt.compressions.{name}")
+    prompt = f"""Rewrite the following {what} as fewer and shorter bullet points, in at most {budget // 2 * 3 // 4} words. Keep the most important and the most recent points. Only output the bullet points.
+
+{text}"""
+    with prioritized(SENTIMENT):
+        compressed = await gen(prompt, max_length=budget // 2)
+    if not compressed or count_tokens(compressed) > budget:
+        return keep_last(text, budget // 2)
+    return compressed
+
+
+def keep_last(text, tokens):
+    """The last lines of `text` that fit in `tokens`"""
+    lines = text.split("\n")
+    kept = []
+    while lines and count_tokens("\n".join([lines[-1], *kept])) <= tokens:
+        kept.insert(0, lines.pop())
+    return "\n".join(kept) if kept else text[-tokens * 4 :]
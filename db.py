@@ -1,20 +1,56 @@
+import asyncio
+import copy
 import sys
 import dataclasses
+import json
 import os
+import sqlite3
+import threading
+import time
+from collections import deque
 from supabase import create_client
 
 from agent import Agent
+import metrics
 
+# Maximum number of database writes in flight across all rooms
+MAX_WRITES_IN_FLIGHT = 4
 
-class DatabaseSession:
+# Set to True to write only what changed since the previous save, as events
+# in the state_event table between full snapshots in the state table. Needs
+# the schema changes in the README, and readers (like the frontend) that
+# apply the events. Otherwise every change is written as a full snapshot
+STATE_EVENTS = False
+
+# Number of state events (deltas) to write between full state snapshots
+SNAPSHOT_INTERVAL = 20
+
+
+class Session:
     def __init__(self, room):
         self.room = room
+        self.state_log = StateLog()
 
-        self.client = None
-        if "SUPABASE_URL" not in os.environ:
-            sys.stderr.write("No SUPABASE_URL provided, won't save to database\n")
-            return
+    def save_state(self, state):
+        record = self.state_log.record(state)
+        if record is not None:
+            self.insert_state_record(*record)
 
+    def save_draft(self, case_id, speaker, text, done=False):
+        self.upsert_draft(
+            {
+                "room": self.room,
+                "case_id": case_id,
+                "speaker": speaker,
+                "text": text,
+                "done": done,
+            }
+        )
+
+
+class DatabaseSession(Session):
+    def __init__(self, room):
+        super().__init__(room)
         self.client = create_client(
             os.environ["SUPABASE_URL"], os.environ["SUPABASE_API_KEY"]
         )
@@ -25,38 +61,22 @@ class DatabaseSession:
         print(f"Starting case {case_id} in room {room}")
         return case_id
 
-    def save_state(self, state):
-        if self.client is None:
-            return
-
-        agent_dicts = None
-        if state.agents is not None:
-            agent_dicts = []
-            for a in state.agents:
-                agent_dicts.append(dataclasses.asdict(a))
+    def insert_state_record(self, kind, row):
+        if not STATE_EVENTS:
+            # The state table may not have a seq column
+            row = {k: v for k, v in row.items() if k != "seq"}
+        table = "state" if kind == "snapshot" else "state_event"
+        self.client.table(table).insert(row).execute()
 
-        self.client.table("state").insert(
-            {
-                "case_id": state.case_id,
-                "room": state.room,
-                "evidence": state.evidence,
-                "agents": agent_dicts,
-                "verdict": state.verdict,
-            }
-        ).execute()
+    def upsert_draft(self, row):
+        self.client.table("utterance_draft").upsert(row).execute()
 
     def save_transcript(self, case_id, transcript):
-        if self.client is None:
-            return
-
         self.client.table("case").update({"transcript": transcript}).eq(
             "id", case_id
         ).execute()
 
     async def load_latest(self, room):
-        if self.client is None:
-            return None, None, None, None, None
-
         # Fetch the latest case for the room
         case_result = (
             self.client.table("case")
@@ -86,19 +106,423 @@ class DatabaseSession:
             return case_id, None, None, None, transcript
 
         state = state_result.data[0]
-        agent_dicts = state["agents"]
-        agents = None
+        seq = state.get("seq") or 0
+        if STATE_EVENTS:
+            event_result = (
+                self.client.table("state_event")
+                .select("*")
+                .eq("case_id", case_id)
+                .gt("seq", seq)
+                .order("seq")
+                .execute()
+            )
+            for event in event_result.data:
+                apply_delta(state, event["delta"])
+                seq = event["seq"]
+        self.state_log.resume(seq)
+
+        return (
+            case_id,
+            agents_from_dicts(state["agents"]),
+            state["evidence"],
+            state["verdict"],
+            transcript,
+        )
+
+
+class SQLiteSession(Session):
+    """Local stand-in for Supabase with the same tables. Uses WAL mode so
+    that readers don't block the (background) writer."""
+
+    def __init__(self, room, path):
+        super().__init__(room)
+        self.path = path
+        self.local = threading.local()
+
+        conn = self.conn()
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS "case" (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                room TEXT NOT NULL,
+                transcript TEXT
+            );
+            CREATE TABLE IF NOT EXISTS state (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                case_id INTEGER REFERENCES "case"(id),
+                room TEXT NOT NULL,
+                evidence TEXT,
+                agents TEXT,
+                verdict TEXT,
+                seq INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS state_event (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                case_id INTEGER REFERENCES "case"(id),
+                room TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                delta TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS utterance_draft (
+                room TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL,
+                case_id INTEGER REFERENCES "case"(id),
+                speaker TEXT NOT NULL,
+                text TEXT NOT NULL,
+                done INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS case_room_created_at ON "case" (room, created_at);
+            CREATE INDEX IF NOT EXISTS state_room_created_at ON state (room, created_at);
+            CREATE INDEX IF NOT EXISTS state_case_id_created_at ON state (case_id, created_at);
+            CREATE INDEX IF NOT EXISTS state_event_case_id_seq ON state_event (case_id, seq);
+            """
+        )
 
-        if agent_dicts:
-            agents = []
-            for agent_dict in agent_dicts:
-                agent = Agent(**agent_dict)
-                agents.append(agent)
+    def conn(self):
+        # One connection per thread, since writes happen in worker threads
+        if getattr(self.local, "conn", None) is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return self.local.conn
+
+    def create_case(self, room):
+        conn = self.conn()
+        with conn:
+            cursor = conn.execute(
+                'INSERT INTO "case" (created_at, room) VALUES (?, ?)',
+                (time.time(), room),
+            )
+        case_id = cursor.lastrowid
+        print(f"Starting case {case_id} in room {room}")
+        return case_id
+
+    def insert_state_record(self, kind, row):
+        conn = self.conn()
+        with conn:
+            if kind == "snapshot":
+                conn.execute(
+                    "INSERT INTO state (created_at, case_id, room, evidence, agents, verdict, seq) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        time.time(),
+                        row["case_id"],
+                        row["room"],
+                        row["evidence"],
+                        json.dumps(row["agents"]),
+                        row["verdict"],
+                        row["seq"],
+                    ),
+                )
+            else:
+                conn.execute(
+                    "INSERT INTO state_event (created_at, case_id, room, seq, delta) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        time.time(),
+                        row["case_id"],
+                        row["room"],
+                        row["seq"],
+                        json.dumps(row["delta"]),
+                    ),
+                )
+
+    def upsert_draft(self, row):
+        conn = self.conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO utterance_draft (room, updated_at, case_id, speaker, text, done) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    row["room"],
+                    time.time(),
+                    row["case_id"],
+                    row["speaker"],
+                    row["text"],
+                    row["done"],
+                ),
+            )
+
+    def save_transcript(self, case_id, transcript):
+        conn = self.conn()
+        with conn:
+            conn.execute(
+                'UPDATE "case" SET transcript = ? WHERE id = ?', (transcript, case_id)
+            )
+
+    async def load_latest(self, room):
+        conn = self.conn()
+        case_row = conn.execute(
+            'SELECT id, transcript FROM "case" WHERE room = ? ORDER BY created_at DESC, id DESC LIMIT 1',
+            (room,),
+        ).fetchone()
+        if case_row is None:
+            return None, None, None, None, None
+        case_id, transcript = case_row
+
+        row = conn.execute(
+            "SELECT evidence, agents, verdict, seq FROM state WHERE case_id = ? ORDER BY created_at DESC, id DESC LIMIT 1",
+            (case_id,),
+        ).fetchone()
+        if row is None:
+            return case_id, None, None, None, transcript
+
+        evidence, agents, verdict, seq = row
+        state = {
+            "evidence": evidence,
+            "agents": json.loads(agents),
+            "verdict": verdict,
+        }
+        seq = seq or 0
+        events = conn.execute(
+            "SELECT seq, delta FROM state_event WHERE case_id = ? AND seq > ? ORDER BY seq",
+            (case_id, seq),
+        ).fetchall()
+        for seq, delta in events:
+            apply_delta(state, json.loads(delta))
+        self.state_log.resume(seq)
 
         return (
             case_id,
-            agents,
+            agents_from_dicts(state["agents"]),
             state["evidence"],
             state["verdict"],
             transcript,
         )
+
+
+def open_session(room):
+    if "SUPABASE_URL" in os.environ:
+        return DatabaseSession(room)
+    path = os.environ.get("LLAMA_JURY_DB", "llama_jury.db")
+    sys.stderr.write(f"No SUPABASE_URL provided, saving to {path}\n")
+    return SQLiteSession(room, path)
+
+
+def agents_from_dicts(agent_dicts):
+    if not agent_dicts:
+        return None
+    return [Agent(**agent_dict) for agent_dict in agent_dicts]
+
+
+class StateLog:
+    """Turns consecutive saves of a state into a full snapshot followed by
+    events that only contain what changed. A new snapshot is taken for every
+    new case or jury, and after SNAPSHOT_INTERVAL events."""
+
+    def __init__(self):
+        self.case_id = None
+        self.agent_names = None
+        self.evidence = None
+        self.verdict = None
+        self.case_summary = None
+        self.seq = 0
+        self.events_since_snapshot = 0
+
+    def force_snapshot(self):
+        self.events_since_snapshot = SNAPSHOT_INTERVAL
+
+    def resume(self, seq):
+        """Continues after the last record of a case that was loaded from the
+        database. Events are found by case and seq, so if a new process
+        numbered its records from 0 again, loading would replay the events
+        of an earlier process on top of its snapshots."""
+        self.seq = max(self.seq, seq)
+
+    def record(self, state):
+        agent_names = [a.name for a in state.agents] if state.agents is not None else None
+        dirty = {a.name: a.pop_dirty_fields() for a in state.agents or []}
+        self.seq += 1
+
+        if (
+            state.case_id != self.case_id
+            or agent_names != self.agent_names
+            or self.events_since_snapshot >= SNAPSHOT_INTERVAL
+        ):
+            return self.snapshot(state, agent_names)
+
+        delta = {}
+        if state.evidence != self.evidence:
+            delta["evidence"] = self.evidence = state.evidence
+        if state.verdict != self.verdict:
+            delta["verdict"] = self.verdict = state.verdict
+        if state.case_summary != self.case_summary:
+            delta["case_summary"] = self.case_summary = state.case_summary
+        agent_deltas = {}
+        for a in state.agents or []:
+            fields = dirty[a.name]
+            if state.case_summary is not None:
+                # Every juror has a copy of the case summary, which is
+                # stored only once
+                fields = fields - {"summary"}
+            if fields:
+                agent_deltas[a.name] = {f: copy.deepcopy(getattr(a, f)) for f in fields}
+        if agent_deltas:
+            delta["agents"] = agent_deltas
+        if not delta:
+            self.seq -= 1
+            return None
+        if not STATE_EVENTS:
+            return self.snapshot(state, agent_names)
+
+        self.events_since_snapshot += 1
+        return "event", {
+            "case_id": state.case_id,
+            "room": state.room,
+            "seq": self.seq,
+            "delta": delta,
+        }
+
+    def snapshot(self, state, agent_names):
+        self.case_id = state.case_id
+        self.agent_names = agent_names
+        self.evidence = state.evidence
+        self.verdict = state.verdict
+        self.case_summary = state.case_summary
+        self.events_since_snapshot = 0
+        row = state_row(state)
+        row["seq"] = self.seq
+        return "snapshot", row
+
+
+def apply_delta(row, delta):
+    if "evidence" in delta:
+        row["evidence"] = delta["evidence"]
+    if "verdict" in delta:
+        row["verdict"] = delta["verdict"]
+    if delta.get("case_summary") is not None:
+        for agent_dict in row["agents"]:
+            agent_dict["summary"] = delta["case_summary"]
+    for name, fields in delta.get("agents", {}).items():
+        for agent_dict in row["agents"]:
+            if agent_dict["name"] == name:
+                agent_dict.update(fields)
+
+
+def merge_records(first, second):
+    """Merge two consecutive state records into one"""
+    first_kind, first_row = first
+    second_kind, second_row = second
+    if second_kind == "snapshot":
+        return second
+    if first_kind == "snapshot":
+        apply_delta(first_row, second_row["delta"])
+        first_row["seq"] = second_row["seq"]
+        return first
+    delta = first_row["delta"]
+    for key in ["evidence", "verdict", "case_summary"]:
+        if key in second_row["delta"]:
+            delta[key] = second_row["delta"][key]
+    for name, fields in second_row["delta"].get("agents", {}).items():
+        delta.setdefault("agents", {}).setdefault(name, {}).update(fields)
+    first_row["seq"] = second_row["seq"]
+    return first
+
+
+class WriteBehindSession:
+    """Queues writes and performs them in the background, in order, so that
+    saving never blocks the event loop. If a state record is still waiting
+    to be written when the next one comes in, the two are merged."""
+
+    _write_slots = None
+
+    def __init__(self, db):
+        self.db = db
+        self.room = db.room
+        self.queue = deque()
+        self.has_writes = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.task = None
+
+    def create_case(self, room):
+        return self.db.create_case(room)
+
+    def save_state(self, state):
+        # Serialize now, the state keeps changing while the write is queued
+        record = self.db.state_log.record(state)
+        if record is None:
+            return
+        if self.queue and self.queue[-1][0] == "state":
+            self.queue[-1] = ("state", merge_records(self.queue[-1][1], record))
+            metrics.incr("db.merged_records")
+        else:
+            self.queue.append(("state", record))
+        self.wake()
+
+    def save_draft(self, case_id, speaker, text, done=False):
+        # Only the latest text of a draft matters
+        if self.queue and self.queue[-1][0] == "draft":
+            self.queue.pop()
+            metrics.incr("db.dropped_drafts")
+        self.queue.append(("draft", (case_id, speaker, text, done)))
+        self.wake()
+
+    def save_transcript(self, case_id, transcript):
+        self.queue.append(("transcript", (case_id, transcript)))
+        self.wake()
+
+    async def load_latest(self, room):
+        await self.flush()
+        return await self.db.load_latest(room)
+
+    def wake(self):
+        metrics.gauge(f"db.{self.room}.queue_depth", len(self.queue))
+        self.idle.clear()
+        self.has_writes.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        if WriteBehindSession._write_slots is None:
+            WriteBehindSession._write_slots = asyncio.Semaphore(MAX_WRITES_IN_FLIGHT)
+
+        while True:
+            await self.has_writes.wait()
+            while self.queue:
+                kind, args = self.queue.popleft()
+                metrics.gauge(f"db.{self.room}.queue_depth", len(self.queue))
+                async with WriteBehindSession._write_slots:
+                    start = time.monotonic()
+                    try:
+                        if kind == "state":
+                            await asyncio.to_thread(self.db.insert_state_record, *args)
+                        elif kind == "draft":
+                            await asyncio.to_thread(self.db.save_draft, *args)
+                        else:
+                            await asyncio.to_thread(self.db.save_transcript, *args)
+                    except Exception as e:
+                        sys.stderr.write(f"Failed to write {kind} to database: {e}\n")
+                        sys.stderr.flush()
+                        if kind == "state":
+                            # Later events would build on the lost write
+                            self.db.state_log.force_snapshot()
+                    metrics.observe("db.write_seconds", time.monotonic() - start)
+            self.has_writes.clear()
+            self.idle.set()
+
+    async def flush(self):
+        await self.idle.wait()
+
+    async def close(self):
+        await self.flush()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+def state_row(state):
+    agent_dicts = None
+    if state.agents is not None:
+        agent_dicts = []
+        for a in state.agents:
+            agent_dicts.append(dataclasses.asdict(a))
+
+    return {
+        "case_id": state.case_id,
+        "room": state.room,
+        "evidence": state.evidence,
+        "agents": agent_dicts,
+        "verdict": state.verdict,
+    }
@@ -1,22 +1,7 @@
-import re
-import time
-import os
-import openai
+import backends
+import metrics
 
-async def generate(prompt) -> str:
-    openai.api_key = os.environ["OPENAI_API_KEY"]
-    response = await openai.ChatCompletion.acreate(
-        model="gpt-4",
-        messages=[
-            {
-                "role": "user",
-                "content": prompt,
-            },
-        ],
-        n=1,
-        stop=None,
-        temperature=0.7,
-        stream=False,
-    )
-    output = response["choices"][0]["message"]["content"]
-    return output
+
+async def generate(prompt, *, cache=True) -> str:
+    metrics.incr("gpt.calls")
+    return await backends.chat.generate(prompt, cache=cache)
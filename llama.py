@@ -1,65 +1,264 @@
 import asyncio
+import collections
+import contextlib
 import re
+import time
 from typing import List, Tuple, Optional, Dict, Any
-import replicate
 
-from monkey_patch_replicate import monkey_patch_replicate
+import backends
+import client
+import metrics
+import structured
+from structured import fuzzy_percent
+from client import count_tokens
 
-monkey_patch_replicate(replicate)
+MAX_ATTEMPTS = 8
 
+# Tries per model call, both for errors (with backoff) and for outputs that
+# break character
+GEN_ATTEMPTS = 6
 
-MAX_ATTEMPTS = 8
+# Set to True to send calls made with hedge=True a second time when they
+# take longer than HEDGE_PERCENTILE of recent ones. Every room may hedge at
+# most HEDGE_BUDGET of its hedgeable calls
+HEDGING = False
+HEDGE_PERCENTILE = 0.9
+HEDGE_BUDGET = 0.1
+HEDGE_MIN_SAMPLES = 20
 
+# Recent latencies of hedgeable calls, streamed calls until their first chunk
+hedge_latencies = {
+    False: collections.deque(maxlen=200),
+    True: collections.deque(maxlen=200),
+}
+hedge_budgets = collections.defaultdict(lambda: {"calls": 0, "hedges": 0})
 
-async def gen(prompt, max_length=500) -> str:
-    loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(None, gen_sync, prompt, max_length)
-    return result
+# Set to True to ask for just the fields that couldn't be parsed before
+# regenerating a whole formatted response
+PARTIAL_RETRY = True
 
+# Set to True to stream formatted responses and stop generating as soon as
+# all fields are complete, or as soon as one of them can't be parsed
+EARLY_STOP = True
 
-def gen_sync(prompt, max_length, *, attempt=0) -> str:
-    try:
-        output = replicate.run(
-            "a16z-infra/llama-2-13b-chat:2a7f981751ec7fdf87b5b91ad4db53683a98082e9ff7bfd12c8cd5ea85980a52",
-            # "replicate/llama-2-70b-chat:58d078176e02c219e11eb4da5a02a7830a283b14cf8f94537af893ccff5ee781",
-            input={"prompt": prompt, "system_prompt": "", "temperature": 1.1, "max_new_tokens": max_length},
-        )
-        output = "".join(list(output)).strip()
-    except Exception:
-        if attempt > 3:
+
+async def gen(prompt, max_length=500, *, cache=True, on_partial=None, schema=None, hedge=False) -> str:
+    """If `on_partial` is given, the output is streamed and on_partial is
+    called with the output so far every time more of it arrives. If
+    `schema` is given, generation stops once all of its fields are complete.
+    Set `hedge` for calls that someone is waiting for, see HEDGING."""
+    if not EARLY_STOP:
+        schema = None
+    for attempt in range(GEN_ATTEMPTS):
+        shown = withheld = False
+
+        def publish(text):
+            nonlocal shown, withheld
+            # Withhold the rest of an output that is going to be rejected.
+            # The space catches a trailing " AI" before the next chunk
+            withheld = withheld or breaks_character(text + " ")
+            if not withheld:
+                shown = True
+                on_partial(text)
+
+        partial = publish if on_partial is not None else None
+        try:
+            metrics.incr("llama.calls")
+            metrics.incr("llama.prompt_tokens", count_tokens(prompt))
+            if hedge:
+                output = await hedged(
+                    prompt, partial, schema, max_length=max_length, cache=cache
+                )
+            else:
+                output = await generate_once(
+                    prompt, partial, schema, max_length=max_length, cache=cache
+                )
+            metrics.incr("llama.output_tokens", count_tokens(output))
+            output = output.strip()
+        except client.PermanentError:
             raise
-        return gen_sync(prompt, max_length=max_length, attempt=attempt + 1)
+        except Exception as e:
+            if attempt == GEN_ATTEMPTS - 1:
+                raise
+            metrics.incr("llama.errors")
+            await asyncio.sleep(client.retry_delay(e, attempt))
+            continue
+
+        if breaks_character(output):
+            if shown:
+                # Take back what was shown of it
+                on_partial("")
+            # Don't keep getting the same bad output from the cache
+            cache = refresh(cache)
+            continue
+
+        return output
+    return ""
+
 
+def breaks_character(text):
     # Catch "as a language model", etc.
-    if " AI " in output or "language model" in output.lower():
-        if attempt > 5:
-            return ""
-        return gen_sync(prompt, max_length=max_length, attempt=attempt + 1)
+    return " AI " in text or "language model" in text.lower()
+
+
+async def generate_once(prompt, on_partial, schema, **params):
+    if on_partial is None and schema is None:
+        return await backends.text.generate(prompt, **params)
+    return await stream(prompt, on_partial, schema, **params)
+
+
+async def hedged(prompt, on_partial, schema, **params):
+    """Sends the call again if it hasn't returned (or, when streamed,
+    started returning) once it has taken longer than HEDGE_PERCENTILE of
+    recent hedged calls. The first one to get there wins, the other one is
+    cancelled."""
+    streamed = on_partial is not None or schema is not None
+    latencies = hedge_latencies[streamed]
+    budget = hedge_budgets[client.current_room.get()]
+    start = time.monotonic()
+    tasks = []
+    leader = None
+
+    def lead(i):
+        nonlocal leader
+        if leader is None:
+            leader = i
+            # The latency of the first call, or a lower bound on it
+            latencies.append(time.monotonic() - start)
+            for j, task in enumerate(tasks):
+                if j != i:
+                    task.cancel()
+        return leader == i
+
+    def call(i):
+        if not streamed:
+            return generate_once(prompt, None, None, **params)
+
+        def partial(text):
+            if lead(i) and on_partial is not None:
+                on_partial(text)
+
+        return stream(prompt, partial, schema, **params)
+
+    budget["calls"] += 1
+    tasks.append(asyncio.ensure_future(call(0)))
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay(latencies))
+        if (
+            not done
+            and budget["hedges"] < HEDGE_BUDGET * budget["calls"]
+            # Don't add to the load of a backend that's in trouble
+            and client.llama_limiter.breaker.closed
+        ):
+            budget["hedges"] += 1
+            metrics.incr("llama.hedges")
+            metrics.incr("llama.prompt_tokens", count_tokens(prompt))
+            tasks.append(asyncio.ensure_future(call(1)))
+
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    i = tasks.index(task)
+                    lead(i)
+                    if i:
+                        metrics.incr("llama.hedge_wins")
+                    metrics.observe("llama.hedged_seconds", time.monotonic() - start)
+                    return task.result()
+        raise next(task.exception() for task in tasks if not task.cancelled())
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def hedge_delay(latencies):
+    if not HEDGING or len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return sorted(latencies)[int(HEDGE_PERCENTILE * (len(latencies) - 1))]
+
 
+async def stream(prompt, on_partial, schema, **params):
+    start = time.monotonic()
+    output = ""
+    # Closed explicitly so that stopping early frees up the model right away
+    async with contextlib.aclosing(backends.text.stream(prompt, **params)) as chunks:
+        async for chunk in chunks:
+            if not output:
+                metrics.observe("llama.first_token_seconds", time.monotonic() - start)
+            output += chunk
+            if on_partial is not None:
+                on_partial(output.strip())
+            # Fields can only be completed by a newline, the next label or the
+            # end of a JSON object
+            if schema is not None and ("\n" in chunk or ":" in chunk or "}" in chunk):
+                status = schema.check(output)
+                if status is not None:
+                    metrics.incr(f"llama.early_stops.{status}")
+                    break
     return output
 
 
-async def gen_formatted_response(prompt, response_fields, max_length=500):
-    for _ in range(MAX_ATTEMPTS):
-        output = await gen(prompt, max_length=max_length)
-        parsed = parse_formatted_response(output, response_fields)
-        if parsed is not None:
-            return parsed
+def refresh(cache):
+    return "refresh" if cache else False
+
+
+async def gen_formatted_response(prompt, schema, max_length=500, *, cache=True):
+    for attempt in range(MAX_ATTEMPTS):
+        output = await gen(
+            prompt,
+            max_length=max_length,
+            cache=cache if attempt == 0 else refresh(cache),
+            schema=schema,
+        )
+        values, errors = schema.parse_fields(output)
+        if values and errors and PARTIAL_RETRY:
+            values, errors = await gen_missing_fields(
+                prompt, schema, values, errors, cache=cache
+            )
+        if not errors:
+            return values
+        metrics.incr("llama.format_retries")
         print("Failed to parse:\n" + output)
     return None
 
 
+async def gen_missing_fields(prompt, schema, values, missing, *, cache=True):
+    """Keeps the fields that could be parsed and asks for only the missing
+    ones, which is a lot shorter than generating everything again"""
+    metrics.incr("llama.partial_retries")
+    missing_schema = structured.subset(schema, tuple(missing))
+    output = await gen(
+        f"""{prompt}
+
+{schema.render(values)}
+
+Some of your response is missing. Reply with only the following, in the same format:
+
+{missing_schema.format_prompt()}""",
+        max_length=sum(field.max_length for field in missing_schema.fields),
+        cache=cache,
+        schema=missing_schema,
+    )
+    more_values, errors = missing_schema.parse_fields(output)
+    if not errors:
+        metrics.incr("llama.partial_retry_successes")
+    return {**values, **more_values}, errors
+
+
+def field_regex(field):
+    # Replace underscores with a regex pattern that will match either a space or an underscore
+    field_pattern = field.replace("_", "[_ ]")
+    return rf"{field_pattern}:(?:\n )*(.*?)($|\n(?=[A-Z_ ]+:|\Z))"
+
+
 def parse_formatted_response(
     text: str, fields: List[Tuple[str, Any]]
 ) -> Optional[Dict[str, Any]]:
     parsed_data = {}
     for field, data_type in fields:
-        # Replace underscores with a regex pattern that will match either a space or an underscore
-        field_pattern = field.replace("_", "[_ ]")
-
         # Use regular expressions to find the data associated with each field
-        pattern = rf"{field_pattern}:(?:\n )*(.*?)($|\n(?=[A-Z_ ]+:|\Z))"
-        match = re.search(pattern, text, re.DOTALL)
+        match = re.search(field_regex(field), text, re.DOTALL)
         if match:
             # If the field is found, attempt to cast it to the specified data type
             try:
@@ -71,20 +270,6 @@ def parse_formatted_response(
     return parsed_data
 
 
-def fuzzy_percent(s):
-    # Remove unnecessary white spaces
-    s = s.strip()
-
-    # Use a regular expression to search for a number, optionally followed by a percent sign
-    match = re.search(r"\b(\d+(\.\d+)?)%?\b", s)
-    if match:
-        # If a match is found, convert the first group to an integer and return it
-        return int(float(match.group(1)))
-    else:
-        # If no match is found, throw an error
-        raise ValueError()
-
-
 def response_format_prompt(fields):
     lines = []
     for key, _ in fields:
@@ -2,7 +2,10 @@ import sys
 import time
 import argparse
 import asyncio
+import contextlib
 import random
+import re
+import signal
 
 from dotenv import load_dotenv
 
@@ -10,9 +13,18 @@ load_dotenv()
 
 
 from llama import gen
+import backends
 import gpt
-from db import DatabaseSession
-from agent import Agent
+from cache import Cache, CachedBackend
+import replay
+import client
+import metrics
+import db
+from db import WriteBehindSession, open_session
+from agent import Agent, hear_all, update_case_summary
+from sd import ImageWorker, image_worker, prewarm_portraits
+import portraits
+import supervisor
 from state import State, INITIAL_EVIDENCE, DELIBERATION_EVIDENCE
 
 ROOM_CHARACTERS = {
@@ -70,14 +82,51 @@ ROOM_CHARACTERS = {
 # Set to False for faster deliberation
 INTELLIGENTLY_PICK_NEXT_SPEAKER = True
 
+# Number of likely next speakers to start generating utterances for while
+# INTELLIGENTLY_PICK_NEXT_SPEAKER is still deciding who gets to speak.
+# The utterances of the jurors who weren't picked are cancelled.
+SPECULATIVE_SPEAKERS = 0
+
+# Set to True to pick the next speaker and let them start talking while the
+# rest of the jury is still reacting to the previous utterance
+PIPELINED_DELIBERATION = False
+
+# Set to True to let all jurors hear evidence and utterances in a single model
+# call instead of one call per juror
+BATCHED_HEARING = False
+
+# Set to True to keep one factual summary of the evidence that is updated once
+# per block of evidence and shared by all jurors, instead of letting every
+# juror rewrite their own summary
+SHARED_CASE_SUMMARY = False
+
+# Set to True to render portraits in the background instead of making the
+# jury wait for them
+BACKGROUND_IMAGES = True
+
+# Set to True to publish utterances while they are being generated, at most
+# once every STREAM_FLUSH_INTERVAL seconds. The state is still only updated
+# once an utterance is complete
+STREAMED_UTTERANCES = False
+STREAM_FLUSH_INTERVAL = 0.25
+
+# Set to True to generate new preconceptions for every case, instead of
+# reusing the ones of the first case with the same jury
+REFRESH_PRECONCEPTIONS = False
+
+# How often to print queue depths, wait times, etc.
+METRICS_INTERVAL = 60
+
 
 async def generate_transcript():
     with open("transcript.txt") as f:
         example_transcript1 = f.read()
     with open("transcript2.txt") as f:
         example_transcript2 = f.read()
+    # Every case needs a new transcript, so never cache this one
     transcript = await gpt.generate(
-        f"""Generate a fictional court case. The suspected crime should be something a bit funny and not violent. Not too cutesy though. Generate a court transcript where the attorney and the prosecutor both interrogate witnesses. Make the outcome of the case somewhat ambiguous. Include opening and closing statements by both attorney and prosecutor. Start with a name for the case and the name of the defendant. Make everything as short as possible.
+        cache=False,
+        prompt=f"""Generate a fictional court case. The suspected crime should be something a bit funny and not violent. Not too cutesy though. Generate a court transcript where the attorney and the prosecutor both interrogate witnesses. Make the outcome of the case somewhat ambiguous. Include opening and closing statements by both attorney and prosecutor. Start with a name for the case and the name of the defendant. Make everything as short as possible.
 
 Split the transcript into blocks of 2-5 lines each, separated by newlines. Below are two examples of the form (but don't use the content of the examples, instead invent a completely new story line. Feel free to include strange bits of evidence, drawing inspiration from science fiction, detective stories, gangster movies, historical events, etc.):
 
@@ -110,7 +159,8 @@ async def summarize_verdict(agents):
     for agent in agents:
         prompt += f"* {agent.name}: {agent.beliefs}\n"
 
-    return await gen(prompt)
+    with client.prioritized(client.VISIBLE):
+        return await gen(prompt)
 
 
 def print_agents(agents):
@@ -133,51 +183,310 @@ def print_box(text):
     print("********************************")
 
 
+def room_characters(room):
+    """Rooms named like "A-2" have the jury of room "A", so that any number of
+    rooms can be run"""
+    if room not in ROOM_CHARACTERS and (match := re.fullmatch(r"(.+)-\d+", room)):
+        room = match.group(1)
+    return ROOM_CHARACTERS[room]
+
+
+def room_name(room):
+    try:
+        room_characters(room)
+    except KeyError:
+        raise argparse.ArgumentTypeError(
+            f"unknown room {room!r}, use one of {', '.join(ROOM_CHARACTERS)}, optionally followed by -<number>"
+        )
+    return room
+
+
 async def main():
     parser = argparse.ArgumentParser(description="Llama Jury")
     parser.add_argument(
         "rooms",
-        help="Names of the court rooms",
-        choices=["A", "B", "C", "dev-A", "dev-B", "dev-C"],
+        help="Names of the court rooms, e.g. A or A-2 for another room with the jury of A",
+        type=room_name,
         nargs="+",
     )
+    parser.add_argument(
+        "--fake",
+        action="store_true",
+        help="Use local fake models instead of Replicate and OpenAI",
+    )
+    parser.add_argument(
+        "--fake-latency",
+        type=float,
+        default=1.0,
+        help="Median latency of fake llama calls in seconds",
+    )
+    parser.add_argument(
+        "--fake-failure-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of fake model calls that fail",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="PATH",
+        help="Cache model outputs in this SQLite file",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=7,
+        help="Number of days to keep cached model outputs",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        default=256,
+        help="Maximum size of the cache in megabytes",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="PATH",
+        help="Run a single new case and record every model call and database write to this file",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="Re-run a case recorded with --record",
+    )
+    parser.add_argument(
+        "--replay-latency-scale",
+        type=float,
+        default=0.0,
+        help="Multiply recorded latencies by this factor when replaying (0 means no latency)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Random seed, recorded with --record",
+    )
+    parser.add_argument(
+        "--portrait-library",
+        metavar="PATH",
+        help="Reuse portraits across cases and rooms, stored in this SQLite file",
+    )
+    parser.add_argument(
+        "--state-events",
+        action="store_true",
+        help="Write state changes as events between snapshots (see the README for the schema)",
+    )
+    parser.add_argument(
+        "--refresh-preconceptions",
+        action="store_true",
+        help="Generate new preconceptions for every case instead of reusing them",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Run the rooms in this many worker processes that are restarted when they crash or hang",
+    )
     args = parser.parse_args()
     rooms = args.rooms
+    if (args.record or args.replay) and len(rooms) > 1:
+        parser.error("Can only record or replay a single room")
+    if (args.record or args.replay) and args.workers:
+        parser.error("Can't record or replay with workers")
+
+    if args.workers:
+        # Every worker configures its own models
+        await supervisor.supervise(
+            rooms, args.workers, run_worker, args, report_interval=METRICS_INTERVAL
+        )
+        return
 
-    async with asyncio.TaskGroup() as tg:
-        for room in rooms:
-            tg.create_task(run_court(room))
+    configure(args)
+
+    if args.record:
+        seed = args.seed if args.seed is not None else random.randrange(2**32)
+        random.seed(seed)
+        recorder = replay.Recorder(args.record, rooms[0], seed)
+        backends.wrap(lambda backend: replay.RecordingBackend(backend, recorder))
+        db = replay.RecordingSession(open_session(rooms[0]), recorder)
+        try:
+            await run_single_case(db, rooms[0])
+        finally:
+            recorder.close()
+            await client.close()
+        return
 
+    if args.replay:
+        log = replay.ReplayLog(args.replay)
+        random.seed(log.header["seed"])
+        replay.use_replay(log, latency_scale=args.replay_latency_scale)
+        db = replay.ReplaySession(log)
+        start = time.time()
+        await run_single_case(db, log.header["room"])
+        db.finish()
+        print(f"Replayed case in {time.time() - start:.1f} seconds")
+        for model, mismatches in log.mismatches.items():
+            print(f"Prompt mismatches for {model}: {mismatches}")
+        print(f"Database divergences: {db.divergences}")
+        metrics.report()
+        return
+
+    await run_courts(rooms, report_metrics())
+
+
+def configure(args):
+    if args.fake:
+        backends.use_fake(latency=args.fake_latency, failure_rate=args.fake_failure_rate)
+    if args.cache:
+        cache = Cache(
+            args.cache,
+            ttl=args.cache_ttl * 24 * 60 * 60,
+            max_bytes=int(args.cache_max_mb * 1024 * 1024),
+        )
+        backends.wrap(lambda backend: CachedBackend(backend, cache))
+
+    if args.portrait_library:
+        portraits.use_library(args.portrait_library)
+
+    global REFRESH_PRECONCEPTIONS
+    REFRESH_PRECONCEPTIONS = args.refresh_preconceptions
+    db.STATE_EVENTS = args.state_events
+
+
+async def run_courts(rooms, monitor):
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(monitor)
+            for room in rooms:
+                tg.create_task(run_court(room))
+    finally:
+        await client.close()
+
+
+def run_worker(rooms, args, conn):
+    configure(args)
+    with contextlib.suppress(KeyboardInterrupt, asyncio.CancelledError):
+        asyncio.run(run_worker_courts(rooms, conn))
+
+
+async def run_worker_courts(rooms, conn):
+    # Let the supervisor stop us without losing queued state writes
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel
+    )
+    await run_courts(rooms, supervisor.heartbeat(conn))
 
-async def run_court(room):
-    db = DatabaseSession(room)
 
-    state = await State.load(db, room)
+async def report_metrics():
     while True:
-        match state.current_step():
-            case state.EMPTY:
-                await new_case(state)
-            case state.EMPTY_CASE:
-                await initialize_agents_and_transcripts(state)
-            case state.PRESENTING_EVIDENCE:
-                await next_evidence(state)
-            case state.AWAITING_UTTERANCE:
-                await next_utterance(state)
-            case state.AWAITING_SENTIMENT:
-                await next_sentiment(state)
-            case state.AWAITING_VERDICT:
-                await create_verdict(state)
-            case state.COMPLETE:
-                time.sleep(30)
-                await new_case(state)
-            case state.INVALID:
-                sys.stderr.write("Invalid state!\n")
-                sys.stderr.flush()
-                await new_case(state)
+        await asyncio.sleep(METRICS_INTERVAL)
+        metrics.report()
+
+
+async def run_court(room):
+    client.current_room.set(room)
+    db = WriteBehindSession(open_session(room))
+
+    try:
+        state = await State.load(db, room)
+        async with background_images(state):
+            while True:
+                await step(state)
+    finally:
+        # Don't lose queued snapshots on shutdown
+        await db.close()
+
+
+async def run_single_case(db, room):
+    """For --record and --replay. Portraits are rendered inline, even with
+    BACKGROUND_IMAGES: when a background portrait finishes, and so which step
+    saves it, depends on timing, which a replay can't reproduce."""
+    client.current_room.set(room)
+    state = State(
+        db=db,
+        room=room,
+        case_id=None,
+        evidence=None,
+        agents=None,
+        verdict=None,
+        transcript=None,
+    )
+    while state.current_step() != State.COMPLETE:
+        await step(state)
+
+
+@contextlib.asynccontextmanager
+async def background_images(state, wait=False):
+    if not BACKGROUND_IMAGES:
+        yield
+        return
+
+    def on_ready():
+        # Saving in the middle of a step could persist a half-updated jury,
+        # so the save happens once the current step is done
+        state.needs_save = True
+
+    worker = ImageWorker(on_ready)
+    token = image_worker.set(worker)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(worker.run()) for _ in range(worker.concurrency)]
+            yield
+            if wait:
+                await worker.join()
+                if state.needs_save:
+                    state.save()
+            for task in tasks:
+                task.cancel()
+    finally:
+        image_worker.reset(token)
+
+
+async def step(state):
+    try:
+        await run_step(state)
+    finally:
+        if state.needs_save:
+            state.save()
+
+
+async def run_step(state):
+    match state.current_step():
+        case state.EMPTY:
+            await new_case(state)
+        case state.EMPTY_CASE:
+            await initialize_agents_and_transcripts(state)
+        case state.PRESENTING_EVIDENCE:
+            await next_evidence(state)
+        case state.AWAITING_UTTERANCE:
+            await next_utterance(state)
+        case state.AWAITING_SENTIMENT:
+            await next_sentiment(state)
+        case state.AWAITING_VERDICT:
+            await create_verdict(state)
+        case state.COMPLETE:
+            await idle(state, 30)
+            await new_case(state)
+        case state.INVALID:
+            sys.stderr.write("Invalid state!\n")
+            sys.stderr.flush()
+            await new_case(state)
+
+
+async def idle(state, seconds):
+    # Use the time between cases to render portraits we're likely to need
+    prewarm = asyncio.create_task(prewarm_portraits(list(room_characters(state.room))))
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        prewarm.cancel()
+        # Unlike awaiting the task, this doesn't swallow our own cancellation
+        await asyncio.wait([prewarm])
+    if not prewarm.cancelled() and prewarm.exception() is not None:
+        sys.stderr.write(f"Failed to prewarm portraits: {prewarm.exception()}\n")
+        sys.stderr.flush()
 
 
 async def new_case(state):
-    state.reset_with_new_case()
+    await state.reset_with_new_case()
 
 
 async def initialize_agents_and_transcripts(state):
@@ -187,14 +496,16 @@ async def initialize_agents_and_transcripts(state):
 
 
 async def initialize_agents(state):
-    characters = ROOM_CHARACTERS[state.room]
+    characters = room_characters(state.room)
     state.agents = [Agent(name, description) for name, description in characters.items()]
 
     async with asyncio.TaskGroup() as tg:
         for agent in state.agents:
             other_agents = [a for a in state.agents if a != agent]
             tg.create_task(
-                agent.set_preconceptions_about_fellow_jury_members(other_agents)
+                agent.set_preconceptions_about_fellow_jury_members(
+                    other_agents, refresh=REFRESH_PRECONCEPTIONS
+                )
             )
 
     async with asyncio.TaskGroup() as tg:
@@ -219,9 +530,38 @@ async def next_evidence(state):
     if state.evidence == DELIBERATION_EVIDENCE:
         return
 
+    summarize = not SHARED_CASE_SUMMARY
     async with asyncio.TaskGroup() as tg:
+        if SHARED_CASE_SUMMARY:
+            # Jurors hear the evidence with the previous summary in the
+            # meantime, they all have the same one
+            summary = tg.create_task(
+                update_case_summary(
+                    state.case_summary or state.agents[0].summary, state.evidence
+                )
+            )
+        if BATCHED_HEARING:
+            tg.create_task(
+                hear_all(
+                    state.agents,
+                    state.evidence,
+                    is_in_deliberation=False,
+                    summarize=summarize,
+                )
+            )
+        else:
+            for agent in state.agents:
+                tg.create_task(
+                    agent.hear(
+                        state.evidence, is_in_deliberation=False, summarize=summarize
+                    )
+                )
+
+    if SHARED_CASE_SUMMARY:
+        # Saved once for the whole jury, see StateLog
+        state.case_summary = summary.result()
         for agent in state.agents:
-            tg.create_task(agent.hear(state.evidence, is_in_deliberation=False))
+            agent.summary = state.case_summary
 
     print_agents(state.agents)
     state.save()
@@ -231,28 +571,86 @@ async def next_utterance(state):
     previous_speaker = state.previous_speaker()
     previous_utterance = state.previous_utterance()
     other_agents = [a for a in state.agents if a != previous_speaker]
+
+    def say(agent, draft=None):
+        return agent.say(
+            is_in_deliberation=True,
+            previous_utterance=previous_utterance,
+            previous_speaker=previous_speaker,
+            on_partial=draft.update if draft else None,
+        )
+
+    # Start talking before we know who gets to talk, using how eager
+    # everyone was last time as a guess
+    speculative = {}
     if INTELLIGENTLY_PICK_NEXT_SPEAKER:
-        async with asyncio.TaskGroup() as tg:
-            for agent in state.agents:
-                tg.create_task(
-                    agent.decide_to_speak(
-                        is_in_deliberation=True,
-                        previous_utterance=previous_utterance,
-                        previous_speaker=previous_speaker,
-                    )
+        candidates = sorted(other_agents, key=lambda a: a.speak_eagerness, reverse=True)
+        speculative = {
+            a.name: Speculation(say(a)) for a in candidates[:SPECULATIVE_SPEAKERS]
+        }
+
+    selection_start = time.monotonic()
+    try:
+        agent = await pick_next_speaker(
+            state.agents, other_agents, previous_utterance, previous_speaker
+        )
+    except BaseException:
+        for s in speculative.values():
+            s.cancel()
+        # Let them give back their limiter slots before the error goes on
+        await asyncio.gather(*(s.task for s in speculative.values()), return_exceptions=True)
+        raise
+    selection_seconds = time.monotonic() - selection_start
+
+    for name, s in speculative.items():
+        if name != agent.name:
+            s.cancel()
+
+    draft = None
+    if agent.name in speculative:
+        metrics.incr("speculation.hits")
+        speculative[agent.name].priority.promote()
+        utterance = await speculative[agent.name].task
+        # Without speculation we would have waited for selection and
+        # then for the whole utterance
+        metrics.observe(
+            "speculation.saved_seconds",
+            min(selection_seconds, speculative[agent.name].seconds),
+        )
+    else:
+        if speculative:
+            metrics.incr("speculation.misses")
+        # Speculative utterances aren't streamed, they might be for nothing
+        if STREAMED_UTTERANCES:
+            draft = Draft(state, agent)
+        utterance = await say(agent, draft)
+
+    commit_utterance(state, agent, utterance)
+    if draft:
+        draft.finish(utterance)
+
+
+async def pick_next_speaker(agents, candidates, previous_utterance, previous_speaker):
+    if not INTELLIGENTLY_PICK_NEXT_SPEAKER:
+        return random.choice(candidates)
+
+    async with asyncio.TaskGroup() as tg:
+        for agent in agents:
+            tg.create_task(
+                agent.decide_to_speak(
+                    is_in_deliberation=True,
+                    previous_utterance=previous_utterance,
+                    previous_speaker=previous_speaker,
                 )
+            )
 
-        agent = random.choices(
-            other_agents, weights=[a.speak_eagerness for a in other_agents], k=1
-        )[0]
-    else:
-        agent = random.choice(other_agents)
+    return random.choices(
+        candidates, weights=[a.speak_eagerness for a in candidates], k=1
+    )[0]
 
-    utterance = await agent.say(
-        is_in_deliberation=True,
-        previous_utterance=previous_utterance,
-        previous_speaker=previous_speaker,
-    )
+
+def commit_utterance(state, agent, utterance):
+    previous_speaker = state.previous_speaker()
     if previous_speaker:
         previous_speaker.latest_utterance = ""
     agent.latest_utterance = utterance
@@ -266,13 +664,88 @@ async def next_utterance(state):
     print_box(f"\n{agent.name} says: {utterance}\n")
 
 
+class Draft:
+    """The text of an utterance that is still being generated. Until `show`
+    is called (or if visible is True) updates are only kept in memory."""
+
+    def __init__(self, state, agent, visible=True):
+        self.state = state
+        self.agent = agent
+        self.visible = visible
+        self.text = ""
+        self.last_flush = 0
+
+    def update(self, text):
+        self.text = text
+        if self.visible and time.monotonic() - self.last_flush >= STREAM_FLUSH_INTERVAL:
+            self.flush()
+
+    def show(self):
+        self.visible = True
+        self.flush()
+
+    def finish(self, text):
+        # Saved after the utterance has been committed to the state, so the
+        # frontend can switch from one to the other
+        self.text = text
+        self.flush(done=True)
+
+    def flush(self, done=False):
+        self.last_flush = time.monotonic()
+        self.state.save_draft(self.agent, self.text, done)
+        metrics.incr("drafts.flushes")
+
+
+class Speculation:
+    def __init__(self, coro):
+        self.start = time.monotonic()
+        self.end = None
+        # Nobody is waiting for it until its speaker is picked
+        self.priority = client.Promotable(client.SPEAKER_SELECTION)
+        self.task = asyncio.create_task(self.run(coro))
+        self.task.add_done_callback(self.done)
+
+    async def run(self, coro):
+        with self.priority:
+            return await coro
+
+    def done(self, task):
+        self.end = time.monotonic()
+
+    @property
+    def seconds(self):
+        return (self.end or time.monotonic()) - self.start
+
+    def cancel(self):
+        if not self.task.done():
+            self.task.cancel()
+            metrics.incr("speculation.wasted_calls")
+            metrics.observe("speculation.wasted_seconds", self.seconds)
+        elif not self.task.cancelled() and self.task.exception() is None:
+            # Finished but never used
+            metrics.incr("speculation.wasted_calls")
+            metrics.observe("speculation.wasted_seconds", self.seconds)
+
+
 async def next_sentiment(state):
+    if PIPELINED_DELIBERATION and not BATCHED_HEARING:
+        await next_sentiment_and_utterance(state)
+        return
+
     other_agents = [a for a in state.agents if a != state.previous_speaker()]
-    async with asyncio.TaskGroup() as tg:
-        for a in other_agents:
-            tg.create_task(
-                a.hear(is_in_deliberation=True, utterance=state.previous_utterance(), speaker=state.previous_speaker())
-            )
+    if BATCHED_HEARING:
+        await hear_all(
+            other_agents,
+            is_in_deliberation=True,
+            utterance=state.previous_utterance(),
+            speaker=state.previous_speaker(),
+        )
+    else:
+        async with asyncio.TaskGroup() as tg:
+            for a in other_agents:
+                tg.create_task(
+                    a.hear(is_in_deliberation=True, utterance=state.previous_utterance(), speaker=state.previous_speaker())
+                )
 
     print_agents(state.agents)
     state.save()
@@ -292,5 +765,74 @@ async def create_verdict(state):
     state.save()
 
 
+async def next_sentiment_and_utterance(state):
+    """Let the jury react to the latest utterance while the next speaker is
+    picked, and let the next speaker start talking as soon as they have
+    finished reacting themselves. The state is saved in the same order as
+    when running next_sentiment and next_utterance one after the other."""
+
+    turn_start = time.monotonic()
+    speaker = state.previous_speaker()
+    utterance = state.previous_utterance()
+    listeners = [a for a in state.agents if a != speaker]
+
+    hearing = {
+        a.name: asyncio.create_task(
+            a.hear(is_in_deliberation=True, utterance=utterance, speaker=speaker)
+        )
+        for a in listeners
+    }
+    saying = None
+    draft = None
+    try:
+        # Uses everyone's beliefs from before they heard the utterance
+        next_speaker = await pick_next_speaker(state.agents, listeners, utterance, speaker)
+        await hearing[next_speaker.name]
+        if STREAMED_UTTERANCES:
+            # Not shown before the reactions to the previous utterance
+            draft = Draft(state, next_speaker, visible=False)
+        saying = asyncio.create_task(
+            next_speaker.say(
+                is_in_deliberation=True,
+                previous_utterance=utterance,
+                previous_speaker=speaker,
+                on_partial=draft.update if draft else None,
+            )
+        )
+        await asyncio.gather(*hearing.values())
+    except BaseException:
+        tasks = [task for task in [*hearing.values(), saying] if task is not None]
+        for task in tasks:
+            task.cancel()
+        # Let them give back their limiter slots and close their streams
+        # before the error goes on
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    print_agents(state.agents)
+    state.save()
+    state.num_deliberation_steps += 1
+
+    match state.current_step():
+        case State.AWAITING_VERDICT:
+            # The jury is ready for a verdict, nobody gets to finish talking
+            saying.cancel()
+            await asyncio.gather(saying, return_exceptions=True)
+            metrics.incr("pipeline.discarded_utterances")
+            return
+        case State.AWAITING_SENTIMENT:
+            # Nobody's reaction could be parsed. next_sentiment would be run
+            # again, but the next utterance is fine, so it goes ahead
+            metrics.incr("pipeline.failed_hearings")
+
+    if draft:
+        draft.show()
+    said = await saying
+    commit_utterance(state, next_speaker, said)
+    if draft:
+        draft.finish(said)
+    metrics.observe("pipeline.turn_seconds", time.monotonic() - turn_start)
+
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,72 @@
+from collections import defaultdict, deque
+
+# Only keep the most recent observations per metric so long running courts
+# don't grow without bound
+MAX_OBSERVATIONS = 10000
+
+_counters = defaultdict(int)
+_gauges = {}
+_observations = defaultdict(lambda: deque(maxlen=MAX_OBSERVATIONS))
+
+
+def incr(name, n=1):
+    _counters[name] += n
+
+
+def gauge(name, value):
+    _gauges[name] = value
+
+
+def observe(name, value):
+    _observations[name].append(value)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": values[-1],
+    }
+
+
+def snapshot():
+    return {
+        "counters": dict(_counters),
+        "gauges": dict(_gauges),
+        "summaries": {
+            name: summarize(values)
+            for name, values in _observations.items()
+            if values
+        },
+    }
+
+
+def reset():
+    _counters.clear()
+    _gauges.clear()
+    _observations.clear()
+
+
+def report(snap=None, title="metrics"):
+    if snap is None:
+        snap = snapshot()
+    print(f"=== {title} ===")
+    for name, value in sorted(snap["counters"].items()):
+        print(f"{name}: {value}")
+    for name, value in sorted(snap["gauges"].items()):
+        print(f"{name}: {value}")
+    for name, s in sorted(snap["summaries"].items()):
+        print(
+            f"{name}: n={s['count']} mean={s['mean']:.3f} p50={s['p50']:.3f} p95={s['p95']:.3f} max={s['max']:.3f}"
+        )
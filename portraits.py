@@ -0,0 +1,240 @@
+import asyncio
+import difflib
+import re
+import sqlite3
+import time
+
+import metrics
+
+# Every free-text mood is mapped onto one of these, so that portraits can be
+# reused across cases and rooms
+MOODS = [
+    "neutral",
+    "happy",
+    "amused",
+    "excited",
+    "confident",
+    "determined",
+    "curious",
+    "intrigued",
+    "thoughtful",
+    "skeptical",
+    "suspicious",
+    "confused",
+    "bored",
+    "tired",
+    "impatient",
+    "annoyed",
+    "grumpy",
+    "angry",
+    "outraged",
+    "disgusted",
+    "sad",
+    "worried",
+    "anxious",
+    "nervous",
+    "shocked",
+    "calm",
+    "serious",
+    "stern",
+    "smug",
+    "sympathetic",
+]
+
+SYNONYMS = {
+    "content": "happy",
+    "cheerful": "happy",
+    "jolly": "happy",
+    "pleased": "happy",
+    "delighted": "happy",
+    "entertained": "amused",
+    "enthusiastic": "excited",
+    "eager": "excited",
+    "assured": "confident",
+    "certain": "confident",
+    "resolute": "determined",
+    "focused": "determined",
+    "inquisitive": "curious",
+    "interested": "curious",
+    "fascinated": "intrigued",
+    "contemplative": "thoughtful",
+    "pensive": "thoughtful",
+    "reflective": "thoughtful",
+    "analytical": "thoughtful",
+    "doubtful": "skeptical",
+    "unconvinced": "skeptical",
+    "wary": "suspicious",
+    "distrustful": "suspicious",
+    "puzzled": "confused",
+    "perplexed": "confused",
+    "uncertain": "confused",
+    "unsure": "confused",
+    "indifferent": "bored",
+    "uninterested": "bored",
+    "sleepy": "tired",
+    "weary": "tired",
+    "exhausted": "tired",
+    "restless": "impatient",
+    "irritated": "annoyed",
+    "frustrated": "annoyed",
+    "exasperated": "annoyed",
+    "grouchy": "grumpy",
+    "cranky": "grumpy",
+    "furious": "angry",
+    "mad": "angry",
+    "indignant": "outraged",
+    "appalled": "disgusted",
+    "melancholy": "sad",
+    "disappointed": "sad",
+    "concerned": "worried",
+    "troubled": "worried",
+    "uneasy": "anxious",
+    "tense": "nervous",
+    "surprised": "shocked",
+    "astonished": "shocked",
+    "stunned": "shocked",
+    "relaxed": "calm",
+    "composed": "calm",
+    "serene": "calm",
+    "stoic": "calm",
+    "solemn": "serious",
+    "grave": "serious",
+    "honorable": "stern",
+    "disciplined": "stern",
+    "proud": "smug",
+    "compassionate": "sympathetic",
+    "empathetic": "sympathetic",
+}
+
+
+# A mood word shortly after one of these doesn't count, e.g. "not happy" or
+# "not very happy" (which would otherwise get a happy portrait)
+NEGATIONS = {"not", "no", "never", "hardly", "nor", "isn't", "wasn't", "don't", "doesn't"}
+NEGATED_WORDS = 2
+
+
+def normalize_mood(mood):
+    words = []
+    negated = 0
+    for word in re.findall(r"[a-z']+", mood.lower()):
+        if word in NEGATIONS:
+            negated = NEGATED_WORDS
+        elif negated:
+            negated -= 1
+        else:
+            words.append(word.strip("'"))
+    for word in words:
+        if word in MOODS:
+            return word
+        if word in SYNONYMS:
+            return SYNONYMS[word]
+
+    # Catch e.g. "grumpier" or "suspicous"
+    for word in words:
+        matches = difflib.get_close_matches(word, MOODS + list(SYNONYMS), n=1, cutoff=0.7)
+        if matches:
+            return SYNONYMS.get(matches[0], matches[0])
+
+    return "neutral"
+
+
+class PortraitLibrary:
+    """Portraits keyed by (character, normalized mood), persisted in SQLite.
+    The least recently used portraits are evicted beyond `max_portraits`."""
+
+    def __init__(self, path, max_portraits=5000):
+        self.max_portraits = max_portraits
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS portrait (
+                character TEXT NOT NULL,
+                mood TEXT NOT NULL,
+                image_uri TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (character, mood)
+            )"""
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS portrait_accessed_at ON portrait (accessed_at)"
+        )
+        self.conn.commit()
+        # Renders in progress, so concurrent requests for the same portrait
+        # (e.g. from several rooms) only render once
+        self.rendering = {}
+
+    def get(self, character, mood):
+        row = self.conn.execute(
+            "SELECT image_uri FROM portrait WHERE character = ? AND mood = ?",
+            (character, mood),
+        ).fetchone()
+        if row is None:
+            metrics.incr("portraits.misses")
+            return None
+
+        metrics.incr("portraits.hits")
+        self.conn.execute(
+            "UPDATE portrait SET accessed_at = ? WHERE character = ? AND mood = ?",
+            (time.time(), character, mood),
+        )
+        self.conn.commit()
+        return row[0]
+
+    def put(self, character, mood, image_uri):
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO portrait VALUES (?, ?, ?, ?, ?)",
+            (character, mood, image_uri, now, now),
+        )
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM portrait").fetchone()
+        if count > self.max_portraits:
+            self.conn.execute(
+                """DELETE FROM portrait WHERE rowid IN (
+                    SELECT rowid FROM portrait ORDER BY accessed_at LIMIT ?
+                )""",
+                (count - self.max_portraits,),
+            )
+            metrics.incr("portraits.evictions", count - self.max_portraits)
+        self.conn.commit()
+
+    def missing(self, characters):
+        rows = self.conn.execute("SELECT character, mood FROM portrait").fetchall()
+        existing = set(rows)
+        return [(c, m) for m in MOODS for c in characters if (c, m) not in existing]
+
+    async def get_or_render(self, character, mood, render):
+        image_uri = self.get(character, mood)
+        if image_uri:
+            return image_uri
+
+        key = (character, mood)
+        if key not in self.rendering:
+            self.rendering[key] = asyncio.ensure_future(
+                self.render_and_store(character, mood, render)
+            )
+        # Shielded so that a cancelled prewarm still stores the portrait
+        return await asyncio.shield(self.rendering[key])
+
+    async def render_and_store(self, character, mood, render):
+        try:
+            image_uri = await render(character, mood)
+            if image_uri:
+                self.put(character, mood, image_uri)
+            return image_uri
+        finally:
+            del self.rendering[(character, mood)]
+
+    async def prewarm(self, characters, render):
+        """Render missing portraits one by one, in vocabulary order. Meant to
+        be cancelled when there is real work to do."""
+        for character, mood in self.missing(characters):
+            metrics.incr("portraits.prewarmed")
+            await self.get_or_render(character, mood, render)
+
+
+library = None
+
+
+def use_library(path):
+    global library
+    library = PortraitLibrary(path)
@@ -0,0 +1,253 @@
+import asyncio
+import contextlib
+import json
+import sys
+import time
+from collections import defaultdict, deque
+
+import backends
+import client
+import metrics
+from db import state_row
+
+
+def call_key(model, prompt, params):
+    # The cache flag decides where an output comes from, not what it is
+    params = {k: v for k, v in params.items() if k != "cache"}
+    return json.dumps([model, prompt, params], sort_keys=True)
+
+
+class ReplayMismatch(client.PermanentError):
+    """The recording has no usable output for a call"""
+
+
+class Recorder:
+    """Writes every model call and database write of a case to a JSON lines
+    file, in the order they happen."""
+
+    def __init__(self, path, room, seed):
+        self.f = open(path, "w")
+        self.write(
+            {
+                "type": "header",
+                "room": room,
+                "seed": seed,
+                "models": {
+                    "text": backends.text.model,
+                    "chat": backends.chat.model,
+                    "image": backends.image.model,
+                },
+            }
+        )
+
+    def write(self, entry):
+        self.f.write(json.dumps(entry) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class RecordingBackend(backends.Backend):
+    def __init__(self, backend, recorder):
+        self.backend = backend
+        self.model = backend.model
+        self.json_mode = backend.json_mode
+        self.recorder = recorder
+
+    async def generate(self, prompt, **params):
+        with self.recording(prompt, params) as entry:
+            entry["output"] = await self.backend.generate(prompt, **params)
+        return entry["output"]
+
+    async def stream(self, prompt, **params):
+        # Recorded as a single output, replays don't stream
+        with self.recording(prompt, params) as entry:
+            entry["output"] = ""
+            async for chunk in self.backend.stream(prompt, **params):
+                entry["output"] += chunk
+                yield chunk
+
+    @contextlib.contextmanager
+    def recording(self, prompt, params):
+        entry = {
+            "type": "model",
+            "model": self.model,
+            "prompt": prompt,
+            "params": {k: v for k, v in params.items() if k != "cache"},
+        }
+        start = time.monotonic()
+        try:
+            yield entry
+        except asyncio.CancelledError:
+            # E.g. speculative utterances that lost
+            entry.pop("output", None)
+            entry["cancelled"] = True
+            raise
+        except Exception as e:
+            entry.pop("output", None)
+            entry["error"] = str(e)
+            raise
+        finally:
+            entry["seconds"] = time.monotonic() - start
+            self.recorder.write(entry)
+
+
+class RecordingSession:
+    def __init__(self, db, recorder):
+        self.db = db
+        self.room = db.room
+        self.recorder = recorder
+
+    def create_case(self, room):
+        case_id = self.db.create_case(room)
+        self.recorder.write({"type": "db", "method": "create_case", "case_id": case_id})
+        return case_id
+
+    def save_state(self, state):
+        self.db.save_state(state)
+        self.recorder.write({"type": "db", "method": "save_state", "row": state_row(state)})
+
+    def save_draft(self, case_id, speaker, text, done=False):
+        # Depends on timing, so it isn't recorded
+        self.db.save_draft(case_id, speaker, text, done)
+
+    def save_transcript(self, case_id, transcript):
+        self.db.save_transcript(case_id, transcript)
+        self.recorder.write(
+            {"type": "db", "method": "save_transcript", "case_id": case_id, "transcript": transcript}
+        )
+
+    async def load_latest(self, room):
+        return await self.db.load_latest(room)
+
+
+class ReplayLog:
+    def __init__(self, path):
+        with open(path) as f:
+            entries = [json.loads(line) for line in f]
+        self.header = entries[0]
+        self.calls = defaultdict(deque)
+        self.calls_by_model = defaultdict(list)
+        self.db_writes = defaultdict(deque)
+        self.mismatches = defaultdict(int)
+
+        for entry in entries[1:]:
+            if entry["type"] == "model":
+                entry["used"] = False
+                self.calls[call_key(entry["model"], entry["prompt"], entry["params"])].append(entry)
+                self.calls_by_model[entry["model"]].append(entry)
+            elif entry["type"] == "db":
+                self.db_writes[entry["method"]].append(entry)
+
+    def next_call(self, model, prompt, params):
+        queue = self.calls[call_key(model, prompt, params)]
+        while queue:
+            entry = queue.popleft()
+            if not entry["used"]:
+                entry["used"] = True
+                return entry
+
+        # The prompt has changed (e.g. because the code has changed since the
+        # recording), fall back on the next unused output from the same model
+        self.mismatches[model] += 1
+        metrics.incr("replay.prompt_mismatches")
+        for entry in self.calls_by_model[model]:
+            if not entry["used"]:
+                entry["used"] = True
+                return entry
+        raise ReplayMismatch(f"Replay log has run out of {model} outputs")
+
+
+class ReplayBackend(backends.Backend):
+    """Serves recorded outputs. Recorded latencies are multiplied by
+    `latency_scale`, so 0 replays as fast as possible."""
+
+    def __init__(self, log, model, latency_scale=0.0):
+        self.log = log
+        self.model = model
+        self.latency_scale = latency_scale
+
+    async def generate(self, prompt, **params):
+        entry = self.log.next_call(self.model, prompt, params)
+        if self.latency_scale:
+            await asyncio.sleep(entry["seconds"] * self.latency_scale)
+        if entry.get("cancelled"):
+            # The recorded call was cancelled before it returned (e.g. a
+            # speculative utterance that lost), so there is no output to
+            # give. Waiting to be cancelled again would hang any call that
+            # isn't
+            metrics.incr("replay.cancelled_calls")
+            raise ReplayMismatch(f"Recorded {self.model} call was cancelled")
+        if "error" in entry:
+            raise client.ModelError(entry["error"])
+        return entry["output"]
+
+
+class ReplaySession:
+    """Stands in for the database. Writes are compared against the recording
+    and every write that is missing or wasn't recorded counts as a
+    divergence (so a write that changed counts twice)."""
+
+    def __init__(self, log):
+        self.log = log
+        self.room = log.header["room"]
+        self.divergences = 0
+
+    def create_case(self, room):
+        return self.log.db_writes["create_case"].popleft()["case_id"]
+
+    def save_state(self, state):
+        self.check("save_state", "row", json_row(state_row(state)))
+
+    def save_draft(self, case_id, speaker, text, done=False):
+        pass
+
+    def save_transcript(self, case_id, transcript):
+        self.check("save_transcript", "transcript", transcript)
+
+    def check(self, method, key, value):
+        # Matched by content rather than position, so that a single extra or
+        # missing write doesn't shift every later comparison. The recorded
+        # writes that a write skips over are missing
+        queue = self.log.db_writes[method]
+        for i, entry in enumerate(queue):
+            if entry[key] == value:
+                break
+        else:
+            self.diverge(method, "an unexpected write")
+            return
+        for _ in range(i):
+            queue.popleft()
+            self.diverge(method, "a missing write")
+        queue.popleft()
+
+    def finish(self):
+        """Counts the recorded writes that never happened"""
+        for method, queue in self.log.db_writes.items():
+            while queue:
+                queue.popleft()
+                self.diverge(method, "a missing write")
+
+    def diverge(self, method, what):
+        self.divergences += 1
+        metrics.incr("replay.divergences")
+        sys.stderr.write(f"Replay diverged from recording in {method}: {what}\n")
+        sys.stderr.flush()
+
+    async def load_latest(self, room):
+        return None, None, None, None, None
+
+
+def json_row(row):
+    # Compared with rows that have been through JSON
+    return json.loads(json.dumps(row))
+
+
+def use_replay(log, latency_scale=0.0):
+    models = log.header["models"]
+    backends.use(
+        ReplayBackend(log, models["text"], latency_scale),
+        ReplayBackend(log, models["chat"], latency_scale),
+        ReplayBackend(log, models["image"], latency_scale),
+    )
@@ -1,23 +1,110 @@
 import asyncio
-import replicate
+import contextvars
+import sys
+
+import backends
+import client
+import metrics
+import portraits
+
+RENDER_ATTEMPTS = 5
+
+# Set per room to render portraits in the background instead of inline
+image_worker = contextvars.ContextVar("image_worker", default=None)
 
 
 async def make_image(agent) -> str:
-    prompt = f"{agent.name}, {agent.mood}, facing the camera, photo, 1950s, neo noir, hyper-realism, kodachrome"
-
-    loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(None, make_image_sync, prompt)
-    return result
-
-
-def make_image_sync(prompt, attempt=0) -> str:
-    try:
-        output = replicate.run(
-            "stability-ai/sdxl:a00d0b7dcbb9c3fbb34ba87d2d5b46c56969c84a628bf778a7fdaec30b1b99c5",
-            input={"prompt": prompt, "negative_prompt": "collage", "width": 512, "height": 1024},
-        )
-        return output[0]
-    except replicate.exceptions.ModelError:
-        if attempt > 3:
+    return await make_portrait(agent.name, agent.mood)
+
+
+async def make_portrait(name, mood) -> str:
+    if portraits.library is None:
+        return await render_portrait(name, mood)
+    return await portraits.library.get_or_render(
+        name, portraits.normalize_mood(mood), render_portrait
+    )
+
+
+async def prewarm_portraits(names):
+    if portraits.library is not None:
+        await portraits.library.prewarm(names, render_portrait)
+
+
+async def render_portrait(name, mood) -> str:
+    """Returns "" if the portrait can't be made, agents then keep their
+    previous one"""
+    prompt = f"{name}, {mood}, facing the camera, photo, 1950s, neo noir, hyper-realism, kodachrome"
+
+    for attempt in range(RENDER_ATTEMPTS):
+        try:
+            metrics.incr("sdxl.calls")
+            return await backends.image.generate(prompt)
+        except client.CircuitOpenError:
+            # Portraits are optional, don't wait for SDXL to recover
+            metrics.incr("degraded.skipped_portraits")
             return ""
-        return make_image_sync(prompt, attempt + 1)
+        except client.PermanentError as e:
+            sys.stderr.write(f"Failed to render portrait of {name}: {e}\n")
+            sys.stderr.flush()
+            return ""
+        except Exception as e:
+            if attempt == RENDER_ATTEMPTS - 1:
+                sys.stderr.write(f"Failed to render portrait of {name}: {e}\n")
+                sys.stderr.flush()
+                return ""
+            await asyncio.sleep(client.retry_delay(e, attempt))
+
+
+async def update_image(agent):
+    worker = image_worker.get()
+    if worker is None:
+        agent.image_uri = await make_image(agent) or agent.image_uri
+    else:
+        worker.request(agent)
+
+
+class ImageWorker:
+    """Renders portraits in the background. Only the latest request per agent
+    is kept, so moods that have already changed again are never rendered.
+    `on_ready` is called after a portrait has been attached to its agent."""
+
+    def __init__(self, on_ready, concurrency=2):
+        self.on_ready = on_ready
+        self.concurrency = concurrency
+        self.pending = {}
+        self.queue = asyncio.Queue()
+
+    def request(self, agent):
+        if agent.name in self.pending:
+            metrics.incr("images.dropped_stale")
+        else:
+            self.queue.put_nowait(agent.name)
+        self.pending[agent.name] = (agent, agent.mood)
+        metrics.gauge("images.queue_depth", len(self.pending))
+
+    async def run(self):
+        while True:
+            name = await self.queue.get()
+            try:
+                agent, mood = self.pending.pop(name)
+                metrics.gauge("images.queue_depth", len(self.pending))
+                try:
+                    image_uri = await make_portrait(agent.name, mood)
+                except Exception as e:
+                    sys.stderr.write(f"Failed to make image: {e}\n")
+                    sys.stderr.flush()
+                    continue
+                if not image_uri:
+                    continue
+                if agent.mood != mood:
+                    # The mood changed while rendering, a new request is
+                    # already on its way
+                    metrics.incr("images.dropped_stale")
+                    continue
+                agent.image_uri = image_uri
+                self.on_ready()
+            finally:
+                self.queue.task_done()
+
+    async def join(self):
+        await self.queue.join()
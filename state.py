@@ -1,3 +1,5 @@
+import asyncio
+
 INITIAL_EVIDENCE = "The court is being assembled..."
 DELIBERATION_EVIDENCE = "The jury now goes into deliberation..."
 
@@ -21,6 +23,10 @@ class State:
         self.verdict = verdict
         self.transcript = transcript
         self.num_deliberation_steps = 0  # no big deal if this state is lost
+        # With SHARED_CASE_SUMMARY, the summary that every juror has a copy of
+        self.case_summary = None
+        # Set when something (e.g. a portrait) has changed outside of a step
+        self.needs_save = False
 
     @classmethod
     async def load(cls, db, room):
@@ -95,16 +101,21 @@ class State:
         return speaker.latest_utterance
 
     def save(self):
+        self.needs_save = False
         self.db.save_state(self)
 
     def save_transcript(self, transcript):
         self.db.save_transcript(self.case_id, transcript)
 
-    def reset_with_new_case(self):
-        case_id = self.db.create_case(self.room)
+    def save_draft(self, speaker, text, done=False):
+        self.db.save_draft(self.case_id, speaker.name, text, done)
+
+    async def reset_with_new_case(self):
+        case_id = await asyncio.to_thread(self.db.create_case, self.room)
         self.case_id = case_id
         self.evidence = None
         self.agents = None
         self.verdict = None
         self.transcript = None
         self.num_deliberation_steps = 0
+        self.case_summary = None
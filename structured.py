@@ -0,0 +1,243 @@
+import bisect
+import copy
+import functools
+import json
+import re
+
+import backends
+
+# A label at the start of a line (possibly in bold or as a heading). A value
+# runs until the next line that starts with one of the schema's labels
+LABEL = re.compile(r"^[*# ]*([A-Z][A-Z_ ]*):", re.MULTILINE)
+
+NUMBER_WORDS = {
+    "zero": 0,
+    "none": 0,
+    "no": 0,
+    "ten": 10,
+    "twenty": 20,
+    "thirty": 30,
+    "forty": 40,
+    "fifty": 50,
+    "half": 50,
+    "sixty": 60,
+    "seventy": 70,
+    "eighty": 80,
+    "ninety": 90,
+    "hundred": 100,
+    "certain": 100,
+}
+
+
+def fuzzy_percent(s):
+    # Remove unnecessary white spaces
+    s = s.strip()
+
+    # Use a regular expression to search for a number, optionally followed by a percent sign
+    match = re.search(r"\b(\d+(\.\d+)?)%?\b", s)
+    if match:
+        # If a match is found, convert the first group to an integer and return it
+        return int(float(match.group(1)))
+    else:
+        # If no match is found, throw an error
+        raise ValueError()
+
+
+def percent(value):
+    return max(0, min(100, fuzzy_percent(value)))
+
+
+def repair_percent(value):
+    # E.g. "fifty percent" or "I'm certain"
+    for word in re.findall(r"[a-z]+", value.lower()):
+        if word in NUMBER_WORDS:
+            return NUMBER_WORDS[word]
+    raise ValueError()
+
+
+def clean(value):
+    value = value.strip()
+    # Left over from labels in bold, e.g. "**MOOD:** Happy"
+    if value.startswith("**"):
+        value = value[2:].lstrip()
+    if value.endswith("**"):
+        value = value[:-2].rstrip()
+    return value
+
+
+class Field:
+    # Tokens to allow for when asking for just this field
+    max_length = 150
+
+    def __init__(self, name, type=str, repair=None):
+        self.name = name
+        self.type = type
+        self.repair = repair
+
+    def convert(self, value):
+        value = clean(value)
+        try:
+            return self.type(value)
+        except ValueError:
+            if self.repair is None:
+                raise
+            return self.repair(value)
+
+
+class Percent(Field):
+    max_length = 20
+
+    def __init__(self, name):
+        super().__init__(name, percent, repair_percent)
+
+
+class Schema:
+    """The fields of a formatted response. A response is parsed in a single
+    pass over its labels. Declare schemas once (or cache them), not per
+    call. Labels may be qualified by one of `qualifiers`, e.g. "YODA_MOOD"
+    for "MOOD" with the qualifier "YODA"."""
+
+    def __init__(self, fields, qualifiers=()):
+        self.fields = list(fields)
+        self.names = [field.name for field in self.fields]
+        self.name_set = set(self.names)
+        self.qualifiers = tuple(qualifiers)
+
+    def field_name(self, label):
+        label = label.replace(" ", "_")
+        if label in self.name_set:
+            return label
+        for qualifier in self.qualifiers:
+            name = label.removeprefix(qualifier + "_")
+            if name != label and name in self.name_set:
+                return name
+        return None
+
+    def format_prompt(self):
+        if backends.text.json_mode:
+            keys = ", ".join(f'"{name}": ...' for name in self.names)
+            return f"A single JSON object: {{{keys}}}"
+        return "\n\n".join(name + ":" for name in self.names)
+
+    def render(self, values):
+        """Formats parsed values the way the model was asked to"""
+        if backends.text.json_mode:
+            return json.dumps(values)
+        return "\n\n".join(
+            f"{name}: {values[name]}" for name in self.names if name in values
+        )
+
+    def spans(self, text):
+        """Where the value of every field that has been found starts and ends"""
+        # Other lines that look like labels, e.g. "* DNA: found on the glove",
+        # are part of a value
+        labels = [
+            (match, name)
+            for match in LABEL.finditer(text)
+            if (name := self.field_name(match.group(1))) is not None
+        ]
+        boundaries = [match.start() for match, _ in labels]
+        spans = {}
+        for match, name in labels:
+            if name in spans:
+                continue
+            start = match.end()
+            while text.startswith("\n ", start):
+                start += 2
+            i = bisect.bisect_left(boundaries, start)
+            spans[name] = (start, boundaries[i] if i < len(boundaries) else len(text))
+        return spans
+
+    def raw_values(self, text):
+        data = parse_json(text)
+        if data is not None:
+            data = {k.upper(): str(v) for k, v in data.items()}
+            if any(name in data for name in self.names):
+                return data
+        return {name: text[start:end] for name, (start, end) in self.spans(text).items()}
+
+    def parse_fields(self, text):
+        """Returns the values of the fields that could be parsed, and the
+        names of the fields that were missing or couldn't be parsed"""
+        raw = self.raw_values(text)
+        values = {}
+        errors = []
+        for field in self.fields:
+            try:
+                values[field.name] = field.convert(raw[field.name])
+            except (KeyError, ValueError):
+                errors.append(field.name)
+        return values, errors
+
+    def parse(self, text):
+        values, errors = self.parse_fields(text)
+        return None if errors else values
+
+    def check(self, text):
+        """For text that's still being generated. Returns "complete" when all
+        fields are complete, "broken" when a complete field can't be parsed,
+        and None otherwise."""
+        if text.lstrip().startswith(("{", "```")):
+            return "complete" if parse_json(text) is not None else None
+
+        spans = self.spans(text)
+        complete = True
+        for field in self.fields:
+            if field.name not in spans:
+                complete = False
+                continue
+
+            start, end = spans[field.name]
+            value = text[start:end]
+            if end == len(text):
+                # The field runs up to the end of the text so far. Text fields
+                # can contain newlines, so they're complete after an empty line
+                terminator = "\n\n" if field.type is str else "\n"
+                if not value.strip() or not text.endswith(terminator):
+                    complete = False
+                    continue
+
+            try:
+                field.convert(value)
+            except ValueError:
+                return "broken"
+        return "complete" if complete else None
+
+
+def parse_json(text):
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        data = json.loads(text[start : end + 1])
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+@functools.cache
+def prefixed(schema, key):
+    """The same fields with `key` in front, unless they already start with it"""
+    fields = []
+    for field in schema.fields:
+        field = copy.copy(field)
+        if not field.name.startswith(key):
+            field.name = f"{key}_{field.name}"
+        fields.append(field)
+    return Schema(fields)
+
+
+@functools.cache
+def subset(schema, names):
+    return Schema(
+        (field for field in schema.fields if field.name in names), schema.qualifiers
+    )
+
+
+@functools.cache
+def combine(*schemas):
+    return Schema(
+        (field for schema in schemas for field in schema.fields),
+        dict.fromkeys(q for schema in schemas for q in schema.qualifiers),
+    )
@@ -0,0 +1,139 @@
+import asyncio
+import multiprocessing
+import sys
+import time
+
+import metrics
+
+# Workers send their metrics this often. A worker that hasn't been heard from
+# for HEARTBEAT_TIMEOUT seconds (e.g. because its event loop is blocked) is
+# restarted
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 60
+
+# Seconds to wait before restarting a worker, doubled for every crash in a row
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+
+
+async def heartbeat(conn):
+    """Runs inside a worker, next to its courts"""
+    while True:
+        start = time.monotonic()
+        conn.send(metrics.snapshot())
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        # How long the event loop was too busy to wake us up
+        metrics.observe("worker.loop_lag_seconds", time.monotonic() - start - HEARTBEAT_INTERVAL)
+
+
+class Worker:
+    """A process that runs the courts of some of the rooms. `target` is called
+    in the new process as target(rooms, args, conn) and should run
+    `heartbeat(conn)` alongside the courts."""
+
+    def __init__(self, index, rooms, target, args):
+        self.name = f"worker-{index}"
+        self.rooms = rooms
+        self.target = target
+        self.args = args
+        self.process = None
+        self.conn = None
+        self.metrics = None
+        self.started_at = None
+        self.last_heartbeat = None
+        self.restart_at = None
+        self.restarts = 0
+        self.crashes_in_a_row = 0
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(
+            target=self.target,
+            args=(self.rooms, self.args, child_conn),
+            name=self.name,
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.started_at = self.last_heartbeat = time.monotonic()
+        self.restart_at = None
+
+    async def check(self):
+        if self.process is None:
+            if time.monotonic() >= self.restart_at:
+                self.start()
+            return
+
+        try:
+            while self.conn.poll():
+                self.metrics = self.conn.recv()
+                self.last_heartbeat = time.monotonic()
+        except EOFError:
+            pass
+
+        if not self.process.is_alive():
+            await self.restart(f"exited with code {self.process.exitcode}")
+        elif time.monotonic() - self.last_heartbeat > HEARTBEAT_TIMEOUT:
+            await self.restart("stopped responding")
+
+    async def restart(self, reason):
+        """Stop the worker and start it again after a delay. Its courts
+        resume from the latest state in the database."""
+        sys.stderr.write(f"{self.name} ({', '.join(self.rooms)}) {reason}, restarting\n")
+        sys.stderr.flush()
+        await self.stop()
+        if time.monotonic() - self.started_at > MAX_RESTART_DELAY:
+            self.crashes_in_a_row = 0
+        delay = min(RESTART_DELAY * 2**self.crashes_in_a_row, MAX_RESTART_DELAY)
+        self.restart_at = time.monotonic() + delay
+        self.crashes_in_a_row += 1
+        self.restarts += 1
+        metrics.incr("supervisor.restarts")
+
+    async def stop(self, timeout=10):
+        if self.process is None:
+            return
+        # Joined in a thread, so that the other workers are still checked on
+        if self.process.is_alive():
+            # Give the worker a chance to flush its queued state writes
+            self.process.terminate()
+            await asyncio.to_thread(self.process.join, timeout)
+            if self.process.is_alive():
+                self.process.kill()
+        await asyncio.to_thread(self.process.join)
+        self.conn.close()
+        self.process = None
+
+
+def report(workers):
+    for worker in workers:
+        status = f"pid {worker.process.pid}" if worker.process else "restarting"
+        heard = time.monotonic() - worker.last_heartbeat
+        metrics.report(
+            worker.metrics or {"counters": {}, "gauges": {}, "summaries": {}},
+            title=f"{worker.name} ({', '.join(worker.rooms)}): {status}, "
+            f"{worker.restarts} restarts, last heard from {heard:.0f}s ago",
+        )
+
+
+async def supervise(rooms, num_workers, target, args, report_interval=60):
+    """Spread the rooms over `num_workers` processes and keep them running"""
+    num_workers = min(num_workers, len(rooms))
+    workers = [
+        Worker(i, rooms[i::num_workers], target, args) for i in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    last_report = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(1)
+            for worker in workers:
+                await worker.check()
+            if time.monotonic() - last_report > report_interval:
+                report(workers)
+                last_report = time.monotonic()
+    finally:
+        await asyncio.gather(*(worker.stop() for worker in workers))
@@ -0,0 +1,92 @@
+from context import Template
+
+# Set to True to order juror prompts from the content that changes least
+# (the jury, the case, the juror) to the content that changes most (mood,
+# what was just said), so that backends with prefix caching can reuse the
+# start of a prompt across calls and jurors. Set to False for the original
+# order, which puts the juror and their mood first.
+PREFIX_STABLE = True
+
+DESCRIPTION = ("description", "You are {description}. You are a member of a jury in a court case. {phase}")
+JURY = ("jury", "You are a member of a jury in a court case. {phase}")
+PERSONA = ("persona", "You are {description}.")
+MOOD = ("mood", "Your current mood is: {mood}")
+SUMMARY = ("summary", "This is the evidence for and against the defendant:\n{summary}")
+BELIEFS = ("beliefs", "Your current opinions and beliefs about the case are:\n{beliefs}")
+CERTAINTY = (
+    "certainty",
+    "You are currently {guilty}% sure that the defendant is guilty and {innocent}% sure that the defendant is innocent.",
+)
+SENTIMENTS = ("sentiments", "Your current opinions about your fellow jury members are:\n{sentiments}")
+PREVIOUS_UTTERANCE = ("previous_utterance", "{previous_utterance}")
+
+HEAR_COURT = [
+    ("utterance", "The court says:\n{utterance}"),
+    (
+        "instructions",
+        "You are {description}, in your own distinctive tone of voice, describe your {summary_request}mood (one word), beliefs (several bullet points in the voice of {name}), and certainty of guilt and innocence (percentages) in the following format::\n{format}",
+    ),
+]
+HEAR_SPEAKER = [
+    ("utterance", "{speaker} says: {utterance}"),
+    (
+        "instructions",
+        "You are {description}, given your previous beliefs and what {speaker} said, in your own distinctive voice, describe your updated mood (one word), new beliefs (several bullet points in the voice of {name}), updated certainty of guilt and innocence (percentages), and updated opinion about the speaker {speaker}'s views in relation to your own beliefs (concise) in the following format (do not output anything else):\n{format}",
+    ),
+]
+DECIDE_TO_SPEAK = [
+    PREVIOUS_UTTERANCE,
+    (
+        "instructions",
+        "How eager are you to speak? Reply as a percentage in the following format:\n\n{format}\n",
+    ),
+]
+SAY_REPLY = [
+    PREVIOUS_UTTERANCE,
+    (
+        "instructions",
+        "You are {name}. In your distinctive voice argue your evidence-based opinion in reply to {speaker} in a single short sentence.",
+    ),
+]
+SAY_OPENING = [
+    PREVIOUS_UTTERANCE,
+    (
+        "instructions",
+        "You are {name}. Try to convince the jury about your opinions in your distinctive voice. Be brief (one or two sentences). Argue for your beliefs mentioning specific evidence.",
+    ),
+]
+
+ORIGINAL = {
+    "hear_court": Template(
+        "hear", [DESCRIPTION, MOOD, SUMMARY, BELIEFS, CERTAINTY, *HEAR_COURT]
+    ),
+    "hear_speaker": Template(
+        "hear", [DESCRIPTION, MOOD, SENTIMENTS, SUMMARY, BELIEFS, CERTAINTY, *HEAR_SPEAKER]
+    ),
+    "decide_to_speak": Template(
+        "decide_to_speak",
+        [DESCRIPTION, MOOD, SUMMARY, BELIEFS, CERTAINTY, SENTIMENTS, *DECIDE_TO_SPEAK],
+    ),
+    "say_reply": Template(
+        "say", [DESCRIPTION, MOOD, SENTIMENTS, SUMMARY, BELIEFS, CERTAINTY, *SAY_REPLY]
+    ),
+    "say_opening": Template(
+        "say", [DESCRIPTION, MOOD, SENTIMENTS, SUMMARY, BELIEFS, CERTAINTY, *SAY_OPENING]
+    ),
+}
+
+# Every juror prompt starts the same way up to the mood
+STABLE_PREFIX = [JURY, SUMMARY, PERSONA, BELIEFS, CERTAINTY]
+STABLE = {
+    "hear_court": Template("hear", [*STABLE_PREFIX, MOOD, *HEAR_COURT]),
+    "hear_speaker": Template("hear", [*STABLE_PREFIX, SENTIMENTS, MOOD, *HEAR_SPEAKER]),
+    "decide_to_speak": Template(
+        "decide_to_speak", [*STABLE_PREFIX, SENTIMENTS, MOOD, *DECIDE_TO_SPEAK]
+    ),
+    "say_reply": Template("say", [*STABLE_PREFIX, SENTIMENTS, MOOD, *SAY_REPLY]),
+    "say_opening": Template("say", [*STABLE_PREFIX, SENTIMENTS, MOOD, *SAY_OPENING]),
+}
+
+
+def get(name):
+    return (STABLE if PREFIX_STABLE else ORIGINAL)[name]
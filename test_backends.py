@@ -0,0 +1,103 @@
+import asyncio
+import statistics
+
+import pytest
+
+import backends
+import client
+from backends import FakeImage, FakeText
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Records how long fake calls sleep for, without sleeping"""
+    sleeps = []
+    sleep = asyncio.sleep
+
+    async def record(seconds):
+        sleeps.append(seconds)
+        await sleep(0)
+
+    monkeypatch.setattr(backends.asyncio, "sleep", record)
+    return sleeps
+
+
+def fake(backend_class, **kwargs):
+    backend = backend_class(seed=1, **kwargs)
+    backend.limiter = client.Limiter("test", 100)
+    return backend
+
+
+def test_fake_latency(sleeps):
+    backend = fake(FakeText, latency=2.0)
+
+    async def run():
+        for _ in range(200):
+            await backend.generate("Hi")
+
+    asyncio.run(run())
+    assert len(sleeps) == 200
+    assert 1.8 < statistics.median(sleeps) < 2.2
+    assert min(sleeps) < 1 and max(sleeps) > 4
+
+    # Streamed, the first word comes after a tenth of the latency and the
+    # others are spread over the rest
+    sleeps.clear()
+
+    async def chunks():
+        return [chunk async for chunk in backend.stream("MOOD:\n\nBELIEFS:")]
+
+    words = asyncio.run(chunks())
+    assert "".join(words).startswith("MOOD: ")
+    assert len(sleeps) == len(words)
+    assert sleeps[1:] == [pytest.approx(sleeps[0] * 9 / len(words))] * (len(words) - 1)
+
+
+def test_fake_failures(sleeps):
+    backend = fake(FakeImage, failure_rate=0.3)
+
+    async def run():
+        results = await asyncio.gather(
+            *(backend.generate(f"Yoda {i}") for i in range(200)), return_exceptions=True
+        )
+        return [result for result in results if isinstance(result, client.ModelError)]
+
+    failures = asyncio.run(run())
+    assert 40 < len(failures) < 80
+    assert backend.running == 0
+    assert backend.limiter.in_flight == 0
+
+
+def test_fake_capacity(sleeps):
+    backend = fake(FakeText, latency=1.0, latency_sigma=0, capacity=2)
+
+    async def run():
+        return await asyncio.gather(
+            *(backend.generate("Hi") for _ in range(8)), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    # Beyond capacity, calls are slowed down or rate limited
+    assert sleeps[:2] == [1.0, 1.0]
+    assert max(sleeps) > 1
+    assert any(isinstance(result, client.ModelError) for result in results)
+    assert backend.running == 0
+
+
+def test_fake_formatted_response():
+    backend = fake(FakeText, malformed_rate=0.5)
+    prompt = "Answer in the following format:\nYODA_MOOD:\n\nYODA_GUILTY_PERCENTAGE:\n\nYODA_INNOCENT_PERCENTAGE:"
+    outputs = [backend.respond(prompt) for _ in range(50)]
+
+    for output in outputs:
+        values = dict(line.split(": ") for line in output.split("\n\n"))
+        assert values["YODA_MOOD"] in backends.FAKE_MOODS
+        if "YODA_INNOCENT_PERCENTAGE" in values:
+            guilty = int(values["YODA_GUILTY_PERCENTAGE"].rstrip("%"))
+            assert values["YODA_INNOCENT_PERCENTAGE"] == f"{100 - guilty}%"
+    # Malformed responses miss the last field
+    assert 10 < sum("INNOCENT" not in output for output in outputs) < 40
+    assert backends.requested_fields('A single JSON object: {"MOOD": ..., "BELIEFS": ...}') == (
+        ["MOOD", "BELIEFS"],
+        True,
+    )
@@ -0,0 +1,104 @@
+import asyncio
+import contextlib
+import time
+
+import backends
+from cache import Cache, CachedBackend
+
+
+class CountingBackend(backends.Backend):
+    model = "counting"
+
+    def __init__(self):
+        self.calls = 0
+
+    async def generate(self, prompt, **params):
+        self.calls += 1
+        return f"{prompt} {self.calls}"
+
+    async def stream(self, prompt, **params):
+        for word in (await self.generate(prompt, **params)).split(" "):
+            yield word + " "
+
+
+def test_expiry(tmp_path, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache = Cache(tmp_path / "cache.db", ttl=60)
+    cache.put("a", "A")
+    assert cache.get("a") == "A"
+
+    now += 61
+    assert cache.get("a") is None
+
+    # Expired entries are dropped on the next write
+    cache.put("b", "B")
+    assert cache.conn.execute("SELECT key FROM cache").fetchall() == [("b",)]
+    assert cache.size == len("bB")
+
+
+def test_eviction_order(tmp_path, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache = Cache(tmp_path / "cache.db", max_bytes=3 * len("aA"))
+    for key in "abc":
+        now += 1
+        cache.put(key, key.upper())
+
+    # Reading "a" makes "b" the least recently used
+    now += 1
+    assert cache.get("a") == "A"
+    now += 1
+    cache.put("d", "D")
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["A", "C", "D"]
+    assert cache.size == 3 * len("aA")
+
+    # Sizes survive reopening the cache
+    assert Cache(tmp_path / "cache.db").size == cache.size
+
+
+def test_cached_backend(tmp_path):
+    backend = CountingBackend()
+    cached = CachedBackend(backend, Cache(tmp_path / "cache.db"))
+
+    async def run():
+        assert await cached.generate("Hi") == "Hi 1"
+        assert await cached.generate("Hi") == "Hi 1"
+        assert await cached.generate("Hi", max_length=10) == "Hi 2"
+        assert await cached.generate("Hi", cache=False) == "Hi 3"
+        assert await cached.generate("Hi") == "Hi 1"
+        assert await cached.generate("Hi", cache="refresh") == "Hi 4"
+        assert await cached.generate("Hi") == "Hi 4"
+
+    asyncio.run(run())
+    assert backend.calls == 4
+
+
+def test_cached_stream(tmp_path):
+    backend = CountingBackend()
+    cached = CachedBackend(backend, Cache(tmp_path / "cache.db"))
+
+    async def read(prompt, count=None, **params):
+        chunks = []
+        async with contextlib.aclosing(cached.stream(prompt, **params)) as stream:
+            async for chunk in stream:
+                chunks.append(chunk)
+                if len(chunks) == count:
+                    break
+        return chunks
+
+    async def run():
+        # Misses are streamed, hits come at once
+        assert await read("Hi") == ["Hi ", "1 "]
+        assert await read("Hi") == ["Hi 1 "]
+        assert await read("Hi", cache=False) == ["Hi ", "2 "]
+        assert await read("Hi", cache="refresh") == ["Hi ", "3 "]
+        assert await cached.generate("Hi") == "Hi 3 "
+
+        # What was read before stopping early is cached
+        assert await read("Hey there", count=2) == ["Hey ", "there "]
+        assert await read("Hey there") == ["Hey there "]
+
+    asyncio.run(run())
+    assert backend.calls == 4
@@ -0,0 +1,319 @@
+import asyncio
+import contextlib
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import client
+
+
+async def acquire_in_order(limiter, requests):
+    order = []
+
+    async def call(name, level, room):
+        client.current_room.set(room)
+        with client.prioritized(level):
+            async with limiter.slot(10):
+                order.append(name)
+
+    async with limiter.slot():
+        tasks = [asyncio.create_task(call(*request)) for request in requests]
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_limiter_priorities():
+    limiter = client.Limiter("test", 1)
+    order = asyncio.run(
+        acquire_in_order(
+            limiter,
+            [
+                ("preconception", client.SETUP, "A"),
+                ("eagerness", client.SPEAKER_SELECTION, "A"),
+                ("utterance", client.VISIBLE, "A"),
+                ("sentiment", client.SENTIMENT, "A"),
+            ],
+        )
+    )
+    assert order == ["utterance", "sentiment", "eagerness", "preconception"]
+
+
+def test_promotable():
+    async def run(promote):
+        limiter = client.Limiter("test", 1)
+        speculation = client.Promotable(client.SPEAKER_SELECTION)
+        order = []
+
+        async def call(name, level):
+            with client.prioritized(level):
+                async with limiter.slot():
+                    order.append(name)
+
+        async def speculate():
+            with speculation:
+                await call("utterance", client.VISIBLE)
+
+        async with limiter.slot():
+            tasks = [
+                asyncio.create_task(speculate()),
+                asyncio.create_task(call("sentiment", client.SENTIMENT)),
+                asyncio.create_task(call("eagerness", client.SPEAKER_SELECTION)),
+            ]
+            await asyncio.sleep(0)
+            if promote:
+                speculation.promote()
+        await asyncio.gather(*tasks)
+        assert not speculation.waiting
+        return order
+
+    assert asyncio.run(run(promote=False)) == ["sentiment", "utterance", "eagerness"]
+    assert asyncio.run(run(promote=True)) == ["utterance", "sentiment", "eagerness"]
+
+
+def test_limiter_shares_between_rooms():
+    limiter = client.Limiter("test", 1)
+    order = asyncio.run(
+        acquire_in_order(
+            limiter,
+            [
+                ("A1", client.SENTIMENT, "A"),
+                ("A2", client.SENTIMENT, "A"),
+                ("A3", client.SENTIMENT, "A"),
+                ("B1", client.SENTIMENT, "B"),
+                ("B2", client.SENTIMENT, "B"),
+            ],
+        )
+    )
+    assert order == ["A1", "B1", "A2", "B2", "A3"]
+
+
+def test_server_sent_events():
+    async def lines():
+        for line in [
+            b"event: output\n",
+            b"data: Hello\n",
+            b"\n",
+            b"event: output\n",
+            b"data:  world\n",
+            b"data: again\n",
+            b"\n",
+            b"event: done\n",
+            b"data: {}\n",
+            b"\n",
+        ]:
+            yield line
+
+    async def collect():
+        return [event async for event in client.server_sent_events(lines())]
+
+    assert asyncio.run(collect()) == [
+        ("output", "Hello"),
+        ("output", " world\nagain"),
+        ("done", "{}"),
+    ]
+
+
+async def call(limiter, fail=False):
+    async with limiter.slot():
+        if fail:
+            raise client.ModelError("Rate limited")
+
+
+def test_circuit_breaker():
+    limiter = client.Limiter("test", 4)
+    limiter.breaker.max_failures = 2
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(client.ModelError):
+                await call(limiter, fail=True)
+        with pytest.raises(client.CircuitOpenError):
+            await call(limiter)
+        assert not limiter.breaker.closed
+
+        # A single call may probe once the breaker has been open long enough
+        limiter.breaker.opened_at -= limiter.breaker.reset_seconds
+        assert limiter.breaker.check()
+        with pytest.raises(client.CircuitOpenError):
+            limiter.breaker.check()
+        limiter.breaker.probing = False
+        await call(limiter)
+        assert limiter.breaker.closed
+
+    asyncio.run(run())
+
+
+def test_adaptive_concurrency(monkeypatch):
+    now = 100.0
+    monkeypatch.setattr(client.time, "monotonic", lambda: now)
+    monkeypatch.setattr(client, "ADAPTIVE_CONCURRENCY", True)
+    limiter = client.Limiter("test", 8)
+
+    limiter.success(1.0)
+    limiter.failure()
+    assert limiter.limit == 4
+    # Calls that were already in flight fail too, but only halve it once
+    now += 0.5
+    limiter.failure()
+    assert limiter.limit == 4
+
+    now += 1
+    limiter.success(1.0)
+    assert limiter.limit == 4.25
+
+    # Calls that get much slower than usual count as failures, once the
+    # average latency has caught up with them
+    for _ in range(2):
+        now += 10
+        limiter.success(10.0)
+    assert limiter.limit > 4.25
+    limit = limiter.limit
+    now += 10
+    limiter.success(10.0)
+    assert limiter.limit == limit / 2
+
+
+class FakeReplicate:
+    """Serves a single prediction that goes through `statuses` as it's
+    polled, and streams `events`. Creating it fails with `error_status`."""
+
+    def __init__(self, statuses=(), events=(), error_status=None):
+        self.statuses = list(statuses)
+        self.events = list(events)
+        self.error_status = error_status
+        self.inputs = []
+        self.cancelled = asyncio.Event()
+
+        self.app = web.Application()
+        self.app.router.add_post("/v1/predictions", self.create)
+        self.app.router.add_get("/v1/predictions/p1", self.get)
+        self.app.router.add_get("/v1/predictions/p1/stream", self.stream)
+        self.app.router.add_post("/v1/predictions/p1/cancel", self.cancel)
+
+    async def create(self, request):
+        assert request.headers["Authorization"] == "Token r8_test"
+        if self.error_status is not None:
+            return web.json_response({"detail": "Nope"}, status=self.error_status)
+        self.inputs.append(await request.json())
+        return web.json_response(self.prediction(request, {"status": "starting"}))
+
+    async def get(self, request):
+        return web.json_response(self.prediction(request, self.statuses.pop(0)))
+
+    def prediction(self, request, status):
+        url = str(request.url.with_path("/v1/predictions/p1"))
+        urls = {"get": url, "stream": url + "/stream", "cancel": url + "/cancel"}
+        return {"id": "p1", "urls": urls, **status}
+
+    async def stream(self, request):
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for event, data in self.events:
+            lines = "".join(f"data: {line}\r\n" for line in data.split("\n"))
+            await resp.write(f"event: {event}\r\n{lines}\r\n".encode())
+        # Like a prediction that is still running
+        await self.cancelled.wait()
+        return resp
+
+    async def cancel(self, request):
+        self.cancelled.set()
+        return web.json_response({})
+
+
+@contextlib.asynccontextmanager
+async def serving(replicate, monkeypatch):
+    server = TestServer(replicate.app)
+    await server.start_server()
+    monkeypatch.setenv("REPLICATE_API_TOKEN", "r8_test")
+    monkeypatch.setattr(client, "REPLICATE_API_URL", str(server.make_url("/v1")))
+    monkeypatch.setattr(client, "POLL_INTERVAL", 0)
+    monkeypatch.setattr(client, "_session", None)
+    try:
+        yield
+    finally:
+        await client.close()
+        await server.close()
+
+
+def test_replicate_run(monkeypatch):
+    replicate = FakeReplicate(
+        statuses=[
+            {"status": "processing"},
+            {"status": "succeeded", "output": ["Hello", " world"]},
+        ]
+    )
+    limiter = client.Limiter("test", 1)
+
+    async def run():
+        async with serving(replicate, monkeypatch):
+            output = await client.replicate_run("meta/llama:v1", {"prompt": "Hi"}, limiter)
+        assert output == ["Hello", " world"]
+
+    asyncio.run(run())
+    assert replicate.inputs == [{"version": "v1", "input": {"prompt": "Hi"}}]
+    assert limiter.latency is not None and limiter.breaker.failures == 0
+
+
+def test_replicate_run_errors(monkeypatch):
+    limiter = client.Limiter("test", 1)
+
+    async def run():
+        replicate = FakeReplicate(statuses=[{"status": "failed", "error": "Out of memory"}])
+        async with serving(replicate, monkeypatch):
+            with pytest.raises(client.ModelError, match="Out of memory"):
+                await client.replicate_run("meta/llama:v1", {}, limiter)
+
+        replicate = FakeReplicate(error_status=429)
+        async with serving(replicate, monkeypatch):
+            with pytest.raises(aiohttp.ClientResponseError):
+                await client.replicate_run("meta/llama:v1", {}, limiter)
+
+    asyncio.run(run())
+    # Both count against the backend
+    assert limiter.breaker.failures == 2
+    assert limiter.in_flight == 0
+
+
+def test_replicate_stream(monkeypatch):
+    limiter = client.Limiter("test", 1)
+
+    async def collect(events, count=None):
+        replicate = FakeReplicate(events=events)
+        chunks = []
+        async with serving(replicate, monkeypatch):
+            stream = client.replicate_stream("meta/llama:v1", {}, limiter)
+            async with contextlib.aclosing(stream):
+                async for chunk in stream:
+                    chunks.append(chunk)
+                    if len(chunks) == count:
+                        break
+            if count is not None:
+                # Stopping early cancels the prediction
+                await asyncio.wait_for(replicate.cancelled.wait(), 5)
+        assert replicate.inputs[0]["stream"]
+        return chunks
+
+    async def run():
+        events = [("output", "Hello"), ("output", " world\nagain"), ("done", "{}")]
+        assert await collect(events) == ["Hello", " world\nagain"]
+        assert await collect(events[:2], count=1) == ["Hello"]
+        with pytest.raises(client.ModelError, match="Broken"):
+            await collect([("output", "Hello"), ("error", "Broken")])
+
+    asyncio.run(run())
+    assert limiter.breaker.failures == 1
+    assert limiter.in_flight == 0
+
+
+def test_retry_delay(monkeypatch):
+    monkeypatch.setattr(client.backoff_random, "uniform", lambda low, high: high)
+    assert [client.retry_delay(client.ModelError(), attempt) for attempt in range(7)] == [
+        1, 2, 4, 8, 16, 30, 30
+    ]
+    # Not before the circuit breaker lets calls through again
+    error = client.CircuitOpenError("llama", 20)
+    assert client.retry_delay(error, 0) == 20
+    assert client.retry_delay(error, 5) == 30
@@ -0,0 +1,53 @@
+import context
+import templates
+from agent import Agent
+from backends import common_prefix
+from context import Prompt, Template, keep_last
+
+
+def test_prompt_within_budget():
+    prompt = Prompt("test")
+    prompt.add("description", "You are a juror.")
+    prompt.add("summary", "* a\n* b", header="Summary:\n", trimmable=True)
+    prompt.add("instructions", "Say something.")
+    assert prompt.render() == "You are a juror.\n\nSummary:\n* a\n* b\n\nSay something."
+
+
+def test_prompt_trims_oldest_lines(monkeypatch):
+    monkeypatch.setattr(context, "PROMPT_BUDGET", 40)
+    summary = "\n".join(f"* Point number {i}" for i in range(10))
+    prompt = Prompt("test")
+    prompt.add("description", "You are a juror.")
+    prompt.add("summary", summary, header="Summary:\n", trimmable=True)
+    prompt.add("beliefs", "* Guilty", header="Beliefs:\n", trimmable=True)
+    text = prompt.render()
+    assert len(text) <= 40 * 4
+    assert "* Point number 9" in text
+    assert "* Point number 0" not in text
+    assert text.startswith("You are a juror.\n\nSummary:\n")
+    assert text.endswith("Beliefs:\n* Guilty")
+
+
+def test_keep_last():
+    assert keep_last("* one\n* two\n* three", 3) == "* three"
+    assert keep_last("* one\n* two\n* three", 100) == "* one\n* two\n* three"
+
+
+def test_template_trims_only_the_field():
+    template = Template("test", [("summary", "Summary:\n{summary}"), ("mood", "Mood: {mood}")])
+    assert template.render(summary="* a\n* b", mood="Calm") == "Summary:\n* a\n* b\n\nMood: Calm"
+
+
+def test_stable_prefix(monkeypatch):
+    monkeypatch.setattr(templates, "PREFIX_STABLE", True)
+    values = Agent("Yoda", "The wise Yoda", mood="Calm").prompt_values(True)
+    values["previous_utterance"] = ""
+    decide = templates.get("decide_to_speak").render(**values, format="SPEAK_EAGERNESS:")
+    say = templates.get("say_opening").render(**values)
+    other = Agent("Worf", "Lieutenant Worf", mood="Angry").prompt_values(True)
+    other["previous_utterance"] = ""
+
+    # Everything up to the instructions is shared by the same juror, the jury
+    # and the case by all jurors
+    assert common_prefix(decide, say) == decide.index("How eager")
+    assert common_prefix(say, templates.get("say_opening").render(**other)) == say.index("The wise Yoda")
@@ -0,0 +1,328 @@
+import asyncio
+import copy
+import itertools
+import threading
+import time
+
+import pytest
+
+from agent import Agent
+import db
+from db import SQLiteSession, StateLog, WriteBehindSession, apply_delta, merge_records, state_row
+
+
+class FakeState:
+    def __init__(self, agents):
+        self.case_id = 1
+        self.room = "A"
+        self.evidence = "The court is being assembled..."
+        self.verdict = None
+        self.agents = agents
+        self.case_summary = None
+
+
+def test_state_log(monkeypatch):
+    monkeypatch.setattr(db, "STATE_EVENTS", True)
+    state = FakeState([Agent("Yoda", "The Jedi master"), Agent("Worf", "The Klingon")])
+    log = StateLog()
+
+    kind, snapshot = log.record(state)
+    assert kind == "snapshot"
+    assert snapshot["agents"][0]["name"] == "Yoda"
+
+    assert log.record(state) is None
+
+    state.evidence = "Exhibit A"
+    state.agents[0].mood = "Calm"
+    state.agents[1].set_agent_sentiment("Yoda", "Small")
+    kind, event = log.record(state)
+    assert kind == "event"
+    assert event["delta"] == {
+        "evidence": "Exhibit A",
+        "agents": {
+            "Yoda": {"mood": "Calm"},
+            "Worf": {"agent_sentiments": {"Yoda": "Small"}},
+        },
+    }
+
+    state.agents[1].guilty_percent = 90
+    second = log.record(state)
+    assert second[1]["delta"] == {"agents": {"Worf": {"guilty_percent": 90}}}
+
+    row = copy.deepcopy(snapshot)
+    apply_delta(row, event["delta"])
+    apply_delta(row, second[1]["delta"])
+    assert {k: v for k, v in row.items() if k != "seq"} == state_row(state)
+
+    kind, merged = merge_records(("snapshot", snapshot), ("event", event))
+    assert kind == "snapshot"
+    assert merged["evidence"] == "Exhibit A"
+    assert merged["seq"] == event["seq"]
+
+
+def test_state_log_snapshots_new_cases():
+    state = FakeState([Agent("Yoda", "The Jedi master")])
+    log = StateLog()
+    assert log.record(state)[0] == "snapshot"
+    state.case_id = 2
+    assert log.record(state)[0] == "snapshot"
+
+
+def test_state_log_stores_case_summary_once(monkeypatch):
+    monkeypatch.setattr(db, "STATE_EVENTS", True)
+    state = FakeState([Agent("Yoda", "The Jedi master"), Agent("Worf", "The Klingon")])
+    log = StateLog()
+    _, snapshot = log.record(state)
+
+    state.case_summary = "* The defendant was seen at the scene"
+    for agent in state.agents:
+        agent.summary = state.case_summary
+    state.agents[0].mood = "Calm"
+    _, event = log.record(state)
+    assert event["delta"] == {
+        "case_summary": "* The defendant was seen at the scene",
+        "agents": {"Yoda": {"mood": "Calm"}},
+    }
+
+    apply_delta(snapshot, event["delta"])
+    assert {k: v for k, v in snapshot.items() if k != "seq"} == state_row(state)
+
+
+def test_state_log_without_events():
+    state = FakeState([Agent("Yoda", "The Jedi master")])
+    log = StateLog()
+    assert log.record(state)[0] == "snapshot"
+    assert log.record(state) is None
+    state.agents[0].mood = "Calm"
+    kind, row = log.record(state)
+    assert kind == "snapshot"
+    assert row["agents"][0]["mood"] == "Calm"
+
+
+def test_sqlite_session(tmp_path):
+    path = str(tmp_path / "llama_jury.db")
+    db = SQLiteSession("A", path)
+    assert asyncio.run(db.load_latest("A")) == (None, None, None, None, None)
+
+    state = FakeState([Agent("Yoda", "The Jedi master"), Agent("Worf", "The Klingon")])
+    state.case_id = db.create_case("A")
+    db.save_transcript(state.case_id, "Exhibit A\n\nExhibit B")
+    db.save_state(state)
+    state.evidence = "Exhibit A"
+    state.agents[1].set_agent_sentiment("Yoda", "Small")
+    db.save_state(state)
+    state.agents[0].guilty_percent = 90
+    db.save_state(state)
+
+    # A new session, like after a restart
+    case_id, agents, evidence, verdict, transcript = asyncio.run(
+        SQLiteSession("A", path).load_latest("A")
+    )
+    assert case_id == state.case_id
+    assert agents == state.agents
+    assert evidence == "Exhibit A"
+    assert verdict is None
+    assert transcript == "Exhibit A\n\nExhibit B"
+
+
+class BlockingSession:
+    """Records writes, which block until `release` is set"""
+
+    def __init__(self, room, release, in_flight):
+        self.room = room
+        self.state_log = StateLog()
+        self.release = release
+        self.in_flight = in_flight
+        self.writes = []
+
+    def write(self, kind, args):
+        with self.in_flight["lock"]:
+            self.in_flight["now"] += 1
+            self.in_flight["max"] = max(self.in_flight["max"], self.in_flight["now"])
+        self.release.wait(timeout=5)
+        time.sleep(0.01)
+        with self.in_flight["lock"]:
+            self.in_flight["now"] -= 1
+        self.writes.append((kind, args))
+
+    def insert_state_record(self, kind, row):
+        self.write(kind, copy.deepcopy(row))
+
+    def save_draft(self, *args):
+        self.write("draft", args)
+
+    def save_transcript(self, *args):
+        self.write("transcript", args)
+
+
+def blocking_session(room="A"):
+    in_flight = {"lock": threading.Lock(), "now": 0, "max": 0}
+    return BlockingSession(room, threading.Event(), in_flight)
+
+
+def test_write_behind_merges_queued_records(monkeypatch):
+    monkeypatch.setattr(db, "STATE_EVENTS", True)
+    monkeypatch.setattr(WriteBehindSession, "_write_slots", None)
+    inner = blocking_session()
+    state = FakeState([Agent("Yoda", "The Jedi master")])
+
+    async def run():
+        session = WriteBehindSession(inner)
+        session.save_state(state)
+        # Wait for the snapshot to be in flight
+        await asyncio.sleep(0.05)
+        state.evidence = "Exhibit A"
+        session.save_state(state)
+        state.agents[0].mood = "Calm"
+        session.save_state(state)
+        session.save_draft(1, "Yoda", "Hmm")
+        session.save_draft(1, "Yoda", "Hmm, guilty")
+        assert len(session.queue) == 2
+        inner.release.set()
+        await session.close()
+        assert session.task is None
+
+    asyncio.run(run())
+    assert [kind for kind, _ in inner.writes] == ["snapshot", "event", "draft"]
+    assert inner.writes[1][1]["delta"] == {"evidence": "Exhibit A", "agents": {"Yoda": {"mood": "Calm"}}}
+    assert inner.writes[2][1] == (1, "Yoda", "Hmm, guilty", False)
+
+
+def test_write_behind_limits_writes_in_flight(monkeypatch):
+    monkeypatch.setattr(WriteBehindSession, "_write_slots", None)
+    monkeypatch.setattr(db, "MAX_WRITES_IN_FLIGHT", 2)
+    release = threading.Event()
+    in_flight = {"lock": threading.Lock(), "now": 0, "max": 0}
+    inners = [BlockingSession(room, release, in_flight) for room in "ABCDE"]
+
+    async def run():
+        sessions = [WriteBehindSession(inner) for inner in inners]
+        for session in sessions:
+            session.save_transcript(1, "Exhibit A")
+        await asyncio.sleep(0.05)
+        assert in_flight["now"] == 2
+        release.set()
+        await asyncio.gather(*(session.close() for session in sessions))
+
+    asyncio.run(run())
+    assert in_flight["max"] == 2
+    assert all(inner.writes == [("transcript", (1, "Exhibit A"))] for inner in inners)
+
+
+def test_write_behind_flushes_on_close(monkeypatch):
+    monkeypatch.setattr(db, "STATE_EVENTS", True)
+    monkeypatch.setattr(WriteBehindSession, "_write_slots", None)
+    inner = blocking_session()
+    inner.release.set()
+    state = FakeState([Agent("Yoda", "The Jedi master")])
+
+    async def run():
+        session = WriteBehindSession(inner)
+        session.save_state(state)
+        session.save_transcript(1, "Exhibit A")
+        state.verdict = "Guilty"
+        session.save_state(state)
+        await session.close()
+
+    asyncio.run(run())
+    assert [kind for kind, _ in inner.writes] == ["snapshot", "transcript", "event"]
+    assert inner.writes[2][1]["delta"] == {"verdict": "Guilty"}
+
+
+class FakeSupabase:
+    """Just enough of the Supabase client for DatabaseSession"""
+
+    def __init__(self):
+        self.tables = {}
+        self.ids = itertools.count(1)
+
+    def table(self, name):
+        return FakeQuery(self, self.tables.setdefault(name, []))
+
+
+class FakeQuery:
+    def __init__(self, client, rows):
+        self.client = client
+        self.rows = rows
+        self.filters = []
+        self.ordering = None
+        self.count = None
+        self.new_row = None
+
+    def insert(self, row):
+        self.new_row = row
+        return self
+
+    def select(self, columns):
+        return self
+
+    def eq(self, key, value):
+        self.filters.append(lambda row: row.get(key) == value)
+        return self
+
+    def gt(self, key, value):
+        self.filters.append(lambda row: row.get(key) is not None and row[key] > value)
+        return self
+
+    def order(self, key, desc=False):
+        self.ordering = (key, desc)
+        return self
+
+    def limit(self, count):
+        self.count = count
+        return self
+
+    def execute(self):
+        if self.new_row is not None:
+            # Like the database, ids and timestamps only go up
+            i = next(self.client.ids)
+            row = {"id": i, "created_at": i, "transcript": None, **copy.deepcopy(self.new_row)}
+            self.rows.append(row)
+            return Result([row])
+        rows = [row for row in self.rows if all(f(row) for f in self.filters)]
+        if self.ordering:
+            key, desc = self.ordering
+            rows.sort(key=lambda row: row[key], reverse=desc)
+        return Result(copy.deepcopy(rows[: self.count]))
+
+
+class Result:
+    def __init__(self, data):
+        self.data = data
+
+
+@pytest.mark.parametrize("backend", ["supabase", "sqlite"])
+def test_resume_after_restarts(backend, monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "STATE_EVENTS", True)
+    if backend == "supabase":
+        supabase = FakeSupabase()
+        monkeypatch.setenv("SUPABASE_URL", "https://example.supabase.co")
+        monkeypatch.setenv("SUPABASE_API_KEY", "key")
+        monkeypatch.setattr(db, "create_client", lambda url, key: supabase)
+
+    def open_session():
+        if backend == "supabase":
+            return db.DatabaseSession("A")
+        return SQLiteSession("A", str(tmp_path / "llama_jury.db"))
+
+    first = open_session()
+    state = FakeState([Agent("Yoda", "The Jedi master"), Agent("Worf", "The Klingon")])
+    state.case_id = first.create_case("A")
+    first.save_state(state)
+    for i in range(5):
+        state.agents[0].mood = f"p1-mood{i}"
+        first.save_state(state)
+
+    # Every restart continues with a snapshot, then events
+    for process in ["p2", "p3"]:
+        session = open_session()
+        case_id, agents, evidence, verdict, transcript = asyncio.run(session.load_latest("A"))
+        assert case_id == state.case_id
+        assert agents == state.agents
+        state.agents = agents
+        session.save_state(state)
+        state.agents[0].mood = f"{process}-mood"
+        session.save_state(state)
+
+    _, agents, _, _, _ = asyncio.run(open_session().load_latest("A"))
+    assert agents[0].mood == "p3-mood"
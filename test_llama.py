@@ -1,5 +1,14 @@
+import asyncio
+from collections import defaultdict, deque
+
 import pytest
-from llama import parse_formatted_response, response_format_prompt, fuzzy_percent
+
+import agent
+import backends
+import llama
+from agent import Agent
+from llama import parse_formatted_response, response_format_prompt, fuzzy_percent, gen_formatted_response
+from structured import Field, Percent, Schema
 
 def test_parse_formatted_response():
     parsed = parse_formatted_response("""foo bar
@@ -135,3 +144,181 @@ def test_fuzzy_percent():
         fuzzy_percent("")
     with pytest.raises(ValueError):
         fuzzy_percent("foo")
+
+
+class ChunkedBackend(backends.Backend):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sent = 0
+
+    async def stream(self, prompt, **params):
+        for chunk in self.chunks:
+            self.sent += 1
+            yield chunk
+
+
+def test_early_stop(monkeypatch):
+    schema = Schema([Field("MOOD"), Field("BELIEFS"), Percent("GUILTY_PERCENTAGE")])
+    backend = ChunkedBackend(
+        ["MOOD: happy\n", "\nBELIEFS: i can fly\n", "\ni can touch the sky\n", "\nGUILTY_PERCENTAGE: 4", "0%\n", "I also like cats\n"]
+    )
+    monkeypatch.setattr(backends, "text", backend)
+    output = asyncio.run(llama.gen("How are you?", schema=schema))
+    assert output == "MOOD: happy\n\nBELIEFS: i can fly\n\ni can touch the sky\n\nGUILTY_PERCENTAGE: 40%"
+    assert backend.sent == 5
+
+    # A field that can't be parsed dooms the response
+    backend = ChunkedBackend(["GUILTY_PERCENTAGE: very\n", "MOOD: happy\n\n", "BELIEFS: i can fly\n\n"])
+    monkeypatch.setattr(backends, "text", backend)
+    asyncio.run(llama.gen("How are you?", schema=schema))
+    assert backend.sent == 1
+
+    schema = Schema([Field("MOOD"), Field("OPINION_ABOUT_YODA")])
+    backend = ChunkedBackend(["MOOD: happy\n\nOPINION_ABOUT_YODA: wise\n", "\n", "He is short\n"])
+    monkeypatch.setattr(backends, "text", backend)
+    asyncio.run(llama.gen("How are you?", schema=schema))
+    assert backend.sent == 2
+
+
+def test_partials_that_break_character_are_withheld(monkeypatch):
+    outputs = [
+        ["I think", " he is guilty.", " As an", " AI", " language model", " I can't judge."],
+        ["He did", " it!"],
+    ]
+
+    class Backend(backends.Backend):
+        async def stream(self, prompt, **params):
+            for chunk in outputs.pop(0):
+                yield chunk
+
+    monkeypatch.setattr(backends, "text", Backend())
+    partials = []
+    assert asyncio.run(llama.gen("Speak", on_partial=partials.append)) == "He did it!"
+    assert partials == ["I think", "I think he is guilty.", "I think he is guilty. As an", "", "He did", "He did it!"]
+
+
+class ScriptedBackend(backends.Backend):
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self.prompts = []
+
+    async def generate(self, prompt, **params):
+        self.prompts.append((prompt, params))
+        return self.outputs.pop(0)
+
+
+def test_partial_retry(monkeypatch):
+    backend = ScriptedBackend(["MOOD: happy\n\nGUILTY_PERCENTAGE: very", "GUILTY_PERCENTAGE: 40%"])
+    monkeypatch.setattr(backends, "text", backend)
+    schema = Schema([Field("MOOD"), Percent("GUILTY_PERCENTAGE")])
+
+    parsed = asyncio.run(gen_formatted_response("How are you?", schema))
+    assert parsed == {"MOOD": "happy", "GUILTY_PERCENTAGE": 40}
+    prompt, params = backend.prompts[1]
+    assert prompt.endswith("MOOD: happy\n\nSome of your response is missing. Reply with only the following, in the same format:\n\nGUILTY_PERCENTAGE:")
+    assert params["max_length"] == Percent.max_length
+
+
+class SlowFirstBackend(backends.Backend):
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = 0
+
+    async def generate(self, prompt, **params):
+        self.calls += 1
+        try:
+            await asyncio.sleep(10 if self.calls == 1 else 0.01)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return f"Call {self.calls}"
+
+
+def test_hedging(monkeypatch):
+    backend = SlowFirstBackend()
+    monkeypatch.setattr(backends, "text", backend)
+    monkeypatch.setattr(llama, "HEDGING", True)
+    monkeypatch.setattr(llama, "hedge_latencies", {False: deque([0.01] * 20), True: deque()})
+    monkeypatch.setattr(llama, "hedge_budgets", defaultdict(lambda: {"calls": 9, "hedges": 0}))
+
+    assert asyncio.run(llama.gen("Say something", hedge=True)) == "Call 2"
+    assert backend.cancelled == 1
+
+    # Out of budget
+    llama.hedge_budgets[None]["calls"] = 0
+    backend.calls = 0
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(llama.gen("Say something", hedge=True), 0.1))
+    assert backend.calls == 1
+
+
+def test_preconceptions_cached_per_cast(monkeypatch):
+    monkeypatch.setattr(agent, "preconceptions", {})
+    backend = ScriptedBackend(
+        ["OPINION_ABOUT_WORF: Stern\n\nOPINION_ABOUT_DATA: Odd", "OPINION_ABOUT_WORF: Loud\n\nOPINION_ABOUT_DATA: Pale"]
+    )
+    monkeypatch.setattr(backends, "text", backend)
+    yoda, worf, data = Agent("Yoda", "The wise Yoda"), Agent("Worf", "Lieutenant Worf"), Agent("Data", "An android")
+
+    asyncio.run(yoda.set_preconceptions_about_fellow_jury_members([worf, data]))
+    assert len(backend.prompts) == 1
+    assert yoda.agent_sentiments == {"Worf": "Stern", "Data": "Odd"}
+
+    # The same jury in the next case
+    yoda = Agent("Yoda", "The wise Yoda")
+    asyncio.run(yoda.set_preconceptions_about_fellow_jury_members([worf, data]))
+    assert len(backend.prompts) == 1
+    assert yoda.agent_sentiments == {"Worf": "Stern", "Data": "Odd"}
+
+    asyncio.run(yoda.set_preconceptions_about_fellow_jury_members([worf, data], refresh=True))
+    assert len(backend.prompts) == 2
+    assert backend.prompts[1][1]["cache"] == "refresh"
+    assert yoda.agent_sentiments == {"Worf": "Loud", "Data": "Pale"}
+
+
+def test_hear_all_falls_back_per_juror(monkeypatch):
+    async def no_image(agent):
+        pass
+
+    monkeypatch.setattr(agent, "update_image", no_image)
+    yoda, worf, data = Agent("Yoda", "The wise Yoda"), Agent("Worf", "Lieutenant Worf"), Agent("Data", "An android")
+    backend = ScriptedBackend(
+        [
+            # Worf's percentages are missing
+            """YODA_MOOD: Calm
+
+YODA_BELIEFS: * Guilty he is
+
+YODA_GUILTY_PERCENTAGE: 80%
+
+YODA_INNOCENT_PERCENTAGE: 20%
+
+YODA_OPINION_ABOUT_DATA: Logical
+
+WORF_MOOD: Angry
+
+WORF_BELIEFS: * Dishonorable
+
+WORF_OPINION_ABOUT_DATA: Weak""",
+            """MOOD: Furious
+
+WORF_BELIEFS: * Without honor
+
+GUILTY_PERCENTAGE: 90%
+
+INNOCENT_PERCENTAGE: 10%
+
+OPINION_ABOUT_DATA: Too calm""",
+        ]
+    )
+    monkeypatch.setattr(backends, "text", backend)
+
+    asyncio.run(agent.hear_all([yoda, worf], "He did it.", True, speaker=data))
+    assert len(backend.prompts) == 2
+    assert "WORF_GUILTY_PERCENTAGE:" in backend.prompts[0][0]
+    assert "Lieutenant Worf" in backend.prompts[1][0]
+    assert "Yoda" not in backend.prompts[1][0]
+    assert (yoda.mood, yoda.beliefs, yoda.guilty_percent, yoda.innocent_percent) == ("Calm", "* Guilty he is", 80, 20)
+    assert yoda.agent_sentiments["Data"] == "Logical"
+    assert (worf.mood, worf.beliefs, worf.guilty_percent, worf.innocent_percent) == ("Furious", "* Without honor", 90, 10)
+    assert worf.agent_sentiments["Data"] == "Too calm"
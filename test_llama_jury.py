@@ -0,0 +1,321 @@
+import asyncio
+import re
+
+import pytest
+
+import agent
+import backends
+import client
+import llama
+import llama_jury
+import metrics
+import sd
+from agent import Agent
+from state import INITIAL_EVIDENCE, State
+
+
+class Jury(backends.Backend):
+    """Answers juror prompts like the fake llama, but with the eagerness of
+    every juror set by the test and utterances that say who is speaking.
+    Calls take as long as `seconds[(kind, name)]` and the ones that get
+    cancelled are recorded. The hearings of `garbled` jurors can't be
+    parsed, those of `failing` jurors fail."""
+
+    model = "test-jury"
+
+    def __init__(self, eagerness=None, seconds=None, guilty=60, garbled=(), failing=()):
+        self.eagerness = eagerness or {}
+        self.seconds = seconds or {}
+        self.guilty = guilty
+        self.garbled = garbled
+        self.failing = failing
+        self.limiter = client.Limiter("test", 100)
+        self.calls = []
+        self.prompts = []
+        self.cancelled = []
+        self.finished = []
+        self.summaries = 0
+
+    async def generate(self, prompt, **params):
+        match = re.search(r"^You are (\w+)\.$", prompt, re.MULTILINE)
+        name = match.group(1) if match else None
+        fields, _ = backends.requested_fields(prompt)
+        if fields == ["SPEAK_EAGERNESS"]:
+            kind = "eagerness"
+        elif fields:
+            kind = "hear"
+        elif "The record so far:" in prompt:
+            kind = "summary"
+        else:
+            kind = "say"
+        self.calls.append((kind, name))
+        self.prompts.append((kind, name, prompt))
+
+        async with self.limiter.slot():
+            try:
+                await asyncio.sleep(self.seconds.get((kind, name), 0))
+            except asyncio.CancelledError:
+                self.cancelled.append((kind, name))
+                raise
+        self.finished.append((kind, name))
+
+        if kind == "eagerness":
+            return f"SPEAK_EAGERNESS: {self.eagerness.get(name, 0)}%"
+        if kind == "summary":
+            self.summaries += 1
+            return f"* Summary {self.summaries}"
+        if kind == "say":
+            return f"{name} has spoken."
+        if name in self.failing:
+            raise client.ModelError("Fake failure")
+        if name in self.garbled:
+            return "I have no opinion."
+        values = {
+            "MOOD": "Calm",
+            "GUILTY_PERCENTAGE": f"{self.guilty}%",
+            "INNOCENT_PERCENTAGE": f"{100 - self.guilty}%",
+        }
+        return "\n\n".join(
+            # Fields may be prefixed with a juror's name
+            f"{field}: {next((v for k, v in values.items() if field.endswith(k)), '* Something')}"
+            for field in fields
+        )
+
+
+class Session:
+    def __init__(self):
+        self.saves = []
+
+    def save_state(self, state):
+        self.saves.append(
+            {a.name: (a.latest_utterance, a.latest_sentiment) for a in state.agents}
+        )
+
+    def save_draft(self, case_id, speaker, text, done=False):
+        pass
+
+
+def deliberating_jury(names, speaker):
+    """A jury in deliberation, right after `speaker` said something"""
+    agents = [Agent(name, name) for name in names]
+    state = State(
+        db=Session(),
+        room="A",
+        case_id=1,
+        evidence="",
+        agents=agents,
+        verdict=None,
+        transcript="Evidence.",
+    )
+    for a in agents:
+        a.speak_eagerness = 50
+        if a.name == speaker:
+            a.latest_utterance = "I have spoken."
+    return state
+
+
+@pytest.fixture
+def jury(monkeypatch):
+    async def no_image(agent):
+        pass
+
+    monkeypatch.setattr(agent, "update_image", no_image)
+    metrics.reset()
+
+    def use(**kwargs):
+        backend = Jury(**kwargs)
+        monkeypatch.setattr(backends, "text", backend)
+        return backend
+
+    return use
+
+
+def test_speculation_hit(jury, monkeypatch):
+    monkeypatch.setattr(llama_jury, "SPECULATIVE_SPEAKERS", 2)
+    state = deliberating_jury(["Yoda", "Worf", "Data", "Spock"], speaker="Yoda")
+    # The most eager last time are speculated on
+    state.agents[1].speak_eagerness = 90
+    state.agents[2].speak_eagerness = 80
+    backend = jury(
+        eagerness={"Data": 100},
+        seconds={("say", "Worf"): 0.1, ("say", "Data"): 0.1, ("eagerness", "Yoda"): 0.05},
+    )
+
+    asyncio.run(llama_jury.next_utterance(state))
+    says = [name for kind, name in backend.calls if kind == "say"]
+    assert says == ["Worf", "Data"]
+    assert backend.cancelled == [("say", "Worf")]
+    assert [name for name, (said, _) in state.db.saves[-1].items() if said] == ["Data"]
+    assert state.agents[2].latest_utterance == "Data has spoken."
+    assert backend.limiter.in_flight == 0
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"]["speculation.hits"] == 1
+    assert snapshot["counters"]["speculation.wasted_calls"] == 1
+    # Speaker selection took as long as Yoda's eagerness
+    saved = snapshot["summaries"]["speculation.saved_seconds"]
+    assert saved["count"] == 1
+    assert 0.04 < saved["max"] < 0.1
+
+
+def test_speculation_miss(jury, monkeypatch):
+    monkeypatch.setattr(llama_jury, "SPECULATIVE_SPEAKERS", 2)
+    state = deliberating_jury(["Yoda", "Worf", "Data", "Spock"], speaker="Yoda")
+    state.agents[1].speak_eagerness = 90
+    state.agents[2].speak_eagerness = 80
+    backend = jury(
+        eagerness={"Spock": 100},
+        seconds={("say", "Worf"): 0.1, ("say", "Data"): 0.1},
+    )
+
+    asyncio.run(llama_jury.next_utterance(state))
+    says = [name for kind, name in backend.calls if kind == "say"]
+    assert says == ["Worf", "Data", "Spock"]
+    assert sorted(backend.cancelled) == [("say", "Data"), ("say", "Worf")]
+    assert state.db.saves[-1]["Spock"] == ("Spock has spoken.", "")
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"]["speculation.misses"] == 1
+    assert snapshot["counters"]["speculation.wasted_calls"] == 2
+    assert "speculation.saved_seconds" not in snapshot["summaries"]
+
+
+def test_speculation_cancelled_with_selection(jury, monkeypatch):
+    monkeypatch.setattr(llama_jury, "SPECULATIVE_SPEAKERS", 2)
+    state = deliberating_jury(["Yoda", "Worf", "Data"], speaker="Yoda")
+    backend = jury(seconds={("say", "Worf"): 1, ("say", "Data"): 1, ("eagerness", "Yoda"): 1})
+
+    async def run():
+        task = asyncio.create_task(llama_jury.next_utterance(state))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert backend.limiter.in_flight == 0
+
+    asyncio.run(run())
+    assert sorted(backend.cancelled) == [("eagerness", "Yoda"), ("say", "Data"), ("say", "Worf")]
+    assert state.db.saves == []
+
+
+def test_pipelined_deliberation(jury):
+    state = deliberating_jury(["Yoda", "Worf", "Data"], speaker="Yoda")
+    backend = jury(
+        eagerness={"Worf": 100},
+        seconds={("hear", "Worf"): 0.05, ("hear", "Data"): 0.2},
+    )
+
+    asyncio.run(llama_jury.next_sentiment_and_utterance(state))
+    # Worf starts talking once he has heard Yoda, before Data has
+    assert backend.calls.index(("say", "Worf")) > backend.finished.index(("hear", "Worf"))
+    assert backend.finished.index(("say", "Worf")) < backend.finished.index(("hear", "Data"))
+    # Saved like next_sentiment followed by next_utterance
+    reactions, utterance = state.db.saves
+    assert reactions == {
+        "Yoda": ("I have spoken.", ""),
+        "Worf": ("", "* Something"),
+        "Data": ("", "* Something"),
+    }
+    assert utterance == {"Yoda": ("", ""), "Worf": ("Worf has spoken.", ""), "Data": ("", "")}
+    assert state.num_deliberation_steps == 1
+
+
+def test_pipelined_deliberation_reaches_verdict(jury):
+    state = deliberating_jury(["Yoda", "Worf", "Data"], speaker="Yoda")
+    state.agents[0].guilty_percent, state.agents[0].innocent_percent = 90, 10
+    state.num_deliberation_steps = 3
+    backend = jury(eagerness={"Worf": 100}, guilty=90, seconds={("say", "Worf"): 1})
+
+    async def run():
+        await llama_jury.next_sentiment_and_utterance(state)
+        assert backend.limiter.in_flight == 0
+
+    asyncio.run(run())
+    assert backend.cancelled == [("say", "Worf")]
+    assert len(state.db.saves) == 1
+    assert state.current_step() == State.AWAITING_VERDICT
+    assert metrics.snapshot()["counters"]["pipeline.discarded_utterances"] == 1
+
+
+def test_pipelined_deliberation_without_reactions(jury):
+    state = deliberating_jury(["Yoda", "Worf", "Data"], speaker="Yoda")
+    backend = jury(eagerness={"Worf": 100}, garbled=("Worf", "Data"))
+
+    asyncio.run(llama_jury.next_sentiment_and_utterance(state))
+    # The utterance is kept even though nobody's reaction could be parsed
+    assert state.db.saves[-1]["Worf"] == ("Worf has spoken.", "")
+    assert backend.cancelled == []
+    assert metrics.snapshot()["counters"]["pipeline.failed_hearings"] == 1
+
+
+def test_pipelined_deliberation_failure(jury, monkeypatch):
+    monkeypatch.setattr(llama, "GEN_ATTEMPTS", 1)
+    state = deliberating_jury(["Yoda", "Worf", "Data", "Spock"], speaker="Yoda")
+    backend = jury(
+        eagerness={"Worf": 100},
+        failing=("Data",),
+        seconds={("hear", "Data"): 0.05, ("hear", "Spock"): 1, ("say", "Worf"): 1},
+    )
+
+    async def run():
+        with pytest.raises(client.ModelError):
+            await llama_jury.next_sentiment_and_utterance(state)
+        # Everything else was cancelled and cleaned up before the error got here
+        assert backend.limiter.in_flight == 0
+        assert sorted(backend.cancelled) == [("hear", "Spock"), ("say", "Worf")]
+
+    asyncio.run(run())
+    assert state.db.saves == []
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_shared_case_summary(jury, monkeypatch, batched):
+    monkeypatch.setattr(llama_jury, "SHARED_CASE_SUMMARY", True)
+    monkeypatch.setattr(llama_jury, "BATCHED_HEARING", batched)
+    state = deliberating_jury(["Yoda", "Worf", "Data"], speaker=None)
+    state.evidence = INITIAL_EVIDENCE
+    state.transcript = "The defendant was seen.\n\nThe glove doesn't fit."
+    backend = jury()
+
+    async def run():
+        for _ in range(2):
+            await llama_jury.next_evidence(state)
+
+    asyncio.run(run())
+    # Summarized once per piece of evidence instead of by every juror
+    assert backend.summaries == 2
+    hearings = [prompt for kind, _, prompt in backend.prompts if kind == "hear"]
+    assert len(hearings) == (2 if batched else 6)
+    assert not any("FACTUAL_SUMMARY" in prompt for prompt in hearings)
+    # Every juror hears the second piece of evidence with the first summary
+    for prompt in hearings[len(hearings) // 2 :]:
+        assert prompt.count("* Summary 1") == (len(state.agents) if batched else 1)
+    assert state.case_summary == "* Summary 2"
+    assert [a.summary for a in state.agents] == ["* Summary 2"] * 3
+
+
+def test_background_portraits_are_saved_after_the_step(monkeypatch):
+    async def make_portrait(name, mood):
+        return f"{name}-{mood}.png"
+
+    async def run_step(state):
+        state.agents[0].mood = "Angry"
+        await sd.update_image(state.agents[0])
+        while not state.needs_save:
+            await asyncio.sleep(0)
+        # Not in the middle of a step
+        assert state.db.saves == []
+
+    monkeypatch.setattr(sd, "make_portrait", make_portrait)
+    monkeypatch.setattr(llama_jury, "run_step", run_step)
+    monkeypatch.setattr(llama_jury, "BACKGROUND_IMAGES", True)
+    state = deliberating_jury(["Yoda", "Worf"], speaker="Yoda")
+
+    async def run():
+        async with llama_jury.background_images(state):
+            await llama_jury.step(state)
+
+    asyncio.run(run())
+    assert state.agents[0].image_uri == "Yoda-Angry.png"
+    assert len(state.db.saves) == 1
+    assert not state.needs_save
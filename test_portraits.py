@@ -0,0 +1,47 @@
+import asyncio
+
+from portraits import normalize_mood, PortraitLibrary, MOODS
+
+
+def test_normalize_mood():
+    assert normalize_mood("Grumpy") == "grumpy"
+    assert normalize_mood("grumpy.") == "grumpy"
+    assert normalize_mood("Very grouchy") == "grumpy"
+    assert normalize_mood("Grumpier than usual. I miss the thrill of battle.") == "grumpy"
+    assert normalize_mood("suspicous") == "suspicious"
+    assert normalize_mood("Intrigued and a bit puzzled") == "intrigued"
+    assert normalize_mood("") == "neutral"
+    assert normalize_mood("Qo'noS") == "neutral"
+
+
+def test_normalize_negated_mood():
+    assert normalize_mood("Not happy") == "neutral"
+    assert normalize_mood("Not very happy at all") == "neutral"
+    assert normalize_mood("I'm not amused.") == "neutral"
+    assert normalize_mood("Isn't convinced") == "neutral"
+    assert normalize_mood("Not happy, but curious") == "curious"
+    assert normalize_mood("Happy, not angry") == "happy"
+
+
+def test_portrait_library():
+    library = PortraitLibrary(":memory:", max_portraits=2)
+    renders = []
+
+    async def render(character, mood):
+        renders.append((character, mood))
+        return f"{character}-{mood}.png"
+
+    async def run():
+        results = await asyncio.gather(
+            library.get_or_render("Yoda", "calm", render),
+            library.get_or_render("Yoda", "calm", render),
+        )
+        assert results == ["Yoda-calm.png", "Yoda-calm.png"]
+        assert await library.get_or_render("Yoda", "calm", render) == "Yoda-calm.png"
+        await library.get_or_render("Yoda", "sad", render)
+        await library.get_or_render("Yoda", "angry", render)
+
+    asyncio.run(run())
+    assert renders == [("Yoda", "calm"), ("Yoda", "sad"), ("Yoda", "angry")]
+    assert library.get("Yoda", "calm") is None
+    assert len(library.missing(["Yoda"])) == len(MOODS) - 2
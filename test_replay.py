@@ -0,0 +1,113 @@
+import asyncio
+import json
+import random
+
+import pytest
+
+import agent
+import backends
+import llama
+import llama_jury
+import replay
+import sd
+
+
+class Session:
+    def __init__(self, room):
+        self.room = room
+
+    def create_case(self, room):
+        return 1
+
+    def save_state(self, state):
+        pass
+
+    def save_draft(self, case_id, speaker, text, done=False):
+        pass
+
+    def save_transcript(self, case_id, transcript):
+        pass
+
+
+@pytest.fixture
+def models(monkeypatch):
+    for name in ["text", "chat", "image"]:
+        monkeypatch.setattr(backends, name, getattr(backends, name))
+    # Preconceptions of a previous case would be reused
+    monkeypatch.setattr(agent, "preconceptions", {})
+
+
+def record(path, seed):
+    random.seed(seed)
+    backends.use_fake(latency=0.001, seed=seed)
+    recorder = replay.Recorder(path, "A", seed)
+    backends.wrap(lambda backend: replay.RecordingBackend(backend, recorder))
+    try:
+        asyncio.run(llama_jury.run_single_case(replay.RecordingSession(Session("A"), recorder), "A"))
+    finally:
+        recorder.close()
+
+
+def replay_case(path):
+    log = replay.ReplayLog(path)
+    random.seed(log.header["seed"])
+    replay.use_replay(log)
+    db = replay.ReplaySession(log)
+    asyncio.run(llama_jury.run_single_case(db, log.header["room"]))
+    db.finish()
+    return log, db
+
+
+def test_record_and_replay(tmp_path, models):
+    path = tmp_path / "case.jsonl"
+    record(path, seed=1)
+    with open(path) as f:
+        entries = [json.loads(line) for line in f]
+    assert any(entry["type"] == "model" and entry["model"] == "fake-sdxl" for entry in entries)
+
+    agent.preconceptions.clear()
+    log, db = replay_case(path)
+    assert db.divergences == 0
+    assert dict(log.mismatches) == {}
+    assert all(entry["used"] for calls in log.calls_by_model.values() for entry in calls)
+
+
+def test_replay_resyncs_after_a_divergence(tmp_path):
+    path = tmp_path / "case.jsonl"
+    rows = [{"evidence": str(i)} for i in range(5)]
+    with open(path, "w") as f:
+        f.write(json.dumps({"type": "header", "room": "A", "seed": 1, "models": {}}) + "\n")
+        for row in rows:
+            f.write(json.dumps({"type": "db", "method": "save_state", "row": row}) + "\n")
+    db = replay.ReplaySession(replay.ReplayLog(path))
+
+    def save(row):
+        db.check("save_state", "row", row)
+
+    save(rows[0])
+    save({"evidence": "extra"})
+    save(rows[1])
+    # rows[2] is missing
+    save(rows[3])
+    assert db.divergences == 2
+    db.finish()
+    # And so is rows[4]
+    assert db.divergences == 3
+
+
+def test_replay_mismatches_fail_fast(tmp_path, models):
+    path = tmp_path / "case.jsonl"
+    names = {"text": "fake-llama", "chat": "fake-gpt", "image": "fake-sdxl"}
+    path.write_text(json.dumps({"type": "header", "room": "A", "seed": 1, "models": names}) + "\n")
+    log = replay.ReplayLog(path)
+    replay.use_replay(log)
+
+    async def run():
+        with pytest.raises(replay.ReplayMismatch):
+            await llama.gen("Hi")
+        # Portraits are optional
+        assert await sd.render_portrait("Yoda", "Calm") == ""
+
+    asyncio.run(run())
+    # Neither was retried
+    assert dict(log.mismatches) == {"fake-llama": 1, "fake-sdxl": 1}
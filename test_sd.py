@@ -0,0 +1,59 @@
+import asyncio
+
+import metrics
+import sd
+from agent import Agent
+
+
+def test_image_worker(monkeypatch):
+    metrics.reset()
+    renders = []
+    rendering = asyncio.Event()
+    release = None
+
+    async def make_portrait(name, mood):
+        renders.append((name, mood))
+        if mood == "Slow":
+            rendering.set()
+            await release.wait()
+        return "" if mood == "Camera shy" else f"{name}-{mood}.png"
+
+    monkeypatch.setattr(sd, "make_portrait", make_portrait)
+    ready = []
+    worker = sd.ImageWorker(lambda: ready.append(True))
+    yoda = Agent("Yoda", "The wise Yoda")
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        task = asyncio.create_task(worker.run())
+
+        # Requests that are still waiting are replaced by newer ones
+        for mood in ["Calm", "Angry"]:
+            yoda.mood = mood
+            worker.request(yoda)
+        await worker.join()
+        assert renders == [("Yoda", "Angry")]
+        assert yoda.image_uri == "Yoda-Angry.png"
+        assert len(ready) == 1
+
+        # A portrait of a mood that changed while it was rendered is dropped
+        yoda.mood = "Slow"
+        worker.request(yoda)
+        await rendering.wait()
+        yoda.mood = "Sad"
+        release.set()
+        await worker.join()
+        assert yoda.image_uri == "Yoda-Angry.png"
+        assert len(ready) == 1
+
+        # Agents keep their portrait when a new one can't be made
+        yoda.mood = "Camera shy"
+        worker.request(yoda)
+        await worker.join()
+        assert yoda.image_uri == "Yoda-Angry.png"
+        assert len(ready) == 1
+        task.cancel()
+
+    asyncio.run(run())
+    assert metrics.snapshot()["counters"]["images.dropped_stale"] == 2
@@ -0,0 +1,120 @@
+from structured import Field, Percent, Schema, combine, prefixed
+
+SCHEMA = Schema([Field("MOOD"), Field("BELIEFS"), Percent("GUILTY_PERCENT")])
+
+
+def test_parse():
+    parsed = SCHEMA.parse("""foo bar
+
+MOOD:
+
+i am happy
+
+BELIEFS:
+
+i believe i can fly
+
+i believe i can touch the sky
+GUILTY PERCENT:
+
+10
+""")
+    assert parsed == {
+        "MOOD": "i am happy",
+        "BELIEFS": "i believe i can fly\n\ni believe i can touch the sky",
+        "GUILTY_PERCENT": 10,
+    }
+
+    parsed = SCHEMA.parse("""**MOOD:** Grumpier than usual.
+
+**BELIEFS:** He smells like a scoundrel.
+
+**GUILTY_PERCENT:** 60% (increased from 50%). My instincts tell me that Jenkins is guilty.""")
+    assert parsed == {
+        "MOOD": "Grumpier than usual.",
+        "BELIEFS": "He smells like a scoundrel.",
+        "GUILTY_PERCENT": 60,
+    }
+
+
+def test_parse_fields():
+    values, errors = SCHEMA.parse_fields("""MOOD: i am happy
+
+GUILTY_PERCENT: foo
+""")
+    assert values == {"MOOD": "i am happy"}
+    assert errors == ["BELIEFS", "GUILTY_PERCENT"]
+    assert SCHEMA.parse("MOOD: i am happy\n\nGUILTY_PERCENT: foo") is None
+
+
+def test_labels():
+    # Only the schema's own labels at the start of a line count
+    values, errors = SCHEMA.parse_fields("""MOOD: wary. My BELIEFS: none yet
+
+NOT_GUILTY_PERCENT: 90
+""")
+    assert values == {"MOOD": "wary. My BELIEFS: none yet\n\nNOT_GUILTY_PERCENT: 90"}
+    assert errors == ["BELIEFS", "GUILTY_PERCENT"]
+
+    # Other lines that look like labels, e.g. bullets or headings, are part of
+    # a value
+    values, errors = SCHEMA.parse_fields("""MOOD: wary
+
+BELIEFS:
+* DNA: found on the glove
+# NOTE: the glove doesn't fit
+**GUILTY_PERCENT:** 70
+""")
+    assert values == {
+        "MOOD": "wary",
+        "BELIEFS": "* DNA: found on the glove\n# NOTE: the glove doesn't fit",
+        "GUILTY_PERCENT": 70,
+    }
+    assert SCHEMA.check("BELIEFS:\n* DNA: found on the glove\n") is None
+
+    output = "YODA_MOOD: calm\nYODA_BELIEFS: patience\nYODA_GUILTY_PERCENT: 30"
+    assert SCHEMA.parse(output) is None
+    schema = Schema(SCHEMA.fields, qualifiers=("YODA",))
+    assert schema.parse(output) == {"MOOD": "calm", "BELIEFS": "patience", "GUILTY_PERCENT": 30}
+    assert schema.parse(output.replace("YODA", "WORF")) is None
+
+
+def test_repair():
+    assert SCHEMA.parse("MOOD: a\nBELIEFS: b\nGUILTY_PERCENT: fifty percent")["GUILTY_PERCENT"] == 50
+    assert SCHEMA.parse("MOOD: a\nBELIEFS: b\nGUILTY_PERCENT: 150%")["GUILTY_PERCENT"] == 100
+
+
+def test_json():
+    parsed = SCHEMA.parse("""Sure! Here you go:
+```json
+{"MOOD": "happy", "BELIEFS": "i can fly", "GUILTY_PERCENT": 20}
+```""")
+    assert parsed == {"MOOD": "happy", "BELIEFS": "i can fly", "GUILTY_PERCENT": 20}
+
+
+def test_prefixed():
+    schema = combine(prefixed(SCHEMA, "YODA"), prefixed(SCHEMA, "WORF"))
+    assert schema.names[:2] == ["YODA_MOOD", "YODA_BELIEFS"]
+    values, errors = schema.parse_fields("""YODA_MOOD: calm
+YODA_BELIEFS: guilty he is
+YODA_GUILTY_PERCENT: 90%
+WORF_MOOD: angry
+""")
+    assert values["YODA_GUILTY_PERCENT"] == 90
+    assert values["WORF_MOOD"] == "angry"
+    assert errors == ["WORF_BELIEFS", "WORF_GUILTY_PERCENT"]
+
+
+def test_check():
+    assert SCHEMA.check("MOOD: happy\n") is None
+    assert SCHEMA.check("MOOD: happy\n\nBELIEFS: i can fly\n\ni can touch the sky\n") is None
+    assert SCHEMA.check("MOOD: happy\n\nBELIEFS: i can fly\n\nGUILTY_PERCENT: 4") is None
+    assert SCHEMA.check("MOOD: happy\n\nBELIEFS: i can fly\n\nGUILTY_PERCENT: 40%\n") == "complete"
+    assert SCHEMA.check("MOOD: happy\n\nBELIEFS: i can fly\n\nGUILTY_PERCENT: very\n") == "broken"
+    assert SCHEMA.check("GUILTY_PERCENT: very\nMOOD: happy") == "broken"
+    assert SCHEMA.check('{"MOOD": "happy", "BELIEFS": "i can') is None
+    assert SCHEMA.check('{"MOOD": "happy", "BELIEFS": "i can fly", "GUILTY_PERCENT": 5}') == "complete"
+
+    schema = Schema([Field("MOOD"), Field("OPINION_ABOUT_YODA")])
+    assert schema.check("MOOD: happy\n\nOPINION_ABOUT_YODA: wise\n") is None
+    assert schema.check("MOOD: happy\n\nOPINION_ABOUT_YODA: wise\n\n") == "complete"
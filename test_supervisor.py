@@ -0,0 +1,56 @@
+import asyncio
+import signal
+import time
+
+import supervisor
+
+
+def crash(rooms, args, conn):
+    conn.send({"counters": {"crashes": 1}, "gauges": {}, "summaries": {}})
+    raise SystemExit(3)
+
+
+def test_worker_restarts_after_crash():
+    worker = supervisor.Worker(0, ["dev-A"], crash, None)
+    worker.start()
+    worker.process.join(30)
+
+    asyncio.run(worker.check())
+    assert worker.metrics["counters"] == {"crashes": 1}
+    assert worker.process is None
+    assert worker.restarts == 1
+
+    worker.restart_at = time.monotonic()
+    asyncio.run(worker.check())
+    assert worker.process is not None
+    asyncio.run(worker.stop())
+
+
+def ignore_terminate(rooms, args, conn):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    conn.send({"counters": {}, "gauges": {}, "summaries": {}})
+    time.sleep(60)
+
+
+def test_stop_does_not_block_the_event_loop():
+    worker = supervisor.Worker(0, ["dev-A"], ignore_terminate, None)
+    worker.start()
+    # Wait until SIGTERM is ignored
+    worker.conn.poll(30)
+
+    async def stop():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.1)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        await worker.stop(timeout=1)
+        ticker.cancel()
+        return ticks
+
+    assert asyncio.run(stop()) >= 5
+    assert worker.process is None